@@ -0,0 +1,30 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Benchmarks for toshokan that run without a network connection.
+
+    catalog  -- synthetic catalogs of 1k, 100k or 1M books with a realistic
+                skew of authors and publishers.
+    stand_in -- a local HTTP server answering like Open Library and Google
+                Books for the books of a synthetic catalog, with a
+                configurable latency and error rate.
+
+Run them from the top of the repository, which saves the results as JSON:
+
+    python -m benchmarks --size 100k --output results-0.3.json
+    python -m benchmarks --compare results-0.2.json results-0.3.json
+'''
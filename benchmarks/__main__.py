@@ -0,0 +1,97 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import sys
+from .catalog import SIZES
+from .suite import BENCHMARKS, compare_results, run_benchmarks
+
+
+def run(args) -> None:
+    results = run_benchmarks(SIZES[args.size], args.seed, args.latency,
+                             args.error_rate, args.lookups, args.searches,
+                             tuple(args.only.split(",")) if args.only
+                             else BENCHMARKS, args.work_dir)
+    text = json.dumps(results, indent = 2)
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as output:
+            output.write(text + "\n")
+        print(f"Saved the results to {args.output}.")
+    else:
+        print(text)
+
+
+def compare(args) -> None:
+    with open(args.compare[0], encoding = "utf-8") as old_file:
+        old = json.load(old_file)
+    with open(args.compare[1], encoding = "utf-8") as new_file:
+        new = json.load(new_file)
+    if old['parameters'] != new['parameters']:
+        print("WARNING: The results were made with different parameters: "
+              f"{old['parameters']} and {new['parameters']}.")
+    worse = 0
+    for metric, old_value, new_value, change, verdict in \
+            compare_results(old, new, args.threshold):
+        print(f"{metric:45} {old_value:12.2f} {new_value:12.2f} "
+              f"{change:+8.1%}  {verdict}")
+        worse += verdict == "worse"
+    sys.exit(1 if worse else 0)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog = "python -m benchmarks",
+                                     description = "Benchmark toshokan "
+                                     "against synthetic catalogs without a "
+                                     "network connection.")
+    parser.add_argument("-v", "--verbose", action = "store_true",
+                        help = "Log progress information.")
+    parser.add_argument("--size", default = "1k", choices = list(SIZES),
+                        help = "The number of books in the catalog.")
+    parser.add_argument("--seed", type = int, default = 0,
+                        help = "Makes a different catalog.")
+    parser.add_argument("--latency", type = float, default = 0.05,
+                        help = "The mean response time of the stand-in "
+                        "providers in seconds.")
+    parser.add_argument("--error-rate", type = float, default = 0.01,
+                        help = "The share of requests the stand-in providers "
+                        "fail.")
+    parser.add_argument("--lookups", type = int, default = 200,
+                        help = "The number of ISBNs looked up.")
+    parser.add_argument("--searches", type = int, default = 1000,
+                        help = "The number of searches run.")
+    parser.add_argument("--only", default = None,
+                        help = "A comma-separated list of the benchmarks to "
+                        f"run, out of {', '.join(BENCHMARKS)}.")
+    parser.add_argument("--work-dir", default = None,
+                        help = "Keep the databases in this directory instead "
+                        "of a temporary one.")
+    parser.add_argument("--output", default = None,
+                        help = "The JSON file the results are saved to. "
+                        "Printed if omitted.")
+    parser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"),
+                        help = "Compare two saved results instead of running "
+                        "the benchmarks. Exits with 1 if anything got worse.")
+    parser.add_argument("--threshold", type = float, default = 0.1,
+                        help = "The relative change --compare ignores.")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO if args.verbose
+                        else logging.WARNING)
+    if args.compare:
+        compare(args)
+    else:
+        run(args)
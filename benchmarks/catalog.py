@@ -0,0 +1,193 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Synthetic catalogs for the benchmarks.
+
+A real library is skewed: a few prolific authors and large publishers
+account for a big share of the books, while most names turn up once or
+twice. Authors and publishers are therefore drawn from Zipf distributions,
+so that the name caches, the UNIQUE indexes and the search index see the
+same kind of data as they would in practice.
+
+Every book is derived from its index alone, so the stand-in providers can
+answer for any ISBN of a catalog without keeping the catalog in memory.
+'''
+
+import itertools
+import random
+from typing import Iterator
+from book import book
+from identifiers import isbn13_to_isbn10
+
+# The catalog sizes the benchmarks are run with.
+SIZES = {
+    '1k': 1000,
+    '100k': 100000,
+    '1m': 1000000
+}
+
+# Made-up words and names are put together from these syllables.
+_SYLLABLES = ('ka', 'to', 'mi', 'ra', 'shi', 'no', 'be', 'lor', 'an', 'vel',
+              'tor', 'is', 'mar', 'en', 'da', 'qui', 'sel', 'om', 'ru', 'fen',
+              'ha', 'gol', 'ti', 'wen', 'zu', 'pe', 'dor', 'li', 'cas', 'yo')
+_PUBLISHER_SUFFIXES = ('Press', 'Books', 'Publishing', 'House', 'Editions',
+                       'Verlag', '& Sons', 'Media')
+# ISBN-13s of the catalog: this prefix followed by the index of the book.
+ISBN_PREFIX = '978'
+
+
+def _isbn_13(index: int) -> str:
+    first_12 = f"{ISBN_PREFIX}{index:09d}"
+    total = sum(int(digit) * (3 if position % 2 else 1)
+                for position, digit in enumerate(first_12))
+    return first_12 + str(-total % 10)
+
+
+def _word(rng: random.Random) -> str:
+    return ''.join(rng.choice(_SYLLABLES)
+                   for _ in range(rng.randint(2, 3))).capitalize()
+
+
+def _zipf_weights(count: int, skew: float) -> list:
+    '''
+    Return the cumulative weights of count ranks of a Zipf distribution with
+    exponent skew, for random.choices().
+    '''
+    return list(itertools.accumulate(1 / rank ** skew
+                                     for rank in range(1, count + 1)))
+
+
+class synthetic_catalog:
+    '''
+    A reproducible catalog of size books. The same size and seed always
+    give the same books.
+
+    There is one author for every books_per_author books and one publisher
+    for every books_per_publisher books; author_skew and publisher_skew are
+    the exponents of their Zipf distributions.
+    '''
+
+    def __init__(self, size: int, seed: int = 0,
+                 books_per_author: int = 8, books_per_publisher: int = 200,
+                 author_skew: float = 1.1, publisher_skew: float = 1.3):
+        self.size = size
+        self.seed = seed
+        rng = random.Random(seed)
+        self.authors = [f"{_word(rng)} {_word(rng)}"
+                        for _ in range(max(10, size // books_per_author))]
+        self.publishers = [f"{_word(rng)} {rng.choice(_PUBLISHER_SUFFIXES)}"
+                           for _ in range(max(5,
+                                              size // books_per_publisher))]
+        self._author_weights = _zipf_weights(len(self.authors), author_skew)
+        self._publisher_weights = _zipf_weights(len(self.publishers),
+                                                publisher_skew)
+
+    def isbn(self, index: int) -> str:
+        '''
+        Return the ISBN-13 of the book with the given index. Indexes of size
+        and above give ISBNs of books that are not in the catalog.
+        '''
+        return _isbn_13(index)
+
+    def index_of(self, isbn: str) -> int:
+        '''
+        Return the index of the book with the given ISBN-13, or None if it
+        is not in the catalog.
+        '''
+        if len(isbn) != 13 or not isbn.isdigit() or \
+                not isbn.startswith(ISBN_PREFIX):
+            return None
+        index = int(isbn[3:12])
+        if index >= self.size or _isbn_13(index) != isbn:
+            return None
+        return index
+
+    def record(self, index: int) -> dict:
+        '''
+        Return the metadata of the book with the given index in the format
+        of the provider modules.
+        '''
+        rng = random.Random(self.seed * 1000003 + index)
+        author_count = rng.choices((1, 2, 3), (80, 15, 5))[0]
+        authors = []
+        for name in rng.choices(self.authors, cum_weights=self._author_weights,
+                                k=author_count):
+            if name not in authors:
+                authors.append(name)
+        isbn_13 = self.isbn(index)
+        return {
+            'title': ' '.join(_word(rng) for _ in range(rng.randint(1, 5))),
+            'authors': authors,
+            'publisher': rng.choices(self.publishers,
+                                     cum_weights=self._publisher_weights)[0],
+            'publish_date': str(rng.randint(1900, 2020)),
+            'identifiers': {
+                'lccn': None,
+                'isbn_13': isbn_13,
+                'isbn_10': isbn13_to_isbn10(isbn_13),
+                'oclc': None,
+                'issn': None
+            },
+            'pages': rng.randint(40, 900)
+        }
+
+    def book(self, index: int) -> book:
+        metadata = self.record(index)
+        return book(metadata['title'], metadata['authors'],
+                    metadata['publisher'], metadata['publish_date'],
+                    metadata['identifiers'], metadata['pages'])
+
+    def books(self, start: int = 0, stop: int = None) -> Iterator[book]:
+        '''
+        Yield the books with indexes from start up to stop (the end of the
+        catalog if None).
+        '''
+        stop = self.size if stop is None else min(stop, self.size)
+        for index in range(start, stop):
+            yield self.book(index)
+
+    def sample_isbns(self, count: int, miss_rate: float = 0.0,
+                     seed: int = 1) -> list:
+        '''
+        Return count ISBNs of random books of the catalog, with about
+        miss_rate of them belonging to books that are not in it.
+        '''
+        rng = random.Random(seed)
+        return [self.isbn(self.size + index if rng.random() < miss_rate
+                          else rng.randrange(self.size))
+                for index in range(count)]
+
+    def search_queries(self, count: int, seed: int = 2) -> list:
+        '''
+        Return count search queries the way people type them: author
+        surnames, title words and abbreviated words.
+        '''
+        rng = random.Random(seed)
+        queries = []
+        for _ in range(count):
+            kind = rng.random()
+            if kind < 0.4:
+                author = rng.choices(self.authors,
+                                     cum_weights=self._author_weights)[0]
+                queries.append(author.split()[-1])
+            elif kind < 0.8:
+                title = self.record(rng.randrange(self.size))['title']
+                queries.append(' '.join(title.split()[:2]))
+            else:
+                queries.append(_word(rng)[:3])
+        return queries
+
@@ -0,0 +1,223 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+A local stand-in for the online book databases.
+
+provider_stand_in serves the books of a synthetic_catalog over HTTP in the
+shape of the Open Library book lookup API and the Google Books volumes API.
+Every response is delayed by about the configured latency, and a share of
+the requests fail with 503 so that the retries of provider_http are part of
+what is measured. Google Books answers with a slightly different publisher
+or page count for some books, so that the merge policies have conflicts to
+settle.
+
+While the stand-in is running, the provider modules are pointed at it and
+the rate limits of provider_limits are off, since the stand-in never
+throttles:
+
+    with provider_stand_in(catalog, latency=0.05, error_rate=0.01):
+        lookup_data.lookup_data("isbn", catalog.isbn(42))
+'''
+
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import googlebooks
+import openlibrary
+import provider_limits
+logger = logging.getLogger(__name__)
+
+OPENLIBRARY_PATH = '/openlibrary/api/books'
+GOOGLEBOOKS_PATH = '/googlebooks/books/v1/volumes'
+
+
+class provider_stand_in:
+    '''
+    An HTTP server on localhost answering for the books of catalog.
+
+    latency is the mean delay of a response in seconds; the actual delays
+    are spread evenly between half and one and a half times of it.
+    error_rate is the share of requests answered with 503, and
+    disagreement_rate the share of books for which Google Books does not
+    agree with Open Library.
+    '''
+
+    def __init__(self, catalog, latency: float = 0.0, error_rate: float = 0.0,
+                 disagreement_rate: float = 0.2, seed: int = 0):
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.disagreement_rate = disagreement_rate
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self._server = None
+        self._thread = None
+        self._saved_urls = None
+        self._saved_rate_limits = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        '''
+        Start serving in a background thread, point the provider modules at
+        the stand-in and turn the rate limits off.
+        '''
+        # Each stand-in gets a handler class that knows it.
+        handler = type('handler', (_stand_in_handler,), {'stand_in': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="toshokan-stand-in", daemon=True)
+        self._thread.start()
+        self._saved_urls = (openlibrary.OPENLIBRARY_API_URL,
+                            googlebooks.GOOGLEBOOKS_API_URL)
+        openlibrary.OPENLIBRARY_API_URL = self.url + OPENLIBRARY_PATH
+        googlebooks.GOOGLEBOOKS_API_URL = self.url + GOOGLEBOOKS_PATH
+        self._saved_rate_limits = provider_limits.rate_limits_enabled()
+        provider_limits.configure_rate_limits(enabled=False)
+        logger.info(f"Provider stand-in listening on {self.url}.")
+
+    def stop(self) -> None:
+        '''
+        Stop the server and point the provider modules back at the real
+        online databases.
+        '''
+        if self._server is None:
+            return
+        openlibrary.OPENLIBRARY_API_URL, googlebooks.GOOGLEBOOKS_API_URL = \
+            self._saved_urls
+        provider_limits.configure_rate_limits(
+            enabled=self._saved_rate_limits)
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+    def _draw(self) -> tuple:
+        '''
+        Return the delay of the next response and whether it fails.
+        '''
+        with self._rng_lock:
+            self.requests += 1
+            delay = self.latency * self._rng.uniform(0.5, 1.5)
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return delay, failed
+
+    def openlibrary_response(self, bibkeys: list) -> dict:
+        response = {}
+        for bibkey in bibkeys:
+            idtype, _, isbn = bibkey.partition(':')
+            index = self.catalog.index_of(isbn) \
+                if idtype.upper() == 'ISBN' else None
+            if index is None:
+                continue
+            record = self.catalog.record(index)
+            identifiers = record['identifiers']
+            response[bibkey] = {
+                'title': record['title'],
+                'authors': [{'name': name} for name in record['authors']],
+                'publishers': [{'name': record['publisher']}],
+                'publish_date': record['publish_date'],
+                'number_of_pages': record['pages'],
+                'identifiers': {id_type: [identifier] for id_type, identifier
+                                in identifiers.items() if identifier}
+            }
+        return response
+
+    def googlebooks_response(self, query: str) -> dict:
+        idtype, _, isbn = query.partition(':')
+        index = self.catalog.index_of(isbn) if idtype == 'isbn' else None
+        if index is None:
+            return {'kind': 'books#volumes', 'totalItems': 0}
+        record = self.catalog.record(index)
+        # Decided by the book, so that every run sees the same conflicts.
+        if random.Random(index).random() < self.disagreement_rate:
+            record['publisher'] += ', Inc.'
+            record['pages'] += 24
+        identifiers = record['identifiers']
+        return {
+            'kind': 'books#volumes',
+            'totalItems': 1,
+            'items': [{'volumeInfo': {
+                'title': record['title'],
+                'authors': record['authors'],
+                'publisher': record['publisher'],
+                'publishedDate': record['publish_date'],
+                'pageCount': record['pages'],
+                'industryIdentifiers': [
+                    {'type': 'ISBN_13', 'identifier': identifiers['isbn_13']},
+                    {'type': 'ISBN_10', 'identifier': identifiers['isbn_10']}
+                ]
+            }}]
+        }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class _stand_in_handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real APIs, so that the session of provider_http
+    # reuses its connections.
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately; with Nagle's
+    # algorithm the body would wait for the client's delayed ACK.
+    disable_nagle_algorithm = True
+    stand_in = None
+
+    def do_GET(self):
+        delay, failed = self.stand_in._draw()
+        if delay:
+            time.sleep(delay)
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if failed:
+            self._send(503, {'error': 'Service Unavailable'})
+        elif url.path == OPENLIBRARY_PATH:
+            bibkeys = ','.join(query.get('bibkeys', [])).split(',')
+            self._send(200, self.stand_in.openlibrary_response(bibkeys))
+        elif url.path == GOOGLEBOOKS_PATH:
+            self._send(200, self.stand_in.googlebooks_response(
+                query.get('q', [''])[0]))
+        else:
+            self._send(404, {'error': 'Not Found'})
+
+    def _send(self, status: int, body: dict) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # The default handler writes every request to stderr.
+        pass
@@ -0,0 +1,313 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+The benchmarks and their results.
+
+run_benchmarks() builds a synthetic catalog in a fresh database and measures:
+
+    add_record  -- tosho_sqlite.add_record_to_database(), one book at a time.
+    add_records -- the batch writer, tosho_database.add_records(). The
+                   database it builds is used by the benchmarks below.
+    lookup      -- lookup_data.query_providers() and merge_results(), one ISBN
+                   after the other, against the provider stand-in.
+    bulk_lookup -- bulk_lookup.bulk_lookup() against the provider stand-in.
+    search      -- tosho_search.search().
+    export      -- tosho_export.export_books() as JSON Lines and CSV.
+
+The results are a dictionary that is saved as JSON. Rates are in "..._per_
+second" keys and latencies in "..._ms" keys; compare_results() uses that to
+tell whether a change is an improvement or a regression.
+'''
+
+import datetime
+import logging
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+import bulk_lookup
+import lookup_data
+import tosho_export
+import tosho_search
+import tosho_sqlite
+from book import BookBatch
+from tosho_database import tosho_database
+from .catalog import synthetic_catalog
+from .stand_in import provider_stand_in
+logger = logging.getLogger(__name__)
+
+BENCHMARKS = ('add_record', 'add_records', 'lookup', 'bulk_lookup', 'search',
+              'export')
+# The format of the saved results; bump it when their meaning changes.
+RESULTS_VERSION = 1
+# add_record_to_database() commits every row, so it is timed on at most this
+# many books.
+ADD_RECORD_LIMIT = 2000
+# The batch writer is fed batches of this many books, generated beforehand
+# so that making up the books is not part of the time.
+ADD_RECORDS_CHUNK = 10000
+# The share of looked up ISBNs that no provider knows.
+LOOKUP_MISS_RATE = 0.05
+
+
+def _latency_summary(latencies: list) -> dict:
+    '''
+    Return the mean and percentiles of latencies (in seconds) in
+    milliseconds.
+    '''
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+
+    def percentile(share):
+        return ordered[min(len(ordered) - 1, int(share * len(ordered)))] * 1e3
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) * 1e3,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': ordered[-1] * 1e3
+    }
+
+
+def bench_add_record(catalog: synthetic_catalog, work_dir: str) -> dict:
+    db_conn = tosho_sqlite.connect_to_database(work_dir, 'add_record.db')
+    db_cursor = db_conn.cursor()
+    books = list(catalog.books(0, ADD_RECORD_LIMIT))
+    try:
+        started = time.perf_counter()
+        for relevant_book in books:
+            tosho_sqlite.add_record_to_database(db_cursor, relevant_book)
+        elapsed = time.perf_counter() - started
+    finally:
+        db_conn.close()
+    return {'books': len(books), 'seconds': elapsed,
+            'books_per_second': len(books) / elapsed}
+
+
+def bench_add_records(catalog: synthetic_catalog, work_dir: str,
+                      db_name: str) -> dict:
+    elapsed = 0.0
+    with tosho_database(work_dir, db_name, profile='bulk-import') as database:
+        for start in range(0, catalog.size, ADD_RECORDS_CHUNK):
+            batch = BookBatch(catalog.books(start, start + ADD_RECORDS_CHUNK))
+            started = time.perf_counter()
+            database.add_records(batch)
+            elapsed += time.perf_counter() - started
+        cache_hits = database.author_ids.hits + database.publisher_ids.hits
+        cache_misses = database.author_ids.misses + \
+            database.publisher_ids.misses
+    return {'books': catalog.size, 'seconds': elapsed,
+            'books_per_second': catalog.size / elapsed,
+            'name_cache_hit_rate':
+                cache_hits / (cache_hits + cache_misses)
+                if cache_hits + cache_misses else 0.0}
+
+
+def bench_lookup(catalog: synthetic_catalog, stand_in: provider_stand_in,
+                 count: int) -> dict:
+    isbns = catalog.sample_isbns(count, LOOKUP_MISS_RATE)
+    requests_before, errors_before = stand_in.requests, stand_in.errors
+    latencies = []
+    found = 0
+    conflicts = 0
+    started = time.perf_counter()
+    for isbn in isbns:
+        lookup_started = time.perf_counter()
+        provider_results = lookup_data.query_providers('isbn', isbn)
+        metadata, merge_conflicts = \
+            lookup_data.merge_results(provider_results)
+        latencies.append(time.perf_counter() - lookup_started)
+        found += bool(metadata)
+        conflicts += len(merge_conflicts)
+    elapsed = time.perf_counter() - started
+    return {'lookups': len(isbns), 'found': found, 'conflicts': conflicts,
+            'requests': stand_in.requests - requests_before,
+            'errors': stand_in.errors - errors_before,
+            'seconds': elapsed, 'lookups_per_second': len(isbns) / elapsed,
+            'latency': _latency_summary(latencies)}
+
+
+def bench_bulk_lookup(catalog: synthetic_catalog, stand_in: provider_stand_in,
+                      count: int, work_dir: str) -> dict:
+    isbns = catalog.sample_isbns(count, LOOKUP_MISS_RATE, seed=3)
+    requests_before, errors_before = stand_in.requests, stand_in.errors
+    summary = bulk_lookup.bulk_lookup(isbns, work_dir, 'bulk_lookup.db',
+                                      report_interval=3600)
+    return {'lookups': summary['looked_up'], 'written': summary['written'],
+            'conflicts': summary['conflicts'],
+            'requests': stand_in.requests - requests_before,
+            'errors': stand_in.errors - errors_before,
+            'seconds': summary['elapsed'],
+            'lookups_per_second': summary['lookups_per_second']}
+
+
+def bench_search(catalog: synthetic_catalog, work_dir: str, db_name: str,
+                 count: int) -> dict:
+    queries = catalog.search_queries(count)
+    db_conn = tosho_sqlite.connect_to_database(work_dir, db_name,
+                                               'read-only-replica')
+    db_cursor = db_conn.cursor()
+    latencies = []
+    results = 0
+    try:
+        started = time.perf_counter()
+        for query in queries:
+            query_started = time.perf_counter()
+            results += len(tosho_search.search(db_cursor, query))
+            latencies.append(time.perf_counter() - query_started)
+        elapsed = time.perf_counter() - started
+    finally:
+        db_conn.close()
+    return {'queries': len(queries), 'mean_results': results / len(queries),
+            'seconds': elapsed, 'queries_per_second': len(queries) / elapsed,
+            'latency': _latency_summary(latencies)}
+
+
+def bench_export(work_dir: str, db_name: str) -> dict:
+    result = {}
+    db_conn = tosho_sqlite.connect_to_database(work_dir, db_name,
+                                               'read-only-replica')
+    try:
+        for export_format in tosho_export.EXPORT_FORMATS:
+            with open(os.devnull, 'w', encoding='utf-8', newline='') \
+                    as output:
+                started = time.perf_counter()
+                book_count = tosho_export.export_books(db_conn.cursor(),
+                                                       output, export_format)
+                elapsed = time.perf_counter() - started
+            result[export_format] = {
+                'books': book_count, 'seconds': elapsed,
+                'books_per_second': book_count / elapsed if elapsed else 0.0}
+    finally:
+        db_conn.close()
+    return result
+
+
+def run_benchmarks(size: int, seed: int = 0, latency: float = 0.05,
+                   error_rate: float = 0.01, lookups: int = 200,
+                   searches: int = 1000, only: tuple = BENCHMARKS,
+                   work_dir: str = None) -> dict:
+    '''
+    Run the benchmarks in only on a synthetic catalog of size books and
+    return the results. The provider stand-in answers after about latency
+    seconds and fails error_rate of the requests. The databases are made in
+    work_dir, which is created if need be, or in a temporary directory that
+    is removed afterwards.
+    '''
+    unknown = set(only) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Unknown benchmarks: {', '.join(sorted(unknown))}.")
+    catalog = synthetic_catalog(size, seed)
+    results = {
+        'version': RESULTS_VERSION,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'parameters': {'size': size, 'seed': seed, 'latency': latency,
+                       'error_rate': error_rate, 'lookups': lookups,
+                       'searches': searches},
+        'benchmarks': {}
+    }
+    benchmarks = results['benchmarks']
+    with tempfile.TemporaryDirectory(prefix='toshokan-bench-') as temp_dir:
+        work_dir = os.path.join(work_dir or temp_dir, '')
+        os.makedirs(work_dir, exist_ok=True)
+        db_name = f'catalog-{size}-{seed}.db'
+        if 'add_record' in only:
+            logger.info("Benchmarking add_record_to_database().")
+            benchmarks['add_record'] = bench_add_record(catalog, work_dir)
+        if {'add_records', 'search', 'export'} & set(only):
+            # Search and export need the catalog in a database anyway.
+            logger.info(f"Adding {size} books to {work_dir}{db_name}.")
+            benchmarks['add_records'] = bench_add_records(catalog, work_dir,
+                                                          db_name)
+        if {'lookup', 'bulk_lookup'} & set(only):
+            with provider_stand_in(catalog, latency, error_rate, seed=seed) \
+                    as stand_in:
+                if 'lookup' in only:
+                    logger.info(f"Looking up {lookups} ISBNs.")
+                    benchmarks['lookup'] = bench_lookup(catalog, stand_in,
+                                                        lookups)
+                if 'bulk_lookup' in only:
+                    logger.info(f"Bulk looking up {lookups} ISBNs.")
+                    benchmarks['bulk_lookup'] = \
+                        bench_bulk_lookup(catalog, stand_in, lookups,
+                                          work_dir)
+        if 'search' in only:
+            logger.info(f"Running {searches} searches.")
+            benchmarks['search'] = bench_search(catalog, work_dir, db_name,
+                                                searches)
+        if 'export' in only:
+            logger.info("Exporting the catalog.")
+            benchmarks['export'] = bench_export(work_dir, db_name)
+    return results
+
+
+def _git_commit() -> str:
+    '''
+    Return the commit the benchmarks were run on, or None if that cannot be
+    found out.
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _flatten(values: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare_results(old: dict, new: dict, threshold: float = 0.1) -> list:
+    '''
+    Compare the rates and latencies of two sets of results. Return a list of
+    (metric, old value, new value, relative change, verdict) tuples, where
+    verdict is "better", "worse" or "same". Changes smaller than threshold
+    are the same.
+    '''
+    old_metrics = _flatten(old['benchmarks'])
+    new_metrics = _flatten(new['benchmarks'])
+    comparison = []
+    for metric, new_value in new_metrics.items():
+        old_value = old_metrics.get(metric)
+        higher_is_better = metric.endswith('_per_second')
+        if not old_value or not (higher_is_better or metric.endswith('_ms')):
+            continue
+        change = (new_value - old_value) / old_value
+        if abs(change) < threshold:
+            verdict = 'same'
+        elif (change > 0) == higher_is_better:
+            verdict = 'better'
+        else:
+            verdict = 'worse'
+        comparison.append((metric, old_value, new_value, change, verdict))
+    return comparison
@@ -14,6 +14,58 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import sys
+from array import array
+from collections.abc import Mapping
+from typing import Iterable, Iterator
+
+# The identifier types a book can have, in the order they are stored.
+IDENTIFIER_TYPES = ('lccn', 'isbn_13', 'isbn_10', 'oclc', 'issn')
+
+
+class book_identifiers(Mapping):
+    '''
+    The identifiers of a book. It behaves like the dictionary
+    {'lccn': ..., 'isbn_13': ..., 'isbn_10': ..., 'oclc': ..., 'issn': ...}
+    that books used to carry, but keeps the values in fixed slots instead of
+    a hash table of its own. Every identifier type is always present, with
+    None for an unknown identifier, and no other keys can be added.
+    '''
+
+    __slots__ = IDENTIFIER_TYPES
+
+    def __init__(self, identifiers=None):
+        for id_type in IDENTIFIER_TYPES:
+            setattr(self, id_type, None)
+        if identifiers is not None:
+            self.update(identifiers)
+
+    def __getitem__(self, id_type: str):
+        if id_type not in IDENTIFIER_TYPES:
+            raise KeyError(id_type)
+        return getattr(self, id_type)
+
+    def __setitem__(self, id_type: str, identifier) -> None:
+        if id_type not in IDENTIFIER_TYPES:
+            raise KeyError(f"Unknown identifier type {id_type!r}.")
+        setattr(self, id_type, identifier)
+
+    def update(self, identifiers) -> None:
+        for id_type, identifier in dict(identifiers).items():
+            self[id_type] = identifier
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(IDENTIFIER_TYPES)
+
+    def __len__(self) -> int:
+        return len(IDENTIFIER_TYPES)
+
+    def copy(self) -> dict:
+        return dict(self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
 
 class book:
     '''
@@ -34,37 +86,44 @@ class book:
         * Pages: int, the number of pages in the book
         * Publisher: list, the list of publishers who published this edition
         * Date of Publishing: the date this edition was published
+        * Volume count: int, the number of copies of this book in the
+          database (0 for a book not extracted from db)
+        * Libraries: list, the names of the libraries holding those copies
+
+    Books use __slots__ and keep their identifiers in a book_identifiers, so
+    that an import can hold hundreds of thousands of them in memory. For
+    even larger batches, see BookBatch.
     '''
 
+    __slots__ = ('identifiers', '_book_id', 'title', 'authors', 'pages',
+                 'publisher', 'publish_date', 'volume_count', 'libraries')
+
     def __init__(self,
                  title: str = "UNKNOWN",
-                 authors: list = ["UNKNOWN"],
+                 authors: list = None,  # None represents ["UNKNOWN"]
                  publisher: str = "UNKNOWN",
                  publish_date: str = "UNKNOWN",
-                 identifiers: dict = {
-                     'lccn': None,
-                     'isbn_13': None,
-                     'isbn_10': None,
-                     'oclc': None,
-                     'issn': None  # Magazines use this.
-                 },
+                 identifiers: dict = None,  # None represents no identifiers
                  pages: int = 0,  # 0 represents unknown
-                 book_id: int = 0):  # 0 represents book not extracted from db
+                 book_id: int = 0,  # 0 represents book not extracted from db
+                 volume_count: int = 0,
+                 libraries: list = None):
         '''
         __init__() is used to create a book which contains the relevant
         information about it.
         '''
-        # Let's add each id_type to the list of identifiers
-        self.identifiers = {}
-        for identifier in identifiers:
-            self.identifiers[identifier] = identifiers[identifier]
+        # ISSN is among the identifiers as well; magazines use it.
+        self.identifiers = book_identifiers(identifiers)
         self._book_id = book_id
         self.title = title
-        self.authors = []
-        self.authors.extend(authors)
+        self.authors = ["UNKNOWN"] if authors is None else list(authors)
         self.pages = pages
-        self.publisher = publisher
+        # Most books of an import share a handful of publishers.
+        self.publisher = sys.intern(publisher) \
+            if type(publisher) is str else publisher
         self.publish_date = publish_date
+        self.volume_count = volume_count
+        self.libraries = [] if libraries is None else list(libraries)
 
     @property  # make this read-only; the database will assign an ID
     def book_id(self):
@@ -77,10 +136,143 @@ class book:
             'authors': self.authors,
             'publisher': self.publisher,
             'publish_date': self.publish_date,
-            'identifiers': self.identifiers,
-            'pages': self.pages
+            'identifiers': dict(self.identifiers),
+            'pages': self.pages,
+            'volume_count': self.volume_count,
+            'libraries': self.libraries
             })
 
+
+class BookBatch:
+    '''
+    A batch of books stored column by column instead of as book objects.
+
+    Every column is a list or array with one entry per book. The ISBN-13s,
+    page counts and BookIDs, which are all integers, are kept in int64
+    arrays at 8 bytes a book, with 0 standing for an unknown value. An
+    ISBN-13 that is not 13 digits is stored as 0 too, and kept as it was
+    given in isbn_13_texts, by index, so that it is written unchanged like
+    any other malformed identifier. Publisher names are interned, so a batch
+    holds one copy of each. The other columns are plain lists.
+
+    tosho_sqlite.add_records_to_database() reads the columns directly, so a
+    BookBatch can be written without creating a book per row. Indexing or
+    iterating over a batch gives book objects, for code that needs them.
+    '''
+
+    __slots__ = ('titles', 'authors', 'publishers', 'publish_dates',
+                 'isbn_13s', 'isbn_13_texts', 'identifiers', 'pages',
+                 'book_ids')
+
+    def __init__(self, books: Iterable[book] = ()):
+        self.titles = []
+        self.authors = []  # A tuple of names per book
+        self.publishers = []
+        self.publish_dates = []
+        self.isbn_13s = array('q')
+        self.isbn_13_texts = {}
+        # The other identifier types, one list each.
+        self.identifiers = {id_type: [] for id_type in IDENTIFIER_TYPES
+                            if id_type != 'isbn_13'}
+        self.pages = array('q')
+        self.book_ids = array('q')
+        self.extend(books)
+
+    def append(self, relevant_book: book) -> None:
+        '''
+        Add a book to the end of the batch.
+        '''
+        self.titles.append(relevant_book.title)
+        self.authors.append(tuple(relevant_book.authors))
+        publisher = relevant_book.publisher
+        self.publishers.append(sys.intern(publisher)
+                               if type(publisher) is str else publisher)
+        self.publish_dates.append(relevant_book.publish_date)
+        identifiers = relevant_book.identifiers
+        isbn_13 = _isbn_13_to_int(identifiers['isbn_13'])
+        if isbn_13 is None:
+            self.isbn_13_texts[len(self.isbn_13s)] = identifiers['isbn_13']
+            isbn_13 = 0
+        self.isbn_13s.append(isbn_13)
+        for id_type, column in self.identifiers.items():
+            column.append(identifiers[id_type])
+        self.pages.append(int(relevant_book.pages or 0))
+        self.book_ids.append(relevant_book.book_id or 0)
+
+    def extend(self, books: Iterable[book]) -> None:
+        for relevant_book in books:
+            self.append(relevant_book)
+
+    def identifier_column(self, id_type: str) -> list:
+        '''
+        Return the identifiers of type id_type of every book in the batch,
+        with None for an unknown identifier.
+        '''
+        if id_type == 'isbn_13':
+            return [isbn_13 or self.isbn_13_texts.get(index)
+                    for index, isbn_13 in enumerate(self.isbn_13s)]
+        return self.identifiers[id_type]
+
+    def slice(self, start: int, stop: int) -> 'BookBatch':
+        '''
+        Return a new batch with the books from start up to stop.
+        '''
+        batch = BookBatch()
+        batch.titles = self.titles[start:stop]
+        batch.authors = self.authors[start:stop]
+        batch.publishers = self.publishers[start:stop]
+        batch.publish_dates = self.publish_dates[start:stop]
+        batch.isbn_13s = self.isbn_13s[start:stop]
+        batch.isbn_13_texts = {index - start: isbn_13
+                               for index, isbn_13 in self.isbn_13_texts.items()
+                               if start <= index < stop}
+        batch.identifiers = {id_type: column[start:stop]
+                             for id_type, column in self.identifiers.items()}
+        batch.pages = self.pages[start:stop]
+        batch.book_ids = self.book_ids[start:stop]
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def __getitem__(self, index: int) -> book:
+        if index < 0:
+            index += len(self)
+        identifiers = {id_type: column[index]
+                       for id_type, column in self.identifiers.items()}
+        identifiers['isbn_13'] = self.isbn_13s[index] or \
+            self.isbn_13_texts.get(index)
+        return book(self.titles[index],
+                    self.authors[index],
+                    self.publishers[index],
+                    self.publish_dates[index],
+                    identifiers,
+                    self.pages[index],
+                    self.book_ids[index])
+
+    def __iter__(self) -> Iterator[book]:
+        for index in range(len(self)):
+            yield self[index]
+
+
+def _isbn_13_to_int(isbn_13) -> int:
+    '''
+    Return isbn_13 as an integer, 0 if it is None, or None if it is not 13
+    digits long. Providers return ISBNs as strings, sometimes with hyphens in
+    them.
+    '''
+    if isbn_13 is None:
+        return 0
+    if isinstance(isbn_13, int):
+        return isbn_13
+    digits = str(isbn_13).strip().replace('-', '')
+    # Anything else, such as an ISBN-10 with a leading 0, would not come
+    # back the same from an integer.
+    if len(digits) != 13 or not digits.isdigit() or digits[0] == '0':
+        return None
+    return int(digits)
+
+
 if __name__ == '__main__':
     import lookup_data as ld
     #relevant_metadata = ld.lookup_data('isbn', 9780980200447)
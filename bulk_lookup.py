@@ -0,0 +1,351 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Look up a stream of ISBNs and store the results in the database.
+
+The ISBNs go through an asyncio pipeline:
+
+    feeder -> lookup queue -> fetch workers -> write queue -> writer
+
+The feeder validates the ISBNs in chunks of FEED_CHUNK_SIZE and looks up
+every distinct book of a chunk once, however many copies of it are in the
+input (an ISBN-10 and its ISBN-13 are the same book). Books the catalog
+already has are never looked up again: the feeder finds them with one query
+per chunk and hands them straight to the writer, which only adds the new
+copies as volumes. A fixed number of
+fetch workers query the providers and merge their results, and a single
+writer stores the books in batches with tosho_database.add_records().
+Disagreements between the providers are settled by a merge_policy without
+asking anybody; the writer stores them in the review queue MergeConflicts
+together with the batch of their book. Both queues are bounded, so when the
+writer falls behind the fetch workers wait for it instead of piling up books
+in memory.
+'''
+
+import asyncio
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+import identifiers
+import lookup_data
+import tosho_metrics
+import tosho_query
+from tosho_database import tosho_database, DEFAULT_CACHE_SIZE
+from tosho_sqlite import add_merge_conflicts_to_table
+logger = logging.getLogger(__name__)
+
+# The number of ISBNs validated and deduplicated at a time.
+FEED_CHUNK_SIZE = 1000
+
+
+class bulk_lookup_stats:
+    '''
+    Counters describing the progress of a bulk lookup.
+    '''
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.read = 0  # ISBNs read from the input
+        self.invalid = 0  # ISBNs rejected before any lookup
+        self.duplicates = 0  # Further copies of an ISBN in the same chunk
+        self.in_catalog = 0  # ISBNs the catalog already had
+        self.looked_up = 0  # ISBNs for which every provider was queried
+        self.not_found = 0  # ISBNs that no provider knew
+        self.conflicts = 0  # Fields the providers disagreed on
+        self.written = 0  # Volumes stored in the database
+
+    def as_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            'read': self.read,
+            'invalid': self.invalid,
+            'duplicates': self.duplicates,
+            'in_catalog': self.in_catalog,
+            'looked_up': self.looked_up,
+            'not_found': self.not_found,
+            'conflicts': self.conflicts,
+            'written': self.written,
+            'elapsed': elapsed,
+            'lookups_per_second': self.looked_up / elapsed if elapsed else 0.0,
+            'writes_per_second': self.written / elapsed if elapsed else 0.0
+        }
+
+
+def bulk_lookup(isbns: Iterable[str], db_path: str, db_name: str,
+                library_id: int = 1, concurrency: int = 8,
+                queue_size: int = 256, batch_size: int = 100,
+                deadline: float = lookup_data.LOOKUP_DEADLINE,
+                report_interval: float = 5.0,
+                profile: str = 'bulk-import', policy=None) -> dict:
+    '''
+    Look up every ISBN in isbns and add the books that were found to the
+    database at db_path + db_name. Return the final counters of the run as a
+    dictionary.
+
+    concurrency is the number of ISBNs being looked up at the same time,
+    queue_size the number of looked up books that may wait for the writer,
+    and batch_size the largest number of books written in one transaction
+    (all copies of a book are written in the same transaction).
+    The database is opened with the connection profile profile (see
+    tosho_sqlite.CONNECTION_PROFILES). The results of the providers are
+    merged with policy, a merge_policy.merge_policy (the default one if
+    None).
+    '''
+    return asyncio.run(run_bulk_lookup(isbns, db_path, db_name, library_id,
+                                       concurrency, queue_size, batch_size,
+                                       deadline, report_interval, profile,
+                                       policy))
+
+
+async def run_bulk_lookup(isbns: Iterable[str], db_path: str, db_name: str,
+                          library_id: int = 1, concurrency: int = 8,
+                          queue_size: int = 256, batch_size: int = 100,
+                          deadline: float = lookup_data.LOOKUP_DEADLINE,
+                          report_interval: float = 5.0,
+                          profile: str = 'bulk-import',
+                          policy=None) -> dict:
+    '''
+    The coroutine behind bulk_lookup(), for callers that already run an
+    event loop.
+    '''
+    if concurrency < 1 or queue_size < 1 or batch_size < 1:
+        raise ValueError("concurrency, queue_size and batch_size must be at "
+                         "least 1")
+    stats = bulk_lookup_stats()
+    lookup_queue = asyncio.Queue(maxsize=concurrency * 2)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+    # The providers block on the network, so every fetch worker needs one
+    # thread per provider. The writer gets a thread of its own because a
+    # sqlite3 connection may only be used by the thread that opened it.
+    fetch_pool = ThreadPoolExecutor(
+        max_workers=concurrency * len(lookup_data.PROVIDERS),
+        thread_name_prefix="toshokan-fetch")
+    write_pool = ThreadPoolExecutor(max_workers=1,
+                                    thread_name_prefix="toshokan-write")
+    loop = asyncio.get_running_loop()
+    try:
+        database = await loop.run_in_executor(write_pool, tosho_database,
+                                              db_path, db_name,
+                                              DEFAULT_CACHE_SIZE, profile)
+    except BaseException:
+        fetch_pool.shutdown(wait=False)
+        write_pool.shutdown(wait=True)
+        raise
+    reporter = asyncio.create_task(_report(stats, write_queue,
+                                           report_interval))
+    try:
+        fetchers = [asyncio.create_task(_fetch(lookup_queue, write_queue,
+                                               fetch_pool, deadline, policy,
+                                               stats))
+                    for _ in range(concurrency)]
+        writer = asyncio.create_task(_write(write_queue, write_pool,
+                                            database, library_id, batch_size,
+                                            stats))
+        producers = asyncio.gather(_feed(isbns, lookup_queue, write_queue,
+                                         database, fetch_pool, concurrency,
+                                         stats), *fetchers)
+        # Returns once the producers are done, or the writer stopped early.
+        await asyncio.wait([producers, writer],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if writer.done():
+            # The writer only stops before it is told to if it failed. Then
+            # nothing empties the write queue any more, and the fetchers
+            # would wait for room in it forever.
+            producers.cancel()
+            await asyncio.gather(producers, return_exceptions=True)
+            writer.result()
+        try:
+            await producers
+        except BaseException:
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+            raise
+        await write_queue.put(None)
+        await writer
+    finally:
+        reporter.cancel()
+        fetch_pool.shutdown(wait=False, cancel_futures=True)
+        await loop.run_in_executor(write_pool, database.close)
+        write_pool.shutdown(wait=True)
+    summary = stats.as_dict()
+    logger.info(f"Bulk lookup finished: {summary}")
+    return summary
+
+
+async def _feed(isbns: Iterable[str], lookup_queue: asyncio.Queue,
+                write_queue: asyncio.Queue, database: tosho_database,
+                read_pool: ThreadPoolExecutor, concurrency: int,
+                stats: bulk_lookup_stats) -> None:
+    loop = asyncio.get_running_loop()
+    isbns = iter(isbns)
+    while True:
+        chunk = list(itertools.islice(isbns, FEED_CHUNK_SIZE))
+        if not chunk:
+            break
+        stats.read += len(chunk)
+        copies, invalid = identifiers.dedupe_isbns(chunk)
+        for raw_isbn in invalid:
+            logger.warning(f"WARNING: {raw_isbn!r} is not a valid ISBN. "
+                           "Skipping!")
+        stats.invalid += len(invalid)
+        stats.duplicates += len(chunk) - len(invalid) - len(copies)
+        known_books = await loop.run_in_executor(read_pool, _find_in_catalog,
+                                                 database, list(copies))
+        stats.in_catalog += len(known_books)
+        for isbn, copy_count in copies.items():
+            if isbn in known_books:
+                # The writer matches it to the stored book by its
+                # identifiers and only adds the copies.
+                await write_queue.put((known_books[isbn], [], copy_count))
+            else:
+                await lookup_queue.put((isbn, copy_count))
+    for _ in range(concurrency):
+        await lookup_queue.put(None)
+
+
+def _find_in_catalog(database: tosho_database, isbns: list) -> dict:
+    '''
+    Return the books of the catalog with any of the ISBN-13s isbns, keyed by
+    ISBN.
+    '''
+    with database.reading() as db_cursor:
+        book_ids = tosho_query.find_isbn_book_ids(db_cursor, isbns)
+        known_books = tosho_query.get_books(db_cursor, book_ids.values())
+    known_books = {known_book.book_id: known_book
+                   for known_book in known_books}
+    return {isbn: known_books[book_id] for isbn, book_id in book_ids.items()
+            if book_id in known_books}
+
+
+async def _fetch(lookup_queue: asyncio.Queue, write_queue: asyncio.Queue,
+                 fetch_pool: ThreadPoolExecutor, deadline: float, policy,
+                 stats: bulk_lookup_stats) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await lookup_queue.get()
+        if item is None:
+            return
+        isbn, copy_count = item
+        provider_results = await _query_providers(loop, fetch_pool, isbn,
+                                                  deadline)
+        stats.looked_up += 1
+        # Merging never asks the user and is cheap enough to do right here.
+        metadata, conflicts = lookup_data.merge_results(provider_results,
+                                                        policy)
+        found_book = lookup_data.metadata_to_book(metadata)
+        if found_book.book_id < 0:
+            logger.warning(f"WARNING: ISBN {isbn} was not found by any "
+                           "provider.")
+            stats.not_found += 1
+            continue
+        for conflict in conflicts:
+            conflict['id_type'] = 'isbn'
+            conflict['identifier'] = isbn
+        stats.conflicts += len(conflicts)
+        # Blocks while the writer is behind; this is the backpressure.
+        await write_queue.put((found_book, conflicts, copy_count))
+
+
+async def _query_providers(loop: asyncio.AbstractEventLoop,
+                           fetch_pool: ThreadPoolExecutor, isbn: str,
+                           deadline: float) -> dict:
+    '''
+    The asyncio counterpart of lookup_data.query_providers().
+    '''
+    provider_results = {}
+    names = []
+    for name, provider in lookup_data.PROVIDERS.items():
+        if lookup_data.known_miss(name, 'isbn', isbn):
+            provider_results[name] = {}
+        elif not provider.allow():
+            provider_results[name] = {}
+            lookup_data.count_lookup(name, 'skipped')
+        else:
+            names.append(name)
+    if not names:
+        return provider_results
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='lookup'):
+        lookups = [asyncio.wrap_future(lookup_data.PROVIDERS[name].submit(
+                       fetch_pool, 'isbn', isbn, deadline), loop=loop)
+                   for name in names]
+        done, pending = await asyncio.wait(lookups, timeout=deadline)
+    for name, lookup in zip(names, lookups):
+        if lookup in pending:
+            lookup.cancel()
+            logger.warning(f"WARNING: {name} did not answer within "
+                           f"{deadline} seconds. Continuing without it.")
+            lookup_data.PROVIDERS[name].timed_out()
+            provider_results[name] = {}
+            lookup_data.count_lookup(name, 'timeout')
+        elif lookup.exception() is not None:
+            logger.warning(f"WARNING: The lookup on {name} failed: "
+                           f"{lookup.exception()!r}")
+            provider_results[name] = {}
+            lookup_data.count_lookup(name, 'failed')
+        else:
+            provider_results[name] = lookup.result()
+            lookup_data.count_lookup(name, 'found' if provider_results[name]
+                                     else 'not_found')
+    return provider_results
+
+
+async def _write(write_queue: asyncio.Queue, write_pool: ThreadPoolExecutor,
+                 database: tosho_database, library_id: int, batch_size: int,
+                 stats: bulk_lookup_stats) -> None:
+    loop = asyncio.get_running_loop()
+    finished = False
+    while not finished:
+        batch = [await write_queue.get()]
+        # Take whatever else is already waiting, up to batch_size.
+        while len(batch) < batch_size and not write_queue.empty():
+            batch.append(write_queue.get_nowait())
+        if batch[-1] is None:
+            batch.pop()
+            finished = True
+        if batch:
+            # Every copy of a book becomes a volume of its own.
+            books = [found_book
+                     for found_book, book_conflicts, copy_count in batch
+                     for _ in range(copy_count)]
+            conflicts = [conflict
+                         for found_book, book_conflicts, copy_count
+                         in batch for conflict in book_conflicts]
+
+            def add_conflicts(db_cursor, committed_batch,
+                              conflicts=conflicts):
+                add_merge_conflicts_to_table(db_cursor, conflicts)
+
+            # With the copies, books may be longer than batch_size. It is
+            # still written in one transaction, as add_conflicts writes
+            # the conflicts of all of them.
+            stats.written += await loop.run_in_executor(
+                write_pool, database.add_records, books, library_id,
+                len(books), add_conflicts if conflicts else None)
+
+
+async def _report(stats: bulk_lookup_stats, write_queue: asyncio.Queue,
+                  report_interval: float) -> None:
+    while True:
+        await asyncio.sleep(report_interval)
+        summary = stats.as_dict()
+        logger.info(f"{summary['looked_up']} looked up "
+                    f"({summary['lookups_per_second']:.1f}/s), "
+                    f"{summary['written']} written "
+                    f"({summary['writes_per_second']:.1f}/s), "
+                    f"{write_queue.qsize()} waiting for the writer.")
@@ -20,8 +20,17 @@
 # program to use this program in a commercial capacity.
 
 import logging
+import identifiers
+import provider_cache
+import provider_http
+import provider_registry
+import tosho_metrics
 logger = logging.getLogger(__name__)
 
+# The Google Books volumes API. The benchmarks point this at a local
+# stand-in.
+GOOGLEBOOKS_API_URL = 'https://www.googleapis.com/books/v1/volumes'
+
 
 def get_googlebooks_data(idtype: str, book_id: int) -> dict:
     """
@@ -41,11 +50,23 @@ def get_googlebooks_data(idtype: str, book_id: int) -> dict:
         metadata about the book
     """
     idtype = idtype.lower()
-    from requests import get
     from json import loads
-    googlebooks_request_result = get('https://www.googleapis.com/books/v1/'
-                                     f'volumes?q={idtype}:{book_id}')
-    googlebooks_data_json = loads(googlebooks_request_result.content)
+    cached_body = provider_cache.lookup('googlebooks', idtype, book_id)
+    if cached_body is not None:
+        return loads(cached_body)
+    googlebooks_request_result = \
+        provider_http.get(f'{GOOGLEBOOKS_API_URL}?q={idtype}:{book_id}',
+                          'googlebooks')
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='parse',
+                             provider='googlebooks'):
+        googlebooks_data_json = loads(googlebooks_request_result.content)
+    if googlebooks_data_json.get('totalItems', 0) > 0:
+        # Only books that were found are cached, so that a book added to
+        # Google Books later on is not hidden by an old empty result.
+        provider_cache.store('googlebooks', idtype, book_id,
+                             googlebooks_request_result.content)
+    else:
+        provider_cache.record_miss('googlebooks', idtype, book_id)
     return googlebooks_data_json
 
 
@@ -133,7 +154,7 @@ def process_googlebooks_data(googlebooks_data_json: dict) -> dict:
         logger.warning("WARNING: The publishing date is unknown.")
         relevant_metadata['publish_date'] = "UNKNOWN"
     try:
-        identifiers = {
+        book_identifiers = {
             'lccn': None,
             'isbn_13': None,  # WE ALREADY KNOW THAT LCCN and OCLC
             'isbn_10': None,  # ARE NOT PRESENT IN THE JSON DATA
@@ -141,7 +162,7 @@ def process_googlebooks_data(googlebooks_data_json: dict) -> dict:
             'issn': None
         }
         # A static version to check if the results were actually empty
-        noidentifiers = identifiers.copy()
+        noidentifiers = book_identifiers.copy()
         logger.info("INFO: A Google JSON result does not contain LCCN or OCLC "
                     "data. Consequently those identifiers will remain "
                     "unpopulated")
@@ -151,13 +172,13 @@ def process_googlebooks_data(googlebooks_data_json: dict) -> dict:
         # better to merge these with queries from other databases.
         for gidentifier in googlebooks_identifiers:
             if gidentifier['type'] == 'ISBN_13':
-                identifiers['isbn_13'] = gidentifier['identifier']
+                book_identifiers['isbn_13'] = gidentifier['identifier']
             elif gidentifier['type'] == 'ISBN_10':
-                identifiers['isbn_10'] = gidentifier['identifier']
+                book_identifiers['isbn_10'] = gidentifier['identifier']
             elif gidentifier['type'] == 'ISSN':
-                identifiers['issn'] = gidentifier['identifier']
+                book_identifiers['issn'] = gidentifier['identifier']
         # sanity check here
-        if identifiers == noidentifiers:
+        if book_identifiers == noidentifiers:
             logger.warning("WARNING: This book has no industry-standard "
                            "identifiers!")
     except KeyError:
@@ -167,7 +188,7 @@ def process_googlebooks_data(googlebooks_data_json: dict) -> dict:
         # twice.
         logger.warning("WARNING: This book has no industry-standard"
                        " identifiers!")
-    relevant_metadata['identifiers'] = identifiers
+    relevant_metadata['identifiers'] = book_identifiers
     try:
         relevant_metadata['pages'] = googlebooks_data['pageCount']
     except KeyError:
@@ -185,12 +206,24 @@ def googlebooks_results(idtype='isbn', book_id=0) -> dict:
     Then calls _process_googlebooks_data to convert it into the format usable
     by toshokan\'s database and returns it to the caller.
     """
-    # No need to check validity as google books does it for us.
+    # Google Books would tell us an ISBN is invalid too, but only after a
+    # request.
+    if idtype.lower() == 'isbn':
+        isbn = identifiers.canonical_isbn(book_id)
+        if isbn is None:
+            logger.warning(f"WARNING: {book_id!r} is not a valid ISBN.")
+            return {}
+        book_id = isbn
     gbooks_data = get_googlebooks_data(idtype, book_id)
-    gbooks_data_processed = process_googlebooks_data(gbooks_data)
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='process',
+                             provider='googlebooks'):
+        gbooks_data_processed = process_googlebooks_data(gbooks_data)
     return gbooks_data_processed
 
 
+provider_registry.register_provider('googlebooks', googlebooks_results)
+
+
 if __name__ == "__main__":  # NOTE:WIP
     import argparse
     parser = \
@@ -0,0 +1,227 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Validation, normalisation and conversion of book identifiers.
+
+An ISBN is normalised by removing spaces and hyphens and upper-casing the
+"X" check digit of an ISBN-10. It is valid if its check digit is right.
+ISBNs are kept as strings throughout: as integers, ISBN-10s starting with 0
+lose a digit and ISBN-10s ending in X cannot be stored at all.
+
+The functions working on whole batches (validate_isbns(), dedupe_isbns())
+verify the check digits of all the ISBNs at once with NumPy if it is
+installed, and with plain Python otherwise. Both give the same results.
+Only the check digits are vectorised: every ISBN is still normalised on its
+own in Python first.
+'''
+
+import logging
+from typing import Iterable
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Weights of the digits of an ISBN-13 and an ISBN-10 in their check sums.
+_ISBN13_WEIGHTS = (1, 3) * 6 + (1,)
+_ISBN10_WEIGHTS = tuple(range(10, 0, -1))
+# Only ISBN-13s with this prefix have an ISBN-10.
+ISBN10_PREFIX = '978'
+
+# Batches smaller than this are not worth handing to NumPy.
+VECTORIZE_THRESHOLD = 64
+
+
+def normalize_isbn(raw_isbn) -> str:
+    '''
+    Return raw_isbn without spaces and hyphens, or None if it does not have
+    the shape of an ISBN-10 or ISBN-13. The check digit is not verified.
+    '''
+    if raw_isbn is None:
+        return None
+    isbn = str(raw_isbn).strip().replace('-', '').replace(' ', '').upper()
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn
+    if len(isbn) == 10 and isbn[:9].isdigit() and \
+            (isbn[9].isdigit() or isbn[9] == 'X'):
+        return isbn
+    return None
+
+
+def _isbn13_check_digit(first_12: str) -> str:
+    total = sum(int(digit) * weight
+                for digit, weight in zip(first_12, _ISBN13_WEIGHTS))
+    return str(-total % 10)
+
+
+def _isbn10_check_digit(first_9: str) -> str:
+    total = sum(int(digit) * weight
+                for digit, weight in zip(first_9, _ISBN10_WEIGHTS))
+    check = -total % 11
+    return 'X' if check == 10 else str(check)
+
+
+def is_valid_isbn(raw_isbn) -> bool:
+    '''
+    Return True if raw_isbn is an ISBN-10 or ISBN-13 with a correct check
+    digit.
+    '''
+    isbn = normalize_isbn(raw_isbn)
+    if isbn is None:
+        return False
+    if len(isbn) == 13:
+        return isbn[12] == _isbn13_check_digit(isbn[:12])
+    return isbn[9] == _isbn10_check_digit(isbn[:9])
+
+
+def isbn10_to_isbn13(raw_isbn) -> str:
+    '''
+    Return the ISBN-13 of a valid ISBN-10, or None if it is not one.
+    '''
+    isbn = normalize_isbn(raw_isbn)
+    if isbn is None or len(isbn) != 10 or not is_valid_isbn(isbn):
+        return None
+    first_12 = ISBN10_PREFIX + isbn[:9]
+    return first_12 + _isbn13_check_digit(first_12)
+
+
+def isbn13_to_isbn10(raw_isbn) -> str:
+    '''
+    Return the ISBN-10 of a valid ISBN-13, or None if it is not one or
+    does not start with 978 (979 ISBNs have no ISBN-10).
+    '''
+    isbn = normalize_isbn(raw_isbn)
+    if isbn is None or len(isbn) != 13 or not is_valid_isbn(isbn) or \
+            not isbn.startswith(ISBN10_PREFIX):
+        return None
+    return isbn[3:12] + _isbn10_check_digit(isbn[3:12])
+
+
+def canonical_isbn(raw_isbn) -> str:
+    '''
+    Return the ISBN-13 of a valid ISBN-10 or ISBN-13, or None if raw_isbn
+    is not a valid ISBN. This is the form in which ISBNs are looked up and
+    compared.
+    '''
+    isbn = normalize_isbn(raw_isbn)
+    if isbn is None or not is_valid_isbn(isbn):
+        return None
+    return isbn if len(isbn) == 13 else isbn10_to_isbn13(isbn)
+
+
+def normalize_issn(raw_issn) -> str:
+    '''
+    Return raw_issn as eight characters without the hyphen, or None if it
+    does not have the shape of an ISSN.
+    '''
+    if raw_issn is None:
+        return None
+    issn = str(raw_issn).strip().replace('-', '').replace(' ', '').upper()
+    if len(issn) == 8 and issn[:7].isdigit() and \
+            (issn[7].isdigit() or issn[7] == 'X'):
+        return issn
+    return None
+
+
+def normalize_identifier(id_type: str, identifier):
+    '''
+    Return identifier of type id_type in the form it is stored in the
+    database: ISBNs and ISSNs as normalised strings (unchanged if they are
+    malformed), everything else as it is.
+    '''
+    if identifier is None:
+        return None
+    if id_type in ('isbn_10', 'isbn_13'):
+        return normalize_isbn(identifier) or str(identifier).strip()
+    if id_type == 'issn':
+        return normalize_issn(identifier) or str(identifier).strip()
+    return identifier
+
+
+def validate_isbns(raw_isbns: Iterable) -> list:
+    '''
+    Return canonical_isbn() of every item of raw_isbns, in the same order:
+    the ISBN-13 of each valid ISBN and None for each invalid one. The items
+    are normalised one by one; with NumPy, the check digits of batches of
+    at least VECTORIZE_THRESHOLD ISBNs are then verified all at once.
+    '''
+    isbns = [normalize_isbn(raw_isbn) for raw_isbn in raw_isbns]
+    if numpy is None or len(isbns) < VECTORIZE_THRESHOLD:
+        return [None if isbn is None or not is_valid_isbn(isbn)
+                else isbn if len(isbn) == 13 else isbn10_to_isbn13(isbn)
+                for isbn in isbns]
+    return _validate_isbns_numpy(isbns)
+
+
+def _validate_isbns_numpy(isbns: list) -> list:
+    result = [None] * len(isbns)
+    isbn13_positions = [i for i, isbn in enumerate(isbns)
+                        if isbn is not None and len(isbn) == 13]
+    isbn10_positions = [i for i, isbn in enumerate(isbns)
+                        if isbn is not None and len(isbn) == 10]
+    if isbn13_positions:
+        digits = _digit_matrix([isbns[i] for i in isbn13_positions], 13)
+        valid = (digits @ numpy.array(_ISBN13_WEIGHTS)) % 10 == 0
+        for i, is_valid in zip(isbn13_positions, valid.tolist()):
+            if is_valid:
+                result[i] = isbns[i]
+    if isbn10_positions:
+        digits = _digit_matrix([isbns[i] for i in isbn10_positions], 10)
+        valid = (digits @ numpy.array(_ISBN10_WEIGHTS)) % 11 == 0
+        # The ISBN-13: 978, the first nine digits and a new check digit.
+        prefix = numpy.array([int(digit) for digit in ISBN10_PREFIX])
+        first_12 = numpy.hstack([numpy.broadcast_to(prefix,
+                                                    (len(digits), 3)),
+                                 digits[:, :9]])
+        check = -(first_12 @ numpy.array(_ISBN13_WEIGHTS[:12])) % 10
+        for i, is_valid, check_digit in zip(isbn10_positions, valid.tolist(),
+                                            check.tolist()):
+            if is_valid:
+                result[i] = f"{ISBN10_PREFIX}{isbns[i][:9]}{check_digit}"
+    return result
+
+
+def _digit_matrix(isbns: list, length: int):
+    '''
+    Return the digits of isbns, all of the given length, as an integer
+    matrix with one row per ISBN. An "X" becomes 10.
+    '''
+    raw = numpy.frombuffer(''.join(isbns).encode('ascii'), dtype=numpy.uint8)
+    digits = raw.reshape(len(isbns), length).astype(numpy.int64) - ord('0')
+    digits[digits == ord('X') - ord('0')] = 10
+    return digits
+
+
+def dedupe_isbns(raw_isbns: Iterable) -> tuple:
+    '''
+    Validate a batch of ISBNs and merge the ones that are the same book,
+    such as an ISBN-10 and its ISBN-13. Return a dictionary mapping every
+    distinct ISBN-13 to the number of times it occurred, in the order they
+    were first seen, and the list of the items of raw_isbns that are not
+    valid ISBNs.
+    '''
+    raw_isbns = list(raw_isbns)
+    counts = {}
+    invalid = []
+    for raw_isbn, isbn in zip(raw_isbns, validate_isbns(raw_isbns)):
+        if isbn is None:
+            invalid.append(raw_isbn)
+        else:
+            counts[isbn] = counts.get(isbn, 0) + 1
+    return counts, invalid
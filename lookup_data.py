@@ -18,34 +18,144 @@
 # Functions will call API and attempt to return a standardised set of data
 # which will be the same across every program
 
-from openlibrary import openlibrary_results as olib
-from googlebooks import googlebooks_results as gbook
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+# The provider modules register themselves when they are imported.
+import googlebooks
+import openlibrary
 from book import book
+import identifiers
+from merge_policy import DEFAULT_POLICY
+import provider_cache
+from provider_registry import PROVIDERS
+import tosho_metrics
+import tosho_query
+from tosho_sqlite import add_copy_to_database, add_merge_conflicts_to_table
+logger = logging.getLogger(__name__)
 
-def lookup_data(idtype: str, bookid: int) -> book:
+# PROVIDERS is the registry of provider_registry. prh is not implemented
+# yet; it will register itself like the others once it is.
+
+# The number of seconds a lookup waits for the providers to answer.
+LOOKUP_DEADLINE = 10.0
+
+# Shared by all lookups so that we don't pay for starting threads every time.
+_provider_pool = ThreadPoolExecutor(max_workers=4 * len(PROVIDERS),
+                                    thread_name_prefix="toshokan-lookup")
+
+
+def lookup_data(idtype: str, bookid: int,
+                deadline: float = LOOKUP_DEADLINE,
+                interactive: bool = False) -> book:
     # NOTE: Function arguments as yet undecided
     '''
     Attempt to grab the relevant information from different databases.
     Currently only Open Library and Google Books are implemented.
     Compare the data and attempt to fill in the blanks for a more complete
     record. Return the data in a dictionary.
+
+    All providers are queried at the same time. Providers that have not
+    answered within deadline seconds are treated as not knowing the book.
+    Disagreements between the providers are settled by the default merge
+    policy, or by asking the user if interactive is True.
     '''
     # NOTE: Open Library uses uppercase idtypes, while Google Books uses
     # lowercase.
-    olib_metadata = olib(idtype, bookid)
-    gbook_metadata = gbook(idtype, bookid)
-    # prh_results = prh(idtype, bookid)
+    provider_results = query_providers(idtype, bookid, deadline)
+    if interactive:
+        return metadata_to_book(_merge_interactively(provider_results))
+    return build_book(provider_results)
+
+
+def add_to_catalog(database, idtype: str, bookid, library_id: int = 1,
+                   deadline: float = LOOKUP_DEADLINE,
+                   interactive: bool = False) -> tuple:
+    '''
+    Add a copy of the book with the given identifier to the library
+    library_id of database, a tosho_database.tosho_database. Return the
+    book and whether it was new to the catalog.
+
+    The catalog is asked first: a book it already has only gets another
+    volume, without any network I/O. Any other book is looked up as in
+    lookup_data() and added, together with the conflicts between the
+    providers (see tosho_sqlite.add_merge_conflicts_to_table()). A book that
+    no provider knows is not added and is returned with a book_id of -1.
+    '''
+    with database.writing() as db_cursor:
+        book_id = tosho_query.find_book_id(db_cursor, idtype, bookid)
+        if book_id is not None:
+            volume_id = add_copy_to_database(db_cursor, book_id, library_id)
+            logger.info(f"{idtype} {bookid} is already in the catalog. "
+                        f"Added volume {volume_id}.")
+            return tosho_query.get_book(db_cursor, book_id), False
+    provider_results = query_providers(idtype, bookid, deadline)
+    if interactive:
+        # The user settles the conflicts, so there are none to review.
+        metadata, conflicts = _merge_interactively(provider_results), []
+    else:
+        metadata, conflicts = merge_results(provider_results)
+    found_book = metadata_to_book(metadata)
+    if found_book.book_id < 0:
+        return found_book, False
+    for conflict in conflicts:
+        conflict['id_type'] = idtype
+        conflict['identifier'] = bookid
+
+    def add_conflicts(db_cursor, batch):
+        add_merge_conflicts_to_table(db_cursor, conflicts)
+
+    # Another writer may have added the book while it was looked up, so only
+    # the write can tell whether it is new.
+    new_book_ids = []
+    database.add_records([found_book], library_id,
+                         before_commit=add_conflicts if conflicts else None,
+                         new_book_ids=new_book_ids)
+    return found_book, bool(new_book_ids)
+
+
+def build_book(provider_results: dict, policy=None) -> book:
+    '''
+    Given the results of the providers as returned by query_providers(),
+    merge them into a single book with policy (a merge_policy, by default
+    merge_policy.DEFAULT_POLICY). The book has a book_id of -1 if none of
+    the providers found it. Use merge_results() to find out which fields
+    the providers disagreed on.
+    '''
+    final_result, conflicts = merge_results(provider_results, policy)
+    return metadata_to_book(final_result)
+
+
+def merge_results(provider_results: dict, policy=None) -> tuple:
+    '''
+    Merge the results of the providers with policy without asking anybody.
+    Return the merged metadata and the list of conflicts that were settled
+    by provider precedence (see merge_policy.merge_policy.merge()).
+    '''
+    if policy is None:
+        policy = DEFAULT_POLICY
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='merge'):
+        return policy.merge(provider_results)
+
+
+def _merge_interactively(provider_results: dict) -> dict:
+    olib_metadata = provider_results['openlibrary']
+    gbook_metadata = provider_results['googlebooks']
     if olib_metadata == gbook_metadata:
         # If they are equivalent do nothing
-        final_result = olib_metadata
+        return olib_metadata
     elif gbook_metadata == {}:
-        final_result = olib_metadata
+        return olib_metadata
     elif olib_metadata == {}:
-        final_result = gbook_metadata
-    else:
-        # If they are not equivalent, merge the data
-        print("Non-identical data found. Merging results:")
-        final_result = merge_data(gbook_metadata, olib_metadata)
+        return gbook_metadata
+    # If they are not equivalent, merge the data
+    print("Non-identical data found. Merging results:")
+    return merge_data(gbook_metadata, olib_metadata)
+
+
+def metadata_to_book(final_result: dict) -> book:
+    '''
+    Turn merged metadata into a book, with a book_id of -1 if it is empty.
+    '''
     if final_result == {}:
         final_book = book(book_id=-1)
     else:
@@ -58,6 +168,71 @@ def lookup_data(idtype: str, bookid: int) -> book:
     return final_book
 
 
+def query_providers(idtype: str, bookid: int,
+                    deadline: float = LOOKUP_DEADLINE) -> dict:
+    '''
+    Query every provider in PROVIDERS concurrently and return a dictionary
+    with the result of each provider, keyed by its name. Lookups that take
+    longer than usual are hedged (see provider_registry).
+
+    A provider that raises an error or misses the deadline gets an empty
+    dictionary as its result, just as if it had not found the book. So does
+    a provider that recently did not know the book, or whose circuit breaker
+    is open, without being asked.
+    '''
+    provider_results = {}
+    futures = {}
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='lookup'):
+        for name, provider in PROVIDERS.items():
+            if known_miss(name, idtype, bookid):
+                provider_results[name] = {}
+            elif not provider.allow():
+                provider_results[name] = {}
+                count_lookup(name, 'skipped')
+            else:
+                futures[name] = provider.submit(_provider_pool, idtype,
+                                                bookid, deadline)
+        wait(futures.values(), timeout=deadline)
+    for name, future in futures.items():
+        if not future.done():
+            # The worker thread cannot be interrupted, but nobody will wait
+            # for its result any more.
+            logger.warning(f"WARNING: {name} did not answer within "
+                           f"{deadline} seconds. Continuing without it.")
+            PROVIDERS[name].timed_out()
+            provider_results[name] = {}
+            count_lookup(name, 'timeout')
+        elif future.exception() is not None:
+            logger.warning(f"WARNING: The lookup on {name} failed: "
+                           f"{future.exception()!r}")
+            provider_results[name] = {}
+            count_lookup(name, 'failed')
+        else:
+            provider_results[name] = future.result()
+            count_lookup(name, 'found' if provider_results[name]
+                         else 'not_found')
+    return provider_results
+
+
+def known_miss(provider: str, idtype: str, bookid) -> bool:
+    '''
+    Return True if provider recently did not know the book. The providers
+    remember misses under the ISBN-13, so an ISBN is looked up as one.
+    '''
+    if idtype.lower() == 'isbn':
+        bookid = identifiers.canonical_isbn(bookid) or bookid
+    return provider_cache.known_miss(provider, idtype, bookid)
+
+
+def count_lookup(provider: str, result: str) -> None:
+    '''
+    Count a lookup on provider by how it ended: found, not_found, failed,
+    timeout or skipped.
+    '''
+    tosho_metrics.count('toshokan_provider_lookups_total', provider=provider,
+                        result=result)
+
+
 def merge_data(gbook_metadata: dict, olib_metadata: dict) -> dict:
     # TODO: prh_metadata:
     '''
@@ -110,7 +285,7 @@ def merge_data(gbook_metadata: dict, olib_metadata: dict) -> dict:
 def _merge_authors(olib_authors: list, gbook_authors: list) -> list:
     # set() will merge all author names except when there is a case mismatch,
     # which we will have to do manually
-    combined_authors = sorted(set(olib_authors, gbook_authors))
+    combined_authors = sorted(set(olib_authors) | set(gbook_authors))
     combined_authors_deduped = _check_duplicate_authors(combined_authors)
     return combined_authors_deduped
 
@@ -0,0 +1,244 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Merge the metadata of several providers without asking anybody.
+
+lookup_data.merge_data() asks the user whenever two providers disagree,
+which stops an unattended import at the first conflict. A merge_policy
+settles every field with a rule instead:
+
+    precedence -- take the value of the first provider in the field's
+                  precedence order that knows it.
+    longest    -- if one value contains the other ("Vertical" and
+                  "Vertical, Inc."), take the more complete one.
+    authors    -- take the union of the author lists, ignoring differences
+                  in case.
+    pages      -- page counts within the tolerance of each other are the
+                  same count.
+    identifiers -- fill in every identifier any provider knows.
+
+When a rule still cannot reconcile the values, it falls back to precedence
+and reports a conflict. bulk_lookup stores the conflicts in the table
+MergeConflicts, a review queue that can be worked through later.
+
+A rule is a function rule(values, policy) -> (value, conflicting), where
+values is a list of (provider, value) tuples in order of precedence with the
+unknown values left out. New rules can be added to MERGE_RULES.
+'''
+
+import logging
+from book import IDENTIFIER_TYPES
+logger = logging.getLogger(__name__)
+
+# The providers in the order they are trusted by default.
+DEFAULT_PRECEDENCE = ('openlibrary', 'googlebooks')
+
+# The rule used for each field; other fields use precedence.
+DEFAULT_FIELD_RULES = {
+    'title': 'longest',
+    'authors': 'authors',
+    'publisher': 'longest',
+    'publish_date': 'longest',
+    'pages': 'pages',
+    'identifiers': 'identifiers'
+}
+
+# Page counts that differ by at most PAGE_TOLERANCE of the larger one, or by
+# PAGE_SLACK pages, count as the same (one provider may count the plates or
+# the index, the other may not).
+PAGE_TOLERANCE = 0.1
+PAGE_SLACK = 5
+
+# The values providers use for "not known".
+_UNKNOWN_VALUES = ("UNKNOWN", "Untitled", "")
+
+
+def _is_unknown(value) -> bool:
+    if value is None or value == 0:
+        return True
+    if isinstance(value, str):
+        return value.strip() in _UNKNOWN_VALUES
+    if isinstance(value, (list, tuple)):
+        return all(_is_unknown(item) for item in value)
+    return False
+
+
+def _normalise(text) -> str:
+    return " ".join(str(text).split()).casefold()
+
+
+def _by_precedence(values: list, policy) -> tuple:
+    '''
+    Take the first value. The values conflict unless they are all equal.
+    '''
+    first = values[0][1]
+    return first, any(value != first for provider, value in values[1:])
+
+
+def _longest(values: list, policy) -> tuple:
+    '''
+    Take the most complete value if every other value is contained in it,
+    ignoring case and spacing.
+    '''
+    longest = max((value for provider, value in values),
+                  key=lambda value: len(_normalise(value)))
+    longest_normalised = _normalise(longest)
+    if all(_normalise(value) in longest_normalised
+           for provider, value in values):
+        return longest, False
+    return _by_precedence(values, policy)[0], True
+
+
+def _merge_author_lists(values: list, policy) -> tuple:
+    '''
+    Take the authors of the first provider followed by the authors only the
+    others know. The lists conflict if no list contains all the others.
+    '''
+    merged = []
+    seen = set()
+    for provider, authors in values:
+        for name in authors:
+            if _is_unknown(name) or _normalise(name) in seen:
+                continue
+            seen.add(_normalise(name))
+            merged.append(name)
+    conflicting = not any({_normalise(name) for name in authors} >= seen
+                          for provider, authors in values)
+    return merged, conflicting
+
+
+def _pages_within_tolerance(values: list, policy) -> tuple:
+    '''
+    Take the first page count if all of them are within the tolerance of the
+    policy.
+    '''
+    counts = [int(value) for provider, value in values]
+    spread = max(counts) - min(counts)
+    allowed = max(policy.page_slack, policy.page_tolerance * max(counts))
+    return counts[0], spread > allowed
+
+
+def _merge_identifiers(values: list, policy) -> tuple:
+    '''
+    Fill in each identifier from the first provider that knows it. Different
+    values of the same identifier conflict.
+    '''
+    merged = {}
+    conflicting = False
+    for id_type in IDENTIFIER_TYPES:
+        known = [identifiers.get(id_type) for provider, identifiers in values
+                 if not _is_unknown(identifiers.get(id_type))]
+        merged[id_type] = known[0] if known else None
+        compact = {str(identifier).replace('-', '').strip().upper()
+                   for identifier in known}
+        if len(compact) > 1:
+            conflicting = True
+    return merged, conflicting
+
+
+MERGE_RULES = {
+    'precedence': _by_precedence,
+    'longest': _longest,
+    'authors': _merge_author_lists,
+    'pages': _pages_within_tolerance,
+    'identifiers': _merge_identifiers
+}
+
+
+class merge_policy:
+    '''
+    The rules for merging the results of several providers.
+
+    precedence is the order in which the providers are trusted, and
+    field_precedence can give a different order for single fields.
+    field_rules maps fields to the names of rules in MERGE_RULES (or to
+    rule functions) and overrides DEFAULT_FIELD_RULES.
+    '''
+
+    def __init__(self, precedence: tuple = DEFAULT_PRECEDENCE,
+                 field_precedence: dict = None, field_rules: dict = None,
+                 page_tolerance: float = PAGE_TOLERANCE,
+                 page_slack: int = PAGE_SLACK):
+        self.precedence = tuple(precedence)
+        self.field_precedence = dict(field_precedence or {})
+        self.field_rules = dict(DEFAULT_FIELD_RULES)
+        self.field_rules.update(field_rules or {})
+        self.page_tolerance = page_tolerance
+        self.page_slack = page_slack
+
+    def providers_for(self, field: str, provider_results: dict) -> list:
+        '''
+        Return the providers in provider_results in the order of precedence
+        for field. Providers missing from the precedence come last.
+        '''
+        order = self.field_precedence.get(field, self.precedence)
+        return sorted(provider_results,
+                      key=lambda name: order.index(name) if name in order
+                      else len(order))
+
+    def merge(self, provider_results: dict) -> tuple:
+        '''
+        Merge the metadata of provider_results, a dictionary of the results
+        of each provider as returned by lookup_data.query_providers().
+        Return the merged metadata, or {} if no provider knew the book, and
+        a list of the conflicts that had to be settled by precedence.
+
+        Every conflict is a dictionary with the field, the candidates (a
+        dictionary of provider names and their values), the chosen value
+        and the name of the rule.
+        '''
+        provider_results = {name: metadata for name, metadata
+                             in provider_results.items() if metadata}
+        if not provider_results:
+            return {}, []
+        fields = []
+        for metadata in provider_results.values():
+            fields.extend(field for field in metadata if field not in fields)
+        merged = {}
+        conflicts = []
+        for field in fields:
+            ordered = self.providers_for(field, provider_results)
+            values = [(name, provider_results[name][field])
+                      for name in ordered
+                      if not _is_unknown(provider_results[name].get(field))]
+            if not values:
+                # Keep the "unknown" of the most trusted provider.
+                merged[field] = next(provider_results[name][field]
+                                     for name in ordered
+                                     if field in provider_results[name])
+                continue
+            rule = self.field_rules.get(field, 'precedence')
+            rule_function = MERGE_RULES[rule] if isinstance(rule, str) \
+                else rule
+            value, conflicting = rule_function(values, self)
+            merged[field] = value
+            if conflicting:
+                conflicts.append({
+                    'field': field,
+                    'candidates': dict(values),
+                    'chosen': value,
+                    'rule': rule if isinstance(rule, str)
+                    else getattr(rule, '__name__', str(rule))
+                })
+        if conflicts:
+            logger.info(f"Settled conflicts in "
+                        f"{', '.join(c['field'] for c in conflicts)} "
+                        f"of {merged.get('title')!r}.")
+        return merged, conflicts
+
+
+DEFAULT_POLICY = merge_policy()
@@ -15,8 +15,17 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import identifiers
+import provider_cache
+import provider_http
+import provider_registry
+import tosho_metrics
 logger = logging.getLogger(__name__)
 
+# The Open Library book lookup API. The benchmarks point this at a local
+# stand-in.
+OPENLIBRARY_API_URL = 'https://openlibrary.org/api/books'
+
 
 def get_openlib_data(idtype: str, book_id: int) -> dict:
     """
@@ -36,15 +45,26 @@ def get_openlib_data(idtype: str, book_id: int) -> dict:
                              about the book
     """
     idtype = idtype.upper()
-    from requests import get
     from json import loads
-    openlib_request_url = 'https://openlibrary.org/api/books'
-    openlib_request_result = get('https://openlibrary.org/api/books?bibkeys'
-                                 f'={idtype}:{book_id}&jscmd=data&format=json')
+    cached_body = provider_cache.lookup('openlibrary', idtype, book_id)
+    if cached_body is not None:
+        return loads(cached_body)
+    openlib_request_result = \
+        provider_http.get(f'{OPENLIBRARY_API_URL}?bibkeys={idtype}:{book_id}'
+                          '&jscmd=data&format=json', 'openlibrary')
     # NOTE: I looked into using the params argument, but apparently params get
     # converted into the % encoding format, which the Open Library API does not
     # know how to work with.
-    openlib_data_json = loads(openlib_request_result.content)
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='parse',
+                             provider='openlibrary'):
+        openlib_data_json = loads(openlib_request_result.content)
+    if openlib_data_json:
+        # Only books that were found are cached, so that a book added to
+        # Open Library later on is not hidden by an old empty result.
+        provider_cache.store('openlibrary', idtype, book_id,
+                             openlib_request_result.content)
+    else:
+        provider_cache.record_miss('openlibrary', idtype, book_id)
     return openlib_data_json
 
 
@@ -55,8 +75,6 @@ def process_openlib_data(openlib_data_json: dict) -> dict:
     arguments:
         openlib_data_json --
     """
-    from re import findall
-    current_id_types = ['lccn', 'isbn_13', 'isbn_10', 'oclc', 'issn']
     try:
         openlib_data = openlib_data_json.popitem()[1]
         # We can do this because the json data given by the Open
@@ -74,6 +92,16 @@ def process_openlib_data(openlib_data_json: dict) -> dict:
         logger.warning("WARNING: The search results are empty! Book not found"
                        " on Open Library.")
         return {}
+    return _process_openlib_record(openlib_data)
+
+
+def _process_openlib_record(openlib_data: dict) -> dict:
+    """
+    Extract all relevant information from the data of a single book, i.e. the
+    value stored under one "search_key" in an Open Library result.
+    """
+    from re import findall
+    current_id_types = ['lccn', 'isbn_13', 'isbn_10', 'oclc', 'issn']
     relevant_metadata = {}
     try:
         relevant_metadata['title'] = openlib_data['title']
@@ -116,21 +144,21 @@ def process_openlib_data(openlib_data_json: dict) -> dict:
         logger.warning("WARNING: The publishing date is unknown.")
         relevant_metadata['publish_date'] = "UNKNOWN"
     openlib_identifiers = openlib_data['identifiers']  # dictionary
-    identifiers = {}
+    book_identifiers = {}
     for id_type in current_id_types:
         try:
             # The data is presented as a list, but we will store it as a string
-            identifiers[id_type] = openlib_identifiers[id_type][0]
+            book_identifiers[id_type] = openlib_identifiers[id_type][0]
         except KeyError:
             logger.warning(f"WARNING: There is no {id_type} for this book.")
-            identifiers[id_type] = None
+            book_identifiers[id_type] = None
             # If openlib_data[identifiers] does not contain data for a type of
             # ID we are supporting, then we append it with ["N/A"]
             # NOTE: There are some books in the Open Library database that
             # actually contain multiple ISBNs for the exact same book for some
             # reason. It is not in the scope of this program to sanity-check
             # the upstream database.
-    relevant_metadata['identifiers'] = identifiers
+    relevant_metadata['identifiers'] = book_identifiers
     try:
         check_pagination = False
         relevant_metadata['pages'] = openlib_data['number_of_pages']
@@ -165,15 +193,129 @@ def openlibrary_results(idtype='ISBN', book_id=0) -> dict:
     Then calls process_openlib_data to convert it into the format usable by
     toshokan\'s database and returns it to the caller.
     """
-    # TODO: Check validity of input data. ISBNs should be 10 or 13 digits long
-    # Similar rules likely exist for other valid search options
-    if idtype == 'ISBN' and int(book_id) <= 0:
-        return {}
+    # TODO: Similar rules likely exist for other valid search options
+    if idtype.upper() == 'ISBN':
+        # Don't spend a request on a typo; look up every ISBN as an ISBN-13.
+        isbn = identifiers.canonical_isbn(book_id)
+        if isbn is None:
+            logger.warning(f"WARNING: {book_id!r} is not a valid ISBN.")
+            return {}
+        book_id = isbn
     olib_data = get_openlib_data(idtype, book_id)
-    olib_data_processed = process_openlib_data(olib_data)
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='process',
+                             provider='openlibrary'):
+        olib_data_processed = process_openlib_data(olib_data)
     return olib_data_processed
 
 
+def get_openlib_data_many(idtype: str, book_ids: list) -> dict:
+    """
+    Looks for information on several books from the Open Library database
+    with a single request.
+
+    The bibkeys parameter of the Open Library book lookup JSON API accepts a
+    comma-separated list of keys, so all of book_ids are sent at once.
+
+    arguments:
+        idtype   -- The type of ID being looked up. Supported values are ISBN,
+                    OCLC, LCCN and OLID.
+        book_ids -- The values of the idtype being looked up.
+    return value:
+        openlib_data_json -- the dictionary containing the parsed JSON metadata
+                             about the books, in the format
+                             {"search_key": {...actual_data...}, ...}. Books
+                             that were not found have no key at all.
+    """
+    idtype = idtype.upper()
+    from json import loads, dumps
+    openlib_data_json = {}
+    uncached_ids = []
+    for book_id in book_ids:
+        cached_body = provider_cache.lookup('openlibrary', idtype, book_id)
+        if cached_body is not None:
+            openlib_data_json.update(loads(cached_body))
+        else:
+            uncached_ids.append(book_id)
+    if not uncached_ids:
+        return openlib_data_json
+    bibkeys = ','.join(f'{idtype}:{book_id}' for book_id in uncached_ids)
+    openlib_request_result = \
+        provider_http.get(f'{OPENLIBRARY_API_URL}?bibkeys={bibkeys}'
+                          '&jscmd=data&format=json', 'openlibrary')
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='parse',
+                             provider='openlibrary'):
+        fetched_data_json = loads(openlib_request_result.content)
+    for book_id in uncached_ids:
+        bibkey = f'{idtype}:{book_id}'
+        if bibkey in fetched_data_json:
+            # Cached in the same shape as the response of get_openlib_data()
+            provider_cache.store('openlibrary', idtype, book_id,
+                                 dumps({bibkey: fetched_data_json[bibkey]})
+                                 .encode())
+        else:
+            provider_cache.record_miss('openlibrary', idtype, book_id)
+    openlib_data_json.update(fetched_data_json)
+    return openlib_data_json
+
+
+def openlibrary_results_many(idtype='ISBN', book_ids=(),
+                             chunk_size=50) -> dict:
+    """
+    Batched version of openlibrary_results().
+
+    Looks up book_ids with one request per chunk_size identifiers and returns
+    a dictionary keyed by each requested identifier. The value is the
+    processed metadata of the book, or an empty dictionary if the identifier
+    is invalid or the book was not found on Open Library, exactly like
+    openlibrary_results() would return for it.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    idtype = idtype.upper()
+    book_ids = list(book_ids)
+    if idtype == 'ISBN':
+        # Validated all at once; an ISBN-10 and its ISBN-13 are looked up
+        # only once.
+        lookup_ids = identifiers.validate_isbns(book_ids)
+    else:
+        lookup_ids = book_ids
+    results = {}
+    # The set is for checking, the list keeps the order for the chunks.
+    seen_ids = set()
+    valid_ids = []
+    for book_id, lookup_id in zip(book_ids, lookup_ids):
+        if lookup_id is None:
+            logger.warning(f"WARNING: {book_id!r} is not a valid ISBN.")
+        elif lookup_id in seen_ids:
+            pass
+        elif provider_cache.known_miss('openlibrary', idtype, lookup_id):
+            seen_ids.add(lookup_id)
+        else:
+            seen_ids.add(lookup_id)
+            valid_ids.append(lookup_id)
+    found = {}
+    for start in range(0, len(valid_ids), chunk_size):
+        chunk = valid_ids[start:start + chunk_size]
+        olib_data = get_openlib_data_many(idtype, chunk)
+        for lookup_id in chunk:
+            # The keys of the result are the bibkeys exactly as we sent them.
+            try:
+                openlib_data = olib_data[f'{idtype}:{lookup_id}']
+            except KeyError:
+                logger.warning(f"WARNING: {idtype} {lookup_id} not found on "
+                               "Open Library.")
+                continue
+            with tosho_metrics.timer('toshokan_stage_seconds',
+                                     stage='process', provider='openlibrary'):
+                found[lookup_id] = _process_openlib_record(openlib_data)
+    for book_id, lookup_id in zip(book_ids, lookup_ids):
+        results[book_id] = found.get(lookup_id, {})
+    return results
+
+
+provider_registry.register_provider('openlibrary', openlibrary_results)
+
+
 if __name__ == "__main__":  # NOTE:WIP
     import argparse
     parser = \
@@ -0,0 +1,277 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+An on-disk cache for the raw responses of the online book databases.
+
+Responses are stored in a SQLite file, keyed by (provider, idtype, id). Each
+provider has its own time to live, and once the cache grows past its size cap
+the least recently used responses are evicted.
+
+The same file also remembers the books a provider did not know (misses). A
+miss is not retried until its back-off has expired, and the back-off doubles
+with every miss in a row.
+
+The cache is off until configure_cache() is called. The provider modules use
+lookup(), store(), record_miss() and known_miss(), which do nothing while the
+cache is off.
+'''
+
+import logging
+import sqlite3
+import threading
+import time
+import tosho_metrics
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+# Seconds a response stays valid, per provider. Providers that are not
+# listed here use DEFAULT_TTL.
+PROVIDER_TTLS = {
+    'openlibrary': 30 * DAY,
+    'googlebooks': 7 * DAY
+}
+DEFAULT_TTL = 7 * DAY
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds before the first retry of a miss. Every further miss doubles it, up
+# to MISS_BACKOFF_MAX.
+MISS_BACKOFF_BASE = 1 * DAY
+MISS_BACKOFF_MAX = 64 * DAY
+
+# How the cache is used:
+#   use     -- serve responses from the cache and store new ones.
+#   refresh -- always ask the provider, but store the new responses.
+#   bypass  -- neither read from nor write to the cache.
+CACHE_MODES = ('use', 'refresh', 'bypass')
+
+
+class response_cache:
+    '''
+    A size-capped, least recently used cache of provider responses stored in
+    a SQLite file. It is safe to share between threads.
+    '''
+
+    def __init__(self, cache_path: str, ttls: dict = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.ttls = dict(PROVIDER_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS Responses(Provider, "
+                           "IDType, ID, Body BLOB, Fetched REAL, LastUsed "
+                           "REAL, Size INT, PRIMARY KEY(Provider, IDType, "
+                           "ID)) WITHOUT ROWID;")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS Responses_LastUsed ON "
+                           "Responses(LastUsed);")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS Misses(Provider, "
+                           "IDType, ID, Attempts INT, LastAttempt REAL, "
+                           "RetryAfter REAL, PRIMARY KEY(Provider, IDType, "
+                           "ID)) WITHOUT ROWID;")
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(Size), 0) FROM Responses").fetchone()[0]
+
+    def get(self, provider: str, idtype: str, book_id) -> bytes:
+        '''
+        Return the cached response body, or None if there is no response or
+        it is older than the time to live of the provider.
+        '''
+        key = (provider, idtype.upper(), str(book_id))
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT Body, Fetched FROM Responses "
+                                     "WHERE Provider=? AND IDType=? AND "
+                                     "ID=?", key).fetchone()
+            if row is None:
+                return None
+            body, fetched = row
+            if now - fetched > self.ttls.get(provider, DEFAULT_TTL):
+                return None
+            self._conn.execute("UPDATE Responses SET LastUsed=? WHERE "
+                               "Provider=? AND IDType=? AND ID=?",
+                               (now,) + key)
+        return body
+
+    def put(self, provider: str, idtype: str, book_id, body: bytes) -> None:
+        '''
+        Store a response body, replacing any older one for the same key.
+        '''
+        key = (provider, idtype.upper(), str(book_id))
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT Size FROM Responses WHERE "
+                                     "Provider=? AND IDType=? AND ID=?",
+                                     key).fetchone()
+            if row is not None:
+                self._total_bytes -= row[0]
+            self._conn.execute("INSERT OR REPLACE INTO Responses(Provider, "
+                               "IDType, ID, Body, Fetched, LastUsed, Size) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               key + (body, now, now, len(body)))
+            self._total_bytes += len(body)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        '''
+        Delete the least recently used responses until the cache is back to
+        90% of its size cap, so that we don't evict on every put().
+        '''
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT Provider, IDType, ID, Size FROM "
+                                  "Responses ORDER BY LastUsed")
+        evicted = []
+        for provider, idtype, book_id, size in rows:
+            if self._total_bytes <= target:
+                break
+            evicted.append((provider, idtype, book_id))
+            self._total_bytes -= size
+        rows.close()
+        self._conn.executemany("DELETE FROM Responses WHERE Provider=? AND "
+                               "IDType=? AND ID=?", evicted)
+        logger.info(f"Evicted {len(evicted)} responses from the cache.")
+
+    def record_miss(self, provider: str, idtype: str, book_id) -> float:
+        '''
+        Remember that provider did not know the book. Return the time after
+        which it may be asked again.
+        '''
+        key = (provider, idtype.upper(), str(book_id))
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT Attempts FROM Misses WHERE "
+                                     "Provider=? AND IDType=? AND ID=?",
+                                     key).fetchone()
+            attempts = 1 if row is None else row[0] + 1
+            backoff = min(MISS_BACKOFF_BASE * 2 ** (attempts - 1),
+                          MISS_BACKOFF_MAX)
+            self._conn.execute("INSERT OR REPLACE INTO Misses(Provider, "
+                               "IDType, ID, Attempts, LastAttempt, "
+                               "RetryAfter) VALUES (?, ?, ?, ?, ?, ?)",
+                               key + (attempts, now, now + backoff))
+        return now + backoff
+
+    def known_miss(self, provider: str, idtype: str, book_id) -> bool:
+        '''
+        Return True if provider did not know the book the last time it was
+        asked and the back-off has not expired yet.
+        '''
+        key = (provider, idtype.upper(), str(book_id))
+        with self._lock:
+            row = self._conn.execute("SELECT RetryAfter FROM Misses WHERE "
+                                     "Provider=? AND IDType=? AND ID=?",
+                                     key).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def forget_miss(self, provider: str, idtype: str, book_id) -> None:
+        key = (provider, idtype.upper(), str(book_id))
+        with self._lock:
+            self._conn.execute("DELETE FROM Misses WHERE Provider=? AND "
+                               "IDType=? AND ID=?", key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM Responses;")
+            self._conn.execute("DELETE FROM Misses;")
+            self._total_bytes = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_cache = None
+_cache_mode = 'bypass'
+
+
+def configure_cache(cache_path: str, mode: str = 'use', ttls: dict = None,
+                    max_bytes: int = DEFAULT_MAX_BYTES) -> response_cache:
+    '''
+    Open the cache file at cache_path and make it the cache used by the
+    provider modules. mode is one of CACHE_MODES.
+    '''
+    global _cache, _cache_mode
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode {mode!r}. Valid modes are "
+                         f"{', '.join(CACHE_MODES)}.")
+    if _cache is not None:
+        _cache.close()
+    _cache = response_cache(cache_path, ttls, max_bytes)
+    _cache_mode = mode
+    return _cache
+
+
+def set_cache_mode(mode: str) -> None:
+    global _cache_mode
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode {mode!r}. Valid modes are "
+                         f"{', '.join(CACHE_MODES)}.")
+    _cache_mode = mode
+
+
+def lookup(provider: str, idtype: str, book_id) -> bytes:
+    '''
+    Return the cached response of provider for the book, or None if it has
+    to be fetched.
+    '''
+    if _cache is None or _cache_mode != 'use':
+        return None
+    body = _cache.get(provider, idtype, book_id)
+    tosho_metrics.count('toshokan_provider_cache_total', provider=provider,
+                        result='miss' if body is None else 'hit')
+    return body
+
+
+def store(provider: str, idtype: str, book_id, body: bytes) -> None:
+    '''
+    Remember the response of provider for the book.
+    '''
+    if _cache is None or _cache_mode == 'bypass':
+        return
+    _cache.put(provider, idtype, book_id, body)
+    _cache.forget_miss(provider, idtype, book_id)
+
+
+def record_miss(provider: str, idtype: str, book_id) -> None:
+    '''
+    Remember that provider did not know the book.
+    '''
+    if _cache is None or _cache_mode == 'bypass':
+        return
+    retry_after = _cache.record_miss(provider, idtype, book_id)
+    logger.info(f"{provider} does not know {idtype} {book_id}. Not asking "
+                f"again before {time.ctime(retry_after)}.")
+
+
+def known_miss(provider: str, idtype: str, book_id) -> bool:
+    '''
+    Return True if provider should not be asked about the book yet because
+    it did not know it recently.
+    '''
+    if _cache is None or _cache_mode != 'use':
+        return False
+    if _cache.known_miss(provider, idtype, book_id):
+        tosho_metrics.count('toshokan_provider_cache_total',
+                            provider=provider, result='known_miss')
+        return True
+    return False
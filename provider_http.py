@@ -0,0 +1,291 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+The HTTP client shared by the provider modules.
+
+All requests go through one requests.Session, so connections to a provider
+are kept alive and reused instead of paying for a new TCP and TLS handshake
+on every lookup. Every request has a connect and a read timeout, and failed
+requests (connection errors, timeouts, 429 and 5xx responses) are retried
+with a jittered exponential back-off. The requests to each provider are
+paced by its adaptive rate limit, see provider_limits.
+
+The traffic can be recorded to an archive and replayed from it instead of
+the network, see configure_traffic() and provider_traffic.
+'''
+
+import atexit
+import email.utils
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import provider_limits
+import tosho_metrics
+from provider_traffic import traffic_archive
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a connection, and then for the response.
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 15.0
+
+# The number of times a failed request is retried before giving up.
+MAX_RETRIES = 3
+# The back-off before retry n is a random time between 0 and
+# min(BACKOFF_MAX, BACKOFF_BASE * 2 ** n) seconds.
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10.0
+# The longest wait asked for in a Retry-After header that we go along with.
+RETRY_AFTER_MAX = 120.0
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# The number of connections kept open per host. This should be at least the
+# number of threads looking up books at the same time.
+POOL_SIZE = 32
+
+USER_AGENT = "toshokan (https://github.com/GNY-001F2/toshokan)"
+
+# What happens to the traffic:
+#   live   -- requests go to the network.
+#   record -- requests go to the network and are recorded to an archive.
+#   replay -- requests are answered from an archive, without the network.
+TRAFFIC_MODES = ('live', 'record', 'replay')
+
+_session = None
+_session_lock = threading.Lock()
+_traffic_mode = 'live'
+_archive = None
+# None to replay without delay, the number of seconds every replayed
+# response takes, or 'recorded' to take as long as the recorded one did.
+_replay_latency = None
+
+
+def get_session() -> requests.Session:
+    '''
+    Return the shared session, creating it on first use.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _new_session()
+        return _session
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    # Retries are done by get() so that they can be logged and use our
+    # back-off; the adapter itself should not retry.
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE,
+                          max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        'User-Agent': USER_AGENT,
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip, deflate'
+    })
+    return session
+
+
+def configure(connect_timeout: float = None, read_timeout: float = None,
+              max_retries: int = None, pool_size: int = None) -> None:
+    '''
+    Change the timeouts, the number of retries or the size of the connection
+    pool. Changing the pool size replaces the shared session.
+    '''
+    global CONNECT_TIMEOUT, READ_TIMEOUT, MAX_RETRIES, POOL_SIZE, _session
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = read_timeout
+    if max_retries is not None:
+        MAX_RETRIES = max_retries
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+        with _session_lock:
+            if _session is not None:
+                _session.close()
+            _session = None
+
+
+def configure_traffic(mode: str, archive_path: str = None,
+                      replay_latency=None) -> None:
+    '''
+    Switch to one of TRAFFIC_MODES. record and replay need the path of the
+    archive. When replaying, every response is delayed by replay_latency:
+    None for no delay (and no back-off before retries), a number of seconds,
+    or 'recorded' for the time the recorded response took.
+    '''
+    global _traffic_mode, _archive, _replay_latency
+    if mode not in TRAFFIC_MODES:
+        raise ValueError(f"Unknown traffic mode {mode!r}. Valid modes are "
+                         f"{', '.join(TRAFFIC_MODES)}.")
+    if mode != 'live' and archive_path is None:
+        raise ValueError(f"The traffic mode {mode!r} needs an archive.")
+    if replay_latency not in (None, 'recorded'):
+        replay_latency = float(replay_latency)
+    if _archive is not None:
+        _archive.close()
+    _archive = traffic_archive(archive_path) if mode != 'live' else None
+    if _archive is not None:
+        atexit.register(_archive.close)
+    _traffic_mode = mode
+    _replay_latency = replay_latency
+
+
+def _send(url: str, provider: str) -> requests.Response:
+    '''
+    Send a single GET request for url, or replay its response, according to
+    the traffic mode.
+    '''
+    if _traffic_mode == 'replay':
+        response, elapsed = _archive.replay(url)
+        if _replay_latency == 'recorded':
+            time.sleep(elapsed)
+        elif _replay_latency:
+            time.sleep(_replay_latency)
+        return response
+    started = time.time()
+    timer = time.perf_counter()
+    try:
+        response = get_session().get(url, timeout=(CONNECT_TIMEOUT,
+                                                   READ_TIMEOUT))
+    except (requests.ConnectionError, requests.Timeout) as e:
+        if _traffic_mode == 'record':
+            _archive.record(provider, url, started,
+                            time.perf_counter() - timer, error=e)
+        raise
+    if _traffic_mode == 'record':
+        _archive.record(provider, url, started, time.perf_counter() - timer,
+                        response)
+    return response
+
+
+def _realtime() -> bool:
+    # A replay without latency runs at full speed, back-offs and rate limits
+    # included.
+    return _traffic_mode != 'replay' or _replay_latency is not None
+
+
+def _sleep(delay: float) -> None:
+    if _realtime():
+        time.sleep(delay)
+
+
+def get(url: str, provider: str = "") -> requests.Response:
+    '''
+    Send a GET request for url with the shared session and return the
+    response.
+
+    Connection errors, timeouts and responses with a status in
+    RETRY_STATUSES are retried up to MAX_RETRIES times. If the last attempt
+    fails as well, the error is raised (requests.HTTPError for a bad status).
+    Every attempt waits for the rate limit of provider.
+    '''
+    limiter = provider_limits.limiter_for(provider) if _realtime() else None
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = _send(url, provider)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _measure(provider, started, 'timeout'
+                     if isinstance(e, requests.Timeout) else 'error')
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = _backoff(attempt)
+            logger.warning(f"WARNING: Request to {provider or url} failed "
+                           f"({e!r}). Retrying in {delay:.2f} seconds.")
+        else:
+            _measure(provider, started, response.status_code, response)
+            if limiter is not None:
+                _adapt(limiter, response)
+            if response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+                return response
+            if attempt >= MAX_RETRIES:
+                response.raise_for_status()
+            delay = max(_backoff(attempt), _retry_after(response))
+            logger.warning(f"WARNING: {provider or url} answered with status "
+                           f"{response.status_code}. Retrying in "
+                           f"{delay:.2f} seconds.")
+        tosho_metrics.count('toshokan_http_retries_total', provider=provider)
+        _sleep(delay)
+        attempt += 1
+
+
+def _measure(provider: str, started: float, status,
+             response: requests.Response = None) -> None:
+    '''
+    Report how long a single request took and how large its response was.
+    status is the HTTP status, or 'timeout' or 'error' if there was no
+    response.
+    '''
+    if not tosho_metrics.enabled():
+        return
+    tosho_metrics.observe('toshokan_http_request_seconds',
+                          time.perf_counter() - started, provider=provider,
+                          status=status)
+    if response is not None:
+        tosho_metrics.observe('toshokan_http_response_bytes',
+                              len(response.content), provider=provider)
+
+
+def _adapt(limiter: provider_limits.rate_limiter,
+           response: requests.Response) -> None:
+    '''
+    Let the rate limit of a provider follow how it answered. Other server
+    errors say nothing about the rate and leave it as it is.
+    '''
+    if response.status_code in provider_limits.THROTTLE_STATUSES:
+        limiter.throttled(response.status_code, _retry_after(response))
+    elif response.status_code < 500:
+        limiter.succeeded()
+
+
+def _backoff(attempt: int) -> float:
+    '''
+    Return a random back-off for the given retry ("full jitter"), so that
+    many threads failing at once do not retry in lockstep.
+    '''
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _retry_after(response: requests.Response) -> float:
+    '''
+    Return the number of seconds the server asked us to wait in its
+    Retry-After header, capped at RETRY_AFTER_MAX, or 0 if it did not ask.
+    '''
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return 0.0
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        # Retry-After may also be an HTTP date.
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return 0.0
+        if retry_at is None:
+            return 0.0
+        seconds = retry_at.timestamp() - time.time()
+    return min(max(seconds, 0.0), RETRY_AFTER_MAX)
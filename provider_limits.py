@@ -0,0 +1,190 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Adaptive rate limits for the requests to the online book databases.
+
+Every provider has one rate_limiter, a token bucket shared by all threads
+sending requests to it. provider_http takes a token before each request and
+tells the limiter how the provider answered. The rate adapts like TCP's
+congestion window: it starts slow and doubles every second of successful
+requests until the provider first throttles us. From then on it grows by
+RATE_INCREASE requests per second for every second of successful requests
+(additive increase), and is cut by RATE_DECREASE (multiplicative decrease)
+whenever the provider answers with 429 or 503. A Retry-After header pauses
+the bucket for as long as the provider asked.
+This way a bulk lookup settles at about the fastest rate each provider puts
+up with.
+'''
+
+import logging
+import threading
+import time
+import tosho_metrics
+logger = logging.getLogger(__name__)
+
+# Requests per second: the rate a provider starts with, and the bounds the
+# adaptation keeps it in.
+INITIAL_RATE = 4.0
+MIN_RATE = 0.1
+MAX_RATE = 25.0
+# The number of tokens a bucket holds, i.e. how many requests may go out at
+# once after a quiet spell.
+BURST = 4
+# Added to the rate per second of successful requests.
+RATE_INCREASE = 0.5
+# The rate is multiplied by this when a provider throttles us.
+RATE_DECREASE = 0.7
+# Responses to requests that were already on their way when the rate was
+# cut tell us nothing new, so the rate is cut at most once in this many
+# seconds (or in the time between two requests, if that is longer).
+DECREASE_COOLDOWN = 1.0
+# The statuses that mean the provider wants fewer requests.
+THROTTLE_STATUSES = frozenset([429, 503])
+
+_enabled = True
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class rate_limiter:
+    '''
+    A token bucket for the requests to one provider. It is safe to share
+    between threads.
+    '''
+
+    def __init__(self, provider: str, rate: float = None,
+                 min_rate: float = None, max_rate: float = None,
+                 burst: int = None):
+        self.provider = provider
+        self.min_rate = MIN_RATE if min_rate is None else min_rate
+        self.max_rate = MAX_RATE if max_rate is None else max_rate
+        rate = INITIAL_RATE if rate is None else rate
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.burst = BURST if burst is None else burst
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        # The time up to which the tokens were counted. It lies in the
+        # future while the bucket is paused for a Retry-After.
+        self._updated = time.monotonic()
+        self._next_decrease = 0.0
+        # Until the provider throttles us for the first time.
+        self._slow_start = True
+
+    def _refill(self, now: float) -> None:
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self) -> float:
+        '''
+        Take a token, waiting until one is available. Return the number of
+        seconds waited.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # The token is reserved right away, even if it only becomes
+            # available later, so that waiting threads are served in order.
+            self._tokens -= 1
+            wait = max(0.0, self._updated - now) + \
+                max(0.0, -self._tokens) / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        tosho_metrics.observe('toshokan_rate_limit_wait_seconds', wait,
+                              provider=self.provider)
+        return wait
+
+    def succeeded(self) -> None:
+        '''
+        Note that the provider answered a request without throttling it.
+        '''
+        with self._lock:
+            # rate successes arrive per second, so slow start doubles the
+            # rate every second and afterwards it grows by RATE_INCREASE per
+            # second.
+            increase = 1.0 if self._slow_start \
+                else RATE_INCREASE / self.rate
+            self.rate = min(self.max_rate, self.rate + increase)
+
+    def throttled(self, status: int, retry_after: float = 0.0) -> None:
+        '''
+        Note that the provider answered with a throttling status, and asked
+        us to wait retry_after seconds.
+        '''
+        tosho_metrics.count('toshokan_rate_limit_throttled_total',
+                            provider=self.provider, status=status)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # No bursting right after being throttled.
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after > 0 and now + retry_after > self._updated:
+                self._updated = now + retry_after
+            self._slow_start = False
+            if now < self._next_decrease:
+                return
+            old_rate = self.rate
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            self._next_decrease = now + max(DECREASE_COOLDOWN,
+                                            1.0 / self.rate)
+        logger.info(f"{self.provider} answered with status {status}. "
+                    f"Slowing down from {old_rate:.2f} to {self.rate:.2f} "
+                    "requests per second.")
+
+
+def limiter_for(provider: str) -> rate_limiter:
+    '''
+    Return the rate_limiter of provider, creating it on first use, or None
+    if requests to it are not limited.
+    '''
+    if not _enabled or not provider:
+        return None
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            limiter = _limiters[provider] = rate_limiter(provider)
+        return limiter
+
+
+def rate_limits_enabled() -> bool:
+    return _enabled
+
+
+def configure_rate_limits(enabled: bool = None, initial_rate: float = None,
+                          min_rate: float = None, max_rate: float = None,
+                          burst: int = None) -> None:
+    '''
+    Turn the rate limits on or off, or change the rates and the size of the
+    buckets. The limiters start over with the new settings.
+    '''
+    global _enabled, INITIAL_RATE, MIN_RATE, MAX_RATE, BURST
+    new_min_rate = MIN_RATE if min_rate is None else min_rate
+    new_max_rate = MAX_RATE if max_rate is None else max_rate
+    if new_min_rate <= 0 or new_max_rate < new_min_rate:
+        raise ValueError("The rates must satisfy 0 < min_rate <= max_rate.")
+    if burst is not None and burst < 1:
+        raise ValueError("burst must be at least 1")
+    MIN_RATE, MAX_RATE = new_min_rate, new_max_rate
+    if enabled is not None:
+        _enabled = enabled
+    if initial_rate is not None:
+        INITIAL_RATE = initial_rate
+    if burst is not None:
+        BURST = burst
+    with _limiters_lock:
+        _limiters.clear()
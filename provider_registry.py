@@ -0,0 +1,336 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+The registry of the online book databases that books are looked up in.
+
+A provider is a function called as lookup(idtype, bookid) that returns the
+processed metadata of the book, or {} if it does not know the book. A
+provider module registers its function when it is imported:
+
+    provider_registry.register_provider('openlibrary', openlibrary_results)
+
+and lookup_data asks every registered provider. Each provider keeps track
+of how long its lookups take, which makes two things possible:
+
+    Hedged requests -- if a lookup has not answered by the provider's 95th
+        percentile latency, the same lookup is sent once more and whichever
+        answers first is used. A few slow responses then no longer set the
+        latency of a whole scan. Hedges are limited to HEDGE_BUDGET of the
+        lookups, so that a provider that is slow across the board does not
+        get twice the load.
+    A circuit breaker -- after FAILURE_THRESHOLD lookups in a row failed or
+        missed the deadline, the provider is skipped for OPEN_SECONDS. Then
+        a single trial lookup decides whether it is used again.
+'''
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, Executor
+import tosho_metrics
+logger = logging.getLogger(__name__)
+
+# The number of recent lookups the latency percentiles are taken from, and
+# how many there must be before lookups are hedged.
+LATENCY_WINDOW = 256
+MIN_SAMPLES = 20
+# The percentile of the latency after which a lookup is hedged, and the
+# shortest time to wait for it. Cached responses make many lookups very
+# fast, which should not make every lookup that has to use the network
+# look slow.
+HEDGE_PERCENTILE = 0.95
+MIN_HEDGE_DELAY = 0.05
+# The share of lookups that may be hedged, and the number of hedges that
+# can be saved up for several slow answers in a row.
+HEDGE_BUDGET = 0.1
+HEDGE_BURST = 5.0
+# Failed or timed out lookups in a row that open the circuit, and the
+# number of seconds it stays open.
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 30.0
+
+PROVIDERS = {}
+_providers_lock = threading.Lock()
+
+
+class latency_tracker:
+    '''
+    The latencies of the recent lookups of a provider.
+    '''
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=window)
+        self._percentile = None
+        self._added = 0
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+            self._added += 1
+
+    def percentile(self, share: float = HEDGE_PERCENTILE) -> float:
+        '''
+        Return the share percentile of the recent latencies, or None if
+        there are fewer than MIN_SAMPLES of them.
+        '''
+        with self._lock:
+            if len(self._samples) < MIN_SAMPLES:
+                return None
+            # Sorting the window for every lookup would be wasteful; the
+            # percentile hardly moves in a few lookups.
+            if self._percentile is None or self._added >= 16:
+                ordered = sorted(self._samples)
+                self._percentile = ordered[min(len(ordered) - 1,
+                                               int(share * len(ordered)))]
+                self._added = 0
+            return self._percentile
+
+
+class circuit_breaker:
+    '''
+    Decides whether a provider is asked at all. It is closed (the provider
+    is asked) until FAILURE_THRESHOLD lookups in a row fail, then open for
+    OPEN_SECONDS, and then half-open: one trial lookup is let through, and
+    closes it again if it succeeds.
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = 'closed'
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_until = 0.0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and \
+                    time.monotonic() >= self._opened_until:
+                self.state = 'half-open'
+                return True
+            # Open, or half-open with the trial still on its way.
+            return False
+
+    def succeeded(self) -> None:
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"{self.name} is answering again.")
+            self.state = 'closed'
+            self._failures = 0
+
+    def failed(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state != 'half-open' and \
+                    self._failures < FAILURE_THRESHOLD:
+                return
+            self.state = 'open'
+            self._opened_until = time.monotonic() + OPEN_SECONDS
+        tosho_metrics.count('toshokan_circuit_opened_total',
+                            provider=self.name)
+        logger.warning(f"WARNING: {self.name} failed {self._failures} times "
+                       f"in a row. Not asking it for {OPEN_SECONDS} "
+                       "seconds.")
+
+
+class registered_provider:
+    '''
+    A provider in the registry: its lookup function together with its
+    latencies and its circuit breaker. Calling it calls the lookup function
+    directly.
+    '''
+
+    def __init__(self, name: str, lookup, hedge: bool = True):
+        self.name = name
+        self.lookup = lookup
+        self.hedge = hedge
+        self.latencies = latency_tracker()
+        self.breaker = circuit_breaker(name)
+        self._budget_lock = threading.Lock()
+        # Every lookup earns HEDGE_BUDGET of a hedge, up to HEDGE_BURST; a
+        # hedge costs one.
+        self._hedge_tokens = 1.0
+
+    def __call__(self, idtype: str, bookid):
+        return self.lookup(idtype, bookid)
+
+    def allow(self) -> bool:
+        '''
+        Return whether the provider should be asked, according to its
+        circuit breaker.
+        '''
+        return self.breaker.allow()
+
+    def submit(self, pool: Executor, idtype: str, bookid,
+               deadline: float) -> Future:
+        '''
+        Start a lookup in pool and return a future of its result. The lookup
+        is hedged if it takes longer than usual, and its outcome is fed to
+        the latencies and the circuit breaker. A lookup that is still
+        running at deadline should be reported with timed_out().
+        '''
+        lookup = _hedged_lookup(self, pool, idtype, bookid, deadline)
+        lookup.attempt()
+        with self._budget_lock:
+            self._hedge_tokens = min(HEDGE_BURST,
+                                     self._hedge_tokens + HEDGE_BUDGET)
+        delay = self.latencies.percentile() if self.hedge else None
+        if delay is not None:
+            delay = max(delay, MIN_HEDGE_DELAY)
+            if delay < deadline:
+                _scheduler.call_later(delay, lookup.hedge)
+        return lookup.future
+
+    def timed_out(self) -> None:
+        self.breaker.failed()
+
+    def _take_hedge_token(self) -> bool:
+        with self._budget_lock:
+            if self._hedge_tokens < 1.0:
+                return False
+            self._hedge_tokens -= 1.0
+            return True
+
+
+class _hedged_lookup:
+    '''
+    One lookup on a provider, made of the first attempt and possibly a
+    hedge. Its future gets the first result, or the error if every attempt
+    failed.
+    '''
+
+    def __init__(self, provider: registered_provider, pool: Executor,
+                 idtype: str, bookid, deadline: float):
+        self.provider = provider
+        self.pool = pool
+        self.idtype = idtype
+        self.bookid = bookid
+        self.deadline = deadline
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def attempt(self, hedged: bool = False) -> None:
+        if not hedged:
+            with self._lock:
+                self._pending += 1
+        started = time.monotonic()
+        attempt = self.pool.submit(self.provider.lookup, self.idtype,
+                                   self.bookid)
+        attempt.add_done_callback(
+            lambda done: self._settle(done, started, hedged))
+
+    def hedge(self) -> None:
+        # Called by the scheduler once the lookup took longer than usual.
+        with self._lock:
+            if self.future.done() or not self.provider._take_hedge_token():
+                return
+            self._pending += 1
+        logger.info(f"{self.provider.name} is slow to answer for "
+                    f"{self.idtype} {self.bookid}. Asking again.")
+        tosho_metrics.count('toshokan_provider_hedges_total',
+                            provider=self.provider.name, result='sent')
+        self.attempt(hedged=True)
+
+    def _settle(self, attempt: Future, started: float, hedged: bool) -> None:
+        error = attempt.exception()
+        if error is None:
+            self.provider.latencies.add(time.monotonic() - started)
+        with self._lock:
+            self._pending -= 1
+            if self.future.done():
+                return
+            if error is not None and self._pending:
+                return  # The other attempt may still succeed.
+            if error is None:
+                self.future.set_result(attempt.result())
+            else:
+                self.future.set_exception(error)
+        if error is not None:
+            self.provider.breaker.failed()
+            return
+        if hedged:
+            tosho_metrics.count('toshokan_provider_hedges_total',
+                                provider=self.provider.name, result='won')
+        if time.monotonic() - self.started <= self.deadline:
+            # Answering after the deadline was already counted as a
+            # failure.
+            self.provider.breaker.succeeded()
+
+
+class _hedge_scheduler:
+    '''
+    Calls functions after a delay from a single background thread, so that
+    waiting for the time to hedge does not take up a thread per lookup.
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay: float, function) -> None:
+        with self._condition:
+            heapq.heappush(self._queue, (time.monotonic() + delay,
+                                         next(self._sequence), function))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="toshokan-hedging",
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if self._queue and self._queue[0][0] <= now:
+                        break
+                    self._condition.wait(self._queue[0][0] - now
+                                         if self._queue else None)
+                function = heapq.heappop(self._queue)[2]
+            try:
+                function()
+            except Exception:
+                logger.exception("Hedging a lookup failed.")
+
+
+_scheduler = _hedge_scheduler()
+
+
+def register_provider(name: str, lookup, hedge: bool = True) -> None:
+    '''
+    Add a provider, or replace the one registered as name. hedge=False
+    turns off hedged requests for providers for which a second request is
+    expensive.
+    '''
+    with _providers_lock:
+        PROVIDERS[name] = registered_provider(name, lookup, hedge)
+
+
+def unregister_provider(name: str) -> None:
+    with _providers_lock:
+        PROVIDERS.pop(name, None)
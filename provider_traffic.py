@@ -0,0 +1,269 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Archives of the traffic between toshokan and the online book databases.
+
+provider_http can record every request it sends, together with its response
+or error and how long it took, and replay an archive later without any
+network access. This reproduces a slow or odd import on an offline machine,
+and lets process_openlib_data() and process_googlebooks_data() be profiled
+against real payloads:
+
+    archive = traffic_archive("import.traffic.gz")
+    for exchange in archive.exchanges("openlibrary"):
+        process_openlib_data(json.loads(exchange['body']))
+
+An archive is a gzip file of JSON lines. The first line of every recording
+session is a header; each further line is one exchange:
+
+    {"provider": "openlibrary", "url": "...", "started": 1600000000.0,
+     "elapsed": 0.42, "status": 200, "headers": {...}, "body": "..."}
+
+A request that failed without a response has "error" ("ConnectionError" or
+"Timeout") and "message" instead of the status, headers and body. Bodies
+that are not UTF-8 are stored in base64 with "encoding": "base64".
+Recording appends a new gzip member to an existing archive, which gzip
+readers treat as one continuous file. The member of a session that was never
+closed, because the import crashed, has no end, and gzip readers would take
+the next member for more of it. Before recording into such an archive, the
+lines it got as far as are written again as a complete member in its place.
+'''
+
+import base64
+import collections
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+from typing import Iterator
+import requests
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMAT = 'toshokan-traffic'
+ARCHIVE_VERSION = 1
+
+# The response headers worth keeping; the rest only take up space.
+KEPT_HEADERS = ('Content-Type', 'Retry-After')
+
+# The number of bytes an archive is read at a time when it is checked.
+_CHUNK_SIZE = 1024 * 1024
+
+# The errors a recorded exchange can end in, by name.
+REPLAYED_ERRORS = {
+    'ConnectionError': requests.ConnectionError,
+    'Timeout': requests.Timeout
+}
+
+
+class traffic_archive:
+    '''
+    An archive of provider traffic at path, opened for recording, replay or
+    both. It is safe to share between threads.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._output = None
+        self._replay = None
+
+    def exchanges(self, provider: str = None) -> Iterator[dict]:
+        '''
+        Yield the recorded exchanges in the order they were recorded, only
+        those with provider if it is given.
+        '''
+        with gzip.open(self.path, 'rt', encoding='utf-8') as archive_file:
+            try:
+                for line in archive_file:
+                    if not line.endswith('\n'):
+                        break  # Cut off in the middle of a line
+                    exchange = json.loads(line)
+                    if exchange.get('format') == ARCHIVE_FORMAT:
+                        continue
+                    if provider is not None and \
+                            exchange.get('provider') != provider:
+                        continue
+                    if exchange.get('encoding') == 'base64':
+                        exchange['body'] = base64.b64decode(exchange['body'])
+                    yield exchange
+            except EOFError:
+                # The recording was not closed, for example because the
+                # import crashed. Everything up to the last flush is there.
+                logger.warning(f"WARNING: {self.path} ends unexpectedly. "
+                               "It was probably not closed properly.")
+
+    def record(self, provider: str, url: str, started: float, elapsed: float,
+               response: requests.Response = None,
+               error: Exception = None) -> None:
+        '''
+        Append an exchange: the response to url, or the error it failed
+        with.
+        '''
+        exchange = {'provider': provider, 'url': url, 'started': started,
+                    'elapsed': round(elapsed, 6)}
+        if response is None:
+            exchange['error'] = 'Timeout' \
+                if isinstance(error, requests.Timeout) else 'ConnectionError'
+            exchange['message'] = str(error)
+        else:
+            exchange['status'] = response.status_code
+            exchange['headers'] = {name: response.headers[name]
+                                   for name in KEPT_HEADERS
+                                   if name in response.headers}
+            try:
+                exchange['body'] = response.content.decode('utf-8')
+            except UnicodeDecodeError:
+                exchange['body'] = \
+                    base64.b64encode(response.content).decode('ascii')
+                exchange['encoding'] = 'base64'
+        line = json.dumps(exchange, ensure_ascii=False,
+                          separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._output is None:
+                if os.path.exists(self.path):
+                    _close_last_session(self.path)
+                self._output = gzip.open(self.path, 'at', encoding='utf-8')
+                self._output.write(json.dumps({
+                    'format': ARCHIVE_FORMAT,
+                    'version': ARCHIVE_VERSION,
+                    'created': datetime.datetime.now(
+                        datetime.timezone.utc).isoformat()
+                }) + '\n')
+            self._output.write(line)
+            # A sync flush costs a little compression, but an import that
+            # crashes keeps everything it recorded up to then.
+            self._output.flush()
+
+    def replay(self, url: str) -> tuple:
+        '''
+        Return the next recorded (response, elapsed) for url. The responses
+        to a URL that was requested more than once are replayed in the same
+        order, and the last one is repeated once they run out. A recorded
+        error is raised again. A URL that was never recorded raises a
+        LookupError, which provider_http does not retry.
+        '''
+        with self._lock:
+            if self._replay is None:
+                self._load()
+            recorded = self._replay.get(url)
+            if not recorded:
+                raise LookupError(f"No recorded response for {url} in "
+                                  f"{self.path}.")
+            exchange = recorded.popleft() if len(recorded) > 1 \
+                else recorded[0]
+        if 'error' in exchange:
+            raise REPLAYED_ERRORS.get(exchange['error'],
+                                      requests.ConnectionError)(
+                exchange.get('message', ''))
+        return _to_response(url, exchange), exchange.get('elapsed', 0.0)
+
+    def _load(self) -> None:
+        self._replay = collections.defaultdict(collections.deque)
+        count = 0
+        for exchange in self.exchanges():
+            self._replay[exchange['url']].append(exchange)
+            count += 1
+        logger.info(f"Loaded {count} recorded exchanges for "
+                    f"{len(self._replay)} URLs from {self.path}.")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._output is not None:
+                self._output.close()
+                self._output = None
+            self._replay = None
+
+
+def _complete_length(path: str) -> int:
+    '''
+    Return the number of bytes at the start of the gzip file at path that
+    are complete gzip members.
+    '''
+    complete = 0
+    position = 0
+    decompressor = zlib.decompressobj(wbits=31)
+    with open(path, 'rb') as archive_file:
+        while True:
+            chunk = archive_file.read(_CHUNK_SIZE)
+            if not chunk:
+                return complete
+            while chunk:
+                try:
+                    decompressor.decompress(chunk)
+                except zlib.error:
+                    return complete
+                if not decompressor.eof:
+                    position += len(chunk)
+                    break
+                # The member ended; the rest of chunk starts the next one.
+                position += len(chunk) - len(decompressor.unused_data)
+                complete = position
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+
+
+def _close_last_session(path: str) -> None:
+    '''
+    If the archive at path ends in a gzip member without an end, replace it
+    with a complete member holding every whole line it got as far as.
+    '''
+    complete = _complete_length(path)
+    if complete == os.path.getsize(path):
+        return
+    logger.warning(f"WARNING: {path} was not closed properly. Keeping what "
+                   "was recorded up to then.")
+    with open(path, 'r+b') as archive_file, \
+            tempfile.TemporaryFile() as salvaged:
+        archive_file.seek(complete)
+        decompressor = zlib.decompressobj(wbits=31)
+        end_of_lines = 0
+        try:
+            while True:
+                chunk = archive_file.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                lines = decompressor.decompress(chunk)
+                if b'\n' in lines:
+                    end_of_lines = salvaged.tell() + lines.rindex(b'\n') + 1
+                salvaged.write(lines)
+        except zlib.error:
+            pass  # Nothing that can be read follows.
+        salvaged.truncate(end_of_lines)
+        salvaged.seek(0)
+        archive_file.seek(complete)
+        archive_file.truncate()
+        if end_of_lines:
+            with gzip.GzipFile(fileobj=archive_file, mode='wb') as member:
+                shutil.copyfileobj(salvaged, member)
+
+
+def _to_response(url: str, exchange: dict) -> requests.Response:
+    response = requests.Response()
+    response.url = url
+    response.status_code = exchange['status']
+    response.headers.update(exchange.get('headers', {}))
+    body = exchange.get('body', '')
+    response._content = body if isinstance(body, bytes) \
+        else body.encode('utf-8')
+    response.encoding = 'utf-8'
+    response.reason = 'Replayed'
+    return response
@@ -0,0 +1,109 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import bulk_lookup
+import identifiers
+import lookup_data
+from benchmarks.catalog import synthetic_catalog
+from benchmarks.stand_in import provider_stand_in
+from merge_policy import merge_policy
+from tosho_database import tosho_database
+
+
+class bulk_lookup_test(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = synthetic_catalog(500, seed=1)
+        self.stand_in = provider_stand_in(self.catalog)
+        self.stand_in.start()
+        self.addCleanup(self.stand_in.stop)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_path = temp_dir.name + '/'
+
+    def test_failing_writer_stops_the_run(self):
+        # More books than fit into the write queue, so that the fetchers
+        # block on it once the writer is gone.
+        isbns = [self.catalog.isbn(index) for index in range(200)]
+        outcome = {}
+
+        def run():
+            try:
+                bulk_lookup.bulk_lookup(isbns, self.db_path, 'bulk.db',
+                                        concurrency=4, queue_size=2,
+                                        batch_size=1)
+            except Exception as e:
+                outcome['error'] = e
+
+        with mock.patch.object(tosho_database, 'add_records',
+                               side_effect=RuntimeError("disk full")):
+            runner = threading.Thread(target=run, daemon=True)
+            runner.start()
+            runner.join(timeout=30)
+        self.assertFalse(runner.is_alive(), "the bulk lookup hangs")
+        self.assertIsInstance(outcome.get('error'), RuntimeError)
+
+    def test_run_finishes(self):
+        isbns = [self.catalog.isbn(index) for index in range(20)]
+        summary = bulk_lookup.bulk_lookup(isbns, self.db_path, 'bulk.db',
+                                          concurrency=4, batch_size=5)
+        self.assertEqual(summary['looked_up'], 20)
+        self.assertEqual(summary['written'], 20)
+
+    def test_books_in_the_catalog_are_not_looked_up(self):
+        isbns = [self.catalog.isbn(index) for index in range(10)]
+        bulk_lookup.bulk_lookup(isbns, self.db_path, 'bulk.db')
+        requests = self.stand_in.requests
+        # Five new books, and the first five again as ISBN-10s.
+        isbns = [self.catalog.isbn(index) for index in range(5, 15)] + \
+            [identifiers.isbn13_to_isbn10(self.catalog.isbn(index))
+             for index in range(5)]
+        summary = bulk_lookup.bulk_lookup(isbns, self.db_path, 'bulk.db')
+        self.assertEqual(summary['in_catalog'], 10)
+        self.assertEqual(summary['looked_up'], 5)
+        self.assertEqual(summary['written'], 15)
+        self.assertEqual(self.stand_in.requests - requests,
+                         5 * len(lookup_data.PROVIDERS))
+        with tosho_database(self.db_path, 'bulk.db') as database:
+            with database.reading() as db_cursor:
+                db_cursor.execute("SELECT COUNT(*) FROM Books")
+                self.assertEqual(db_cursor.fetchone()[0], 15)
+                db_cursor.execute("SELECT COUNT(*) FROM Volumes")
+                self.assertEqual(db_cursor.fetchone()[0], 25)
+
+    def test_conflicts_of_copies_are_written_once(self):
+        self.stand_in.disagreement_rate = 1.0
+        # The publishers then differ in every book.
+        policy = merge_policy(field_rules={'publisher': 'precedence'})
+        # Both books with their copies are more than a batch.
+        isbns = [self.catalog.isbn(index) for index in (3, 4)] * 5
+        summary = bulk_lookup.bulk_lookup(isbns, self.db_path, 'bulk.db',
+                                          batch_size=3, policy=policy)
+        self.assertEqual(summary['written'], 10)
+        self.assertEqual(summary['conflicts'], 2)
+        with tosho_database(self.db_path, 'bulk.db') as database:
+            with database.reading() as db_cursor:
+                db_cursor.execute("SELECT COUNT(*) FROM MergeConflicts")
+                self.assertEqual(db_cursor.fetchone()[0],
+                                 summary['conflicts'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+import unittest
+from unittest import mock
+import pytest
+import identifiers
+
+
+def _mixed_isbns(count: int, seed: int = 0) -> list:
+    '''
+    Return count ISBNs: valid and invalid ISBN-10s and ISBN-13s, written
+    in different ways, and some things that are no ISBN at all.
+    '''
+    rng = random.Random(seed)
+    isbns = []
+    for _ in range(count):
+        kind = rng.randrange(5)
+        if kind == 0:
+            first_9 = ''.join(rng.choice('0123456789') for _ in range(9))
+            isbn = first_9 + identifiers._isbn10_check_digit(first_9)
+        else:
+            first_12 = rng.choice(('978', '979')) + \
+                ''.join(rng.choice('0123456789') for _ in range(9))
+            isbn = first_12 + identifiers._isbn13_check_digit(first_12)
+        if kind == 2:
+            # A wrong check digit.
+            isbn = isbn[:-1] + str((int(isbn[-1]) + 1) % 10)
+        elif kind == 3:
+            isbn = f"{isbn[:3]}-{isbn[3:7]} {isbn[7:]}".lower()
+        elif kind == 4 and rng.random() < 0.5:
+            isbn = rng.choice(('', 'n/a', '12345', None, isbn + '0'))
+        isbns.append(isbn)
+    return isbns
+
+
+class identifiers_test(unittest.TestCase):
+
+    def test_isbn_10_check_digit(self):
+        self.assertTrue(identifiers.is_valid_isbn('0306406152'))
+        self.assertTrue(identifiers.is_valid_isbn('0-8044-2957-x'))
+        self.assertFalse(identifiers.is_valid_isbn('0306406153'))
+        self.assertFalse(identifiers.is_valid_isbn('030640615'))
+
+    def test_isbn_13_check_digit(self):
+        self.assertTrue(identifiers.is_valid_isbn('978-0-306-40615-7'))
+        self.assertFalse(identifiers.is_valid_isbn('9780306406158'))
+        self.assertFalse(identifiers.is_valid_isbn('978030640615X'))
+
+    def test_conversion(self):
+        self.assertEqual(identifiers.isbn10_to_isbn13('0306406152'),
+                         '9780306406157')
+        self.assertEqual(identifiers.isbn10_to_isbn13('080442957X'),
+                         '9780804429573')
+        self.assertEqual(identifiers.isbn13_to_isbn10('9780804429573'),
+                         '080442957X')
+        # 979 ISBNs have no ISBN-10.
+        self.assertTrue(identifiers.is_valid_isbn('9791034304301'))
+        self.assertIsNone(identifiers.isbn13_to_isbn10('9791034304301'))
+
+    def test_canonical_isbn(self):
+        for raw_isbn in ('0306406152', '0-306-40615-2', ' 9780306406157 ',
+                         '978-0306406157'):
+            self.assertEqual(identifiers.canonical_isbn(raw_isbn),
+                             '9780306406157')
+        for raw_isbn in (None, '', 'n/a', '0306406153', '97803064061570'):
+            self.assertIsNone(identifiers.canonical_isbn(raw_isbn))
+
+    def test_dedupe_isbns(self):
+        counts, invalid = identifiers.dedupe_isbns(
+            ['0306406152', '9780306406157', 'n/a', '978-0-306-40615-7',
+             '080442957X'])
+        self.assertEqual(counts, {'9780306406157': 3, '9780804429573': 1})
+        self.assertEqual(invalid, ['n/a'])
+
+    def test_python_path_matches_canonical_isbn(self):
+        isbns = _mixed_isbns(500)
+        with mock.patch.object(identifiers, 'numpy', None):
+            validated = identifiers.validate_isbns(isbns)
+        self.assertEqual(validated,
+                         [identifiers.canonical_isbn(isbn) for isbn in isbns])
+
+    def test_numpy_path_matches_python_path(self):
+        pytest.importorskip('numpy')
+        isbns = _mixed_isbns(500, seed=1)
+        self.assertGreaterEqual(len(isbns), identifiers.VECTORIZE_THRESHOLD)
+        with mock.patch.object(identifiers, '_validate_isbns_numpy',
+                               wraps=identifiers._validate_isbns_numpy) \
+                as vectorised:
+            validated = identifiers.validate_isbns(isbns)
+        vectorised.assert_called_once()
+        self.assertEqual(validated,
+                         [identifiers.canonical_isbn(isbn) for isbn in isbns])
+        self.assertTrue(any(validated))
+        self.assertIn(None, validated)
+
+    def test_numpy_path_handles_x_check_digits(self):
+        pytest.importorskip('numpy')
+        isbns = ['080442957X', '080442957x', '0804429570'] * 30
+        self.assertEqual(identifiers.validate_isbns(isbns),
+                         ['9780804429573', '9780804429573', None] * 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tempfile
+import unittest
+from unittest import mock
+import lookup_data
+import provider_cache
+import tosho_query
+from benchmarks.catalog import synthetic_catalog
+from benchmarks.stand_in import provider_stand_in
+from merge_policy import merge_policy
+from tosho_database import tosho_database
+
+
+class lookup_data_test(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = synthetic_catalog(50, seed=1)
+        self.stand_in = provider_stand_in(self.catalog)
+        self.stand_in.start()
+        self.addCleanup(self.stand_in.stop)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_path = temp_dir.name + '/'
+        cache = provider_cache.configure_cache(temp_dir.name + '/cache.db')
+        self.addCleanup(cache.close)
+        self.addCleanup(provider_cache.set_cache_mode, 'bypass')
+
+    def test_misses_of_isbn_10_are_remembered(self):
+        # Not in the catalog, so neither provider knows it.
+        for _ in range(2):
+            provider_results = lookup_data.query_providers('isbn',
+                                                           '0306406152')
+            self.assertEqual(provider_results,
+                             {name: {} for name in lookup_data.PROVIDERS})
+        self.assertEqual(self.stand_in.requests, len(lookup_data.PROVIDERS))
+
+    def test_add_to_catalog_keeps_conflicts(self):
+        self.stand_in.disagreement_rate = 1.0
+        # The publishers then differ in every book.
+        policy = merge_policy(field_rules={'publisher': 'precedence'})
+        isbn = self.catalog.isbn(3)
+        with mock.patch.object(lookup_data, 'DEFAULT_POLICY', policy), \
+                tosho_database(self.db_path, 'catalog.db') as database:
+            found_book, is_new = lookup_data.add_to_catalog(database, 'isbn',
+                                                            isbn)
+            self.assertTrue(is_new)
+            with database.reading() as db_cursor:
+                db_cursor.execute("SELECT Field, Identifier FROM "
+                                  "MergeConflicts")
+                self.assertEqual(db_cursor.fetchall(), [('publisher', isbn)])
+
+    def test_add_to_catalog_asks_the_write_whether_a_book_is_new(self):
+        isbn = self.catalog.isbn(3)
+        with tosho_database(self.db_path, 'catalog.db') as database:
+            self.assertTrue(lookup_data.add_to_catalog(database, 'isbn',
+                                                       isbn)[1])
+            # As if another writer added the book during the lookup.
+            with mock.patch.object(tosho_query, 'find_book_id',
+                                   return_value=None):
+                found_book, is_new = lookup_data.add_to_catalog(database,
+                                                                'isbn', isbn)
+            self.assertFalse(is_new)
+            with database.reading() as db_cursor:
+                db_cursor.execute("SELECT COUNT(*) FROM Books")
+                self.assertEqual(db_cursor.fetchone()[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tempfile
+import unittest
+import tosho_query
+import tosho_sqlite
+from merge_policy import merge_policy, DEFAULT_POLICY
+
+
+def _results(**fields) -> dict:
+    '''
+    Return the results of both providers. Each keyword is a field with a
+    tuple of the Open Library and the Google Books value.
+    '''
+    return {
+        'openlibrary': {field: values[0] for field, values in fields.items()},
+        'googlebooks': {field: values[1] for field, values in fields.items()}
+    }
+
+
+class merge_policy_test(unittest.TestCase):
+
+    def merge(self, policy=DEFAULT_POLICY, **fields) -> tuple:
+        return policy.merge(_results(**fields))
+
+    def test_agreement_has_no_conflicts(self):
+        merged, conflicts = self.merge(title=("Hi no Tori", "Hi no Tori"),
+                                       pages=(400, 400))
+        self.assertEqual(merged, {'title': "Hi no Tori", 'pages': 400})
+        self.assertEqual(conflicts, [])
+
+    def test_nobody_knows_the_book(self):
+        self.assertEqual(DEFAULT_POLICY.merge({'openlibrary': {},
+                                               'googlebooks': {}}), ({}, []))
+
+    def test_unknown_values_are_filled_in(self):
+        merged, conflicts = self.merge(publisher=("UNKNOWN", "Kadokawa"),
+                                       pages=(0, 400),
+                                       publish_date=("UNKNOWN", "UNKNOWN"))
+        self.assertEqual(merged, {'publisher': "Kadokawa", 'pages': 400,
+                                  'publish_date': "UNKNOWN"})
+        self.assertEqual(conflicts, [])
+
+    def test_longest_takes_the_more_complete_value(self):
+        merged, conflicts = self.merge(publisher=("Vertical",
+                                                  "vertical,  Inc."))
+        self.assertEqual(merged['publisher'], "vertical,  Inc.")
+        self.assertEqual(conflicts, [])
+        merged, conflicts = self.merge(publisher=("Vertical", "Kodansha"))
+        self.assertEqual(merged['publisher'], "Vertical")
+        self.assertEqual(conflicts, [{
+            'field': 'publisher',
+            'candidates': {'openlibrary': "Vertical",
+                           'googlebooks': "Kodansha"},
+            'chosen': "Vertical",
+            'rule': 'longest'
+        }])
+
+    def test_authors_are_united(self):
+        merged, conflicts = self.merge(authors=(
+            ["Osamu Tezuka"], ["OSAMU TEZUKA", "Frederik L. Schodt"]))
+        self.assertEqual(merged['authors'],
+                         ["Osamu Tezuka", "Frederik L. Schodt"])
+        self.assertEqual(conflicts, [])
+        merged, conflicts = self.merge(authors=(["Osamu Tezuka"],
+                                                ["Frederik L. Schodt"]))
+        self.assertEqual(merged['authors'],
+                         ["Osamu Tezuka", "Frederik L. Schodt"])
+        self.assertEqual([c['field'] for c in conflicts], ['authors'])
+
+    def test_page_tolerance(self):
+        # Within PAGE_SLACK pages, or within PAGE_TOLERANCE of the count.
+        for pages, conflicting in [((20, 25), False), ((20, 26), True),
+                                   ((400, 440), False), ((400, 445), True)]:
+            merged, conflicts = self.merge(pages=pages)
+            self.assertEqual(merged['pages'], pages[0])
+            self.assertEqual(bool(conflicts), conflicting, pages)
+        policy = merge_policy(page_tolerance=0.0, page_slack=0)
+        self.assertTrue(self.merge(policy, pages=(400, 401))[1])
+
+    def test_identifiers_are_filled_in(self):
+        merged, conflicts = self.merge(identifiers=(
+            {'isbn_13': '978-0-306-40615-7', 'isbn_10': None},
+            {'isbn_13': '9780306406157', 'isbn_10': '0306406152'}))
+        self.assertEqual(merged['identifiers']['isbn_13'],
+                         '978-0-306-40615-7')
+        self.assertEqual(merged['identifiers']['isbn_10'], '0306406152')
+        self.assertEqual(conflicts, [])
+        merged, conflicts = self.merge(identifiers=(
+            {'lccn': '67012345'}, {'lccn': '67012346'}))
+        self.assertEqual(merged['identifiers']['lccn'], '67012345')
+        self.assertEqual([c['field'] for c in conflicts], ['identifiers'])
+
+    def test_precedence(self):
+        policy = merge_policy(precedence=('googlebooks', 'openlibrary'),
+                              field_precedence={'title': ('openlibrary',)},
+                              field_rules={'publisher': 'precedence'})
+        merged, conflicts = self.merge(policy, title=("Kokoro", "Kokoro 2"),
+                                       publisher=("Vertical", "Kodansha"))
+        # Kokoro 2 contains Kokoro, so it is the more complete title.
+        self.assertEqual(merged, {'title': "Kokoro 2",
+                                  'publisher': "Kodansha"})
+        self.assertEqual([(c['field'], c['rule']) for c in conflicts],
+                         [('publisher', 'precedence')])
+        merged, conflicts = self.merge(policy, title=("Kokoro", "Phoenix"))
+        self.assertEqual(merged['title'], "Kokoro")
+        self.assertEqual(conflicts[0]['chosen'], "Kokoro")
+
+    def test_rule_functions(self):
+        def shortest(values, policy):
+            return min((value for provider, value in values), key=len), True
+
+        policy = merge_policy(field_rules={'title': shortest})
+        merged, conflicts = self.merge(policy, title=("Kokoro", "Kokoro 2"))
+        self.assertEqual(merged['title'], "Kokoro")
+        self.assertEqual(conflicts[0]['rule'], 'shortest')
+
+    def test_conflicts_are_queued_for_review(self):
+        merged, conflicts = self.merge(title=("Kokoro", "Phoenix"),
+                                       authors=(["Natsume Sōseki"],
+                                                ["Osamu Tezuka"]))
+        self.assertEqual(len(conflicts), 2)
+        for conflict in conflicts:
+            conflict['id_type'] = 'isbn'
+            conflict['identifier'] = '9784003101117'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_conn = tosho_sqlite.connect_to_database(temp_dir + '/',
+                                                       'review.db')
+            try:
+                db_cursor = db_conn.cursor()
+                tosho_sqlite.add_merge_conflicts_to_table(db_cursor,
+                                                          conflicts)
+                db_conn.commit()
+                queued = tosho_query.get_merge_conflicts(db_cursor)
+            finally:
+                db_conn.close()
+        self.assertEqual([(c['field'], c['candidates'], c['chosen'],
+                           c['rule'], c['identifier'], c['resolved'])
+                          for c in queued],
+                         [(c['field'], c['candidates'], c['chosen'],
+                           c['rule'], c['identifier'], False)
+                          for c in conflicts])
+
+
+if __name__ == '__main__':
+    unittest.main()
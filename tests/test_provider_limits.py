@@ -0,0 +1,186 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import email.utils
+import time
+import unittest
+from unittest import mock
+import provider_http
+import provider_limits
+from provider_limits import rate_limiter, RATE_DECREASE, RATE_INCREASE
+
+
+class fake_clock:
+    '''
+    Stands in for the time module: sleeping only moves the clock forward.
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class fake_response:
+
+    def __init__(self, status_code: int, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class rate_limiter_test(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock()
+        patcher = mock.patch.object(provider_limits, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def succeed_for(self, limiter: rate_limiter, seconds: int) -> None:
+        '''
+        Send requests at the rate of limiter for seconds, all of them
+        successful.
+        '''
+        for _ in range(seconds):
+            for _ in range(round(limiter.rate)):
+                limiter.succeeded()
+
+    def test_burst_then_rate(self):
+        limiter = rate_limiter('test', rate=4.0, burst=4)
+        waits = [limiter.acquire() for _ in range(6)]
+        self.assertEqual(waits[:4], [0.0] * 4)
+        self.assertAlmostEqual(waits[4], 0.25)
+        self.assertAlmostEqual(waits[5], 0.25)
+
+    def test_slow_start_doubles_every_second(self):
+        limiter = rate_limiter('test', rate=2.0, max_rate=50.0)
+        rates = []
+        for _ in range(4):
+            self.succeed_for(limiter, 1)
+            rates.append(limiter.rate)
+        self.assertEqual(rates, [4.0, 8.0, 16.0, 32.0])
+        self.succeed_for(limiter, 1)
+        self.assertEqual(limiter.rate, 50.0)
+
+    def test_throttling_cuts_the_rate_once_per_cooldown(self):
+        limiter = rate_limiter('test', rate=10.0)
+        limiter.throttled(429)
+        # Answers to requests sent before the cut.
+        limiter.throttled(429)
+        limiter.throttled(503)
+        self.assertAlmostEqual(limiter.rate, 10.0 * RATE_DECREASE)
+        self.clock.now += provider_limits.DECREASE_COOLDOWN
+        limiter.throttled(429)
+        self.assertAlmostEqual(limiter.rate, 10.0 * RATE_DECREASE ** 2)
+
+    def test_rate_stays_within_bounds(self):
+        limiter = rate_limiter('test', rate=1.0, min_rate=0.5)
+        for _ in range(5):
+            limiter.throttled(429)
+            self.clock.now += 10
+        self.assertEqual(limiter.rate, 0.5)
+        self.assertEqual(rate_limiter('test', rate=100.0,
+                                      max_rate=20.0).rate, 20.0)
+
+    def test_additive_increase_after_throttling(self):
+        limiter = rate_limiter('test', rate=10.0)
+        limiter.throttled(429)
+        throttled_rate = limiter.rate
+        self.succeed_for(limiter, 4)
+        # About RATE_INCREASE per second, instead of doubling.
+        self.assertAlmostEqual(limiter.rate,
+                               throttled_rate + 4 * RATE_INCREASE, delta=0.25)
+
+    def test_recovers_after_a_throttling_spell(self):
+        limiter = rate_limiter('test', rate=10.0)
+        for _ in range(3):
+            limiter.throttled(503)
+            self.clock.now += 2
+        low_rate = limiter.rate
+        self.assertLess(low_rate, 4.0)
+        self.succeed_for(limiter, 30)
+        self.assertGreater(limiter.rate, low_rate + 10)
+
+    def test_retry_after_pauses_the_bucket(self):
+        limiter = rate_limiter('test', rate=4.0, burst=4)
+        limiter.throttled(429, retry_after=10.0)
+        self.assertGreaterEqual(limiter.acquire(), 10.0)
+        self.assertGreaterEqual(sum(self.clock.slept), 10.0)
+        # No burst right after being throttled.
+        self.assertGreater(limiter.acquire(), 0.0)
+
+
+class provider_http_test(unittest.TestCase):
+
+    def test_adapt(self):
+        limiter = mock.Mock(spec=rate_limiter)
+        provider_http._adapt(limiter, fake_response(429,
+                                                    {'Retry-After': '3'}))
+        limiter.throttled.assert_called_once_with(429, 3.0)
+        provider_http._adapt(limiter, fake_response(200))
+        limiter.succeeded.assert_called_once_with()
+        # Other server errors say nothing about the rate.
+        provider_http._adapt(limiter, fake_response(500))
+        self.assertEqual(limiter.throttled.call_count, 1)
+        self.assertEqual(limiter.succeeded.call_count, 1)
+
+    def test_retry_after(self):
+        self.assertEqual(provider_http._retry_after(fake_response(429)), 0.0)
+        self.assertEqual(provider_http._retry_after(
+            fake_response(429, {'Retry-After': 'soon'})), 0.0)
+        self.assertEqual(provider_http._retry_after(
+            fake_response(429, {'Retry-After': '100000'})),
+            provider_http.RETRY_AFTER_MAX)
+        retry_at = email.utils.formatdate(time.time() + 20, usegmt=True)
+        self.assertAlmostEqual(provider_http._retry_after(
+            fake_response(503, {'Retry-After': retry_at})), 20, delta=2)
+
+
+class limiter_for_test(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(
+            provider_limits, _enabled=True, INITIAL_RATE=4.0, MIN_RATE=0.1,
+            MAX_RATE=25.0, BURST=4, _limiters={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_limiter_per_provider(self):
+        limiter = provider_limits.limiter_for('openlibrary')
+        self.assertIs(provider_limits.limiter_for('openlibrary'), limiter)
+        self.assertIsNot(provider_limits.limiter_for('googlebooks'), limiter)
+        self.assertIsNone(provider_limits.limiter_for(''))
+
+    def test_configure_rate_limits(self):
+        limiter = provider_limits.limiter_for('openlibrary')
+        provider_limits.configure_rate_limits(initial_rate=2.0, burst=1)
+        new_limiter = provider_limits.limiter_for('openlibrary')
+        self.assertIsNot(new_limiter, limiter)
+        self.assertEqual((new_limiter.rate, new_limiter.burst), (2.0, 1))
+        provider_limits.configure_rate_limits(enabled=False)
+        self.assertIsNone(provider_limits.limiter_for('openlibrary'))
+        with self.assertRaises(ValueError):
+            provider_limits.configure_rate_limits(min_rate=5.0, max_rate=1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
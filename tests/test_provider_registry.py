@@ -0,0 +1,172 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import lookup_data
+import provider_registry
+from provider_registry import circuit_breaker, latency_tracker, \
+    registered_provider, FAILURE_THRESHOLD, MIN_SAMPLES
+
+
+class scripted_lookup:
+    '''
+    A provider lookup that takes the next of delays seconds for each call
+    (the last one for all calls after that), or raises if the delay is an
+    exception. Lookups still waiting are let go when the test ends.
+    '''
+
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.released = threading.Event()
+
+    def __call__(self, idtype: str, bookid):
+        with self._lock:
+            delay = self.delays[min(self.calls, len(self.delays) - 1)]
+            self.calls += 1
+            call = self.calls
+        if isinstance(delay, Exception):
+            raise delay
+        self.released.wait(delay)
+        return {'title': f"Answer {call}"}
+
+
+class registry_test(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.pool.shutdown, wait=False)
+
+    def provider(self, lookup: scripted_lookup,
+                 hedge: bool = True) -> registered_provider:
+        self.addCleanup(lookup.released.set)
+        provider = registered_provider('test', lookup, hedge)
+        # Lookups usually take 10 ms.
+        for _ in range(MIN_SAMPLES):
+            provider.latencies.add(0.01)
+        return provider
+
+    def test_latency_percentile(self):
+        latencies = latency_tracker()
+        for index in range(MIN_SAMPLES - 1):
+            latencies.add(index / 100)
+        self.assertIsNone(latencies.percentile())
+        latencies.add(0.19)
+        self.assertEqual(latencies.percentile(0.95), 0.19)
+
+    def test_slow_lookup_is_hedged(self):
+        lookup = scripted_lookup(30.0, 0.0)
+        provider = self.provider(lookup)
+        started = time.monotonic()
+        result = provider.submit(self.pool, 'isbn', '9780306406157',
+                                 5.0).result(timeout=5)
+        self.assertEqual(result, {'title': "Answer 2"})
+        self.assertLess(time.monotonic() - started, 2.0)
+        self.assertEqual(lookup.calls, 2)
+
+    def test_hedges_are_limited_by_the_budget(self):
+        lookup = scripted_lookup(0.5)
+        provider = self.provider(lookup)
+        for _ in range(3):
+            provider.submit(self.pool, 'isbn', '9780306406157',
+                            5.0).result(timeout=5)
+        # The first lookup spent the only hedge there was.
+        self.assertEqual(lookup.calls, 4)
+
+    def test_no_hedging_when_turned_off(self):
+        lookup = scripted_lookup(0.3)
+        provider = self.provider(lookup, hedge=False)
+        provider.submit(self.pool, 'isbn', '9780306406157',
+                        5.0).result(timeout=5)
+        self.assertEqual(lookup.calls, 1)
+
+    def test_hedge_can_answer_for_a_failed_attempt(self):
+        lookup = scripted_lookup(0.5, RuntimeError("broken"))
+        provider = self.provider(lookup)
+        # The first attempt is still pending when the hedge fails.
+        self.assertEqual(provider.submit(self.pool, 'isbn', '9780306406157',
+                                         5.0).result(timeout=5),
+                         {'title': "Answer 1"})
+        self.assertEqual(provider.breaker.state, 'closed')
+
+    def test_breaker_opens_and_recovers(self):
+        breaker = circuit_breaker('test')
+        with mock.patch.object(provider_registry, 'OPEN_SECONDS', 0.1):
+            for _ in range(FAILURE_THRESHOLD - 1):
+                breaker.failed()
+            self.assertTrue(breaker.allow())
+            breaker.failed()
+            self.assertEqual(breaker.state, 'open')
+            self.assertFalse(breaker.allow())
+            time.sleep(0.15)
+            # One trial lookup, and no other until it answered.
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            # A failed trial opens it again right away.
+            breaker.failed()
+            self.assertEqual(breaker.state, 'open')
+            time.sleep(0.15)
+            self.assertTrue(breaker.allow())
+            breaker.succeeded()
+            self.assertEqual(breaker.state, 'closed')
+            self.assertTrue(breaker.allow())
+            # The count starts over.
+            breaker.failed()
+            self.assertEqual(breaker.state, 'closed')
+
+    def test_failed_lookups_open_the_breaker(self):
+        lookup = scripted_lookup(RuntimeError("broken"))
+        provider = self.provider(lookup)
+        for _ in range(FAILURE_THRESHOLD):
+            self.assertTrue(provider.allow())
+            with self.assertRaises(RuntimeError):
+                provider.submit(self.pool, 'isbn', '9780306406157',
+                                5.0).result(timeout=5)
+        self.assertFalse(provider.allow())
+
+    def test_deadline(self):
+        slow = scripted_lookup(30.0)
+        fast = scripted_lookup(0.0)
+        with mock.patch.dict(lookup_data.PROVIDERS, clear=True), \
+                mock.patch.object(provider_registry, 'FAILURE_THRESHOLD', 1):
+            provider_registry.register_provider('slow', slow, hedge=False)
+            provider_registry.register_provider('fast', fast)
+            self.addCleanup(slow.released.set)
+            started = time.monotonic()
+            provider_results = lookup_data.query_providers(
+                'isbn', '9780306406157', deadline=0.2)
+            self.assertLess(time.monotonic() - started, 2.0)
+            self.assertEqual(provider_results,
+                             {'slow': {}, 'fast': {'title': "Answer 1"}})
+            slow_provider = lookup_data.PROVIDERS['slow']
+            self.assertEqual(slow_provider.breaker.state, 'open')
+            # Answering after the deadline does not close the breaker.
+            slow.released.set()
+            time.sleep(0.1)
+            self.assertEqual(slow_provider.breaker.state, 'open')
+            self.assertEqual(lookup_data.query_providers(
+                'isbn', '9780306406157', deadline=0.2),
+                {'slow': {}, 'fast': {'title': "Answer 2"}})
+            self.assertEqual(slow.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+from provider_traffic import traffic_archive
+
+
+class traffic_archive_test(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'import.traffic.gz')
+
+    def record(self, archive: traffic_archive, *urls) -> None:
+        for url in urls:
+            archive.record('openlibrary', url, 0.0, 0.1,
+                           error=requests.Timeout("too slow"))
+
+    def crashed_archive(self, *urls) -> None:
+        '''
+        Leave an archive at self.path as a recording session that crashed
+        after recording urls.
+        '''
+        archive = traffic_archive(self.path + '.live')
+        self.record(archive, *urls)
+        shutil.copy(self.path + '.live', self.path)
+        archive.close()
+
+    def urls(self) -> list:
+        return [exchange['url']
+                for exchange in traffic_archive(self.path).exchanges()]
+
+    def test_sessions_are_appended(self):
+        archive = traffic_archive(self.path)
+        self.record(archive, 'a', 'b')
+        archive.close()
+        with open(self.path, 'rb') as archive_file:
+            first_session = archive_file.read()
+        archive = traffic_archive(self.path)
+        self.record(archive, 'c')
+        archive.close()
+        with open(self.path, 'rb') as archive_file:
+            self.assertTrue(archive_file.read().startswith(first_session))
+        self.assertEqual(self.urls(), ['a', 'b', 'c'])
+
+    def test_recording_after_a_crash(self):
+        self.crashed_archive('a', 'b')
+        with self.assertLogs('provider_traffic', 'WARNING'):
+            archive = traffic_archive(self.path)
+            self.record(archive, 'c')
+        archive.close()
+        self.assertEqual(self.urls(), ['a', 'b', 'c'])
+
+    def test_recording_after_a_crash_in_a_later_session(self):
+        archive = traffic_archive(self.path + '.live')
+        self.record(archive, 'a')
+        archive.close()
+        self.crashed_archive('b')
+        archive = traffic_archive(self.path)
+        self.record(archive, 'c')
+        archive.close()
+        self.assertEqual(self.urls(), ['a', 'b', 'c'])
+
+    def test_recording_after_a_crash_in_the_gzip_header(self):
+        archive = traffic_archive(self.path)
+        self.record(archive, 'a')
+        archive.close()
+        with open(self.path, 'ab') as archive_file:
+            archive_file.write(b'\x1f\x8b\x08')
+        archive = traffic_archive(self.path)
+        self.record(archive, 'b')
+        archive.close()
+        self.assertEqual(self.urls(), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
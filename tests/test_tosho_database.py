@@ -0,0 +1,71 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tempfile
+import unittest
+import tosho_sqlite
+from book import book
+from tosho_database import tosho_database
+
+
+class writing_test(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.database = tosho_database(temp_dir.name + '/', 'test.db')
+        self.addCleanup(self.database.close)
+        self.book = book("Kokoro", ["Natsume Soseki"], "Iwanami Shoten",
+                         "1914", {'isbn_13': '9784003101117'}, 328)
+
+    def count(self, table: str) -> int:
+        with self.database.reading() as db_cursor:
+            db_cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            return db_cursor.fetchone()[0]
+
+    def test_helpers_that_commit_are_rolled_back(self):
+        with self.assertRaises(RuntimeError):
+            with self.database.writing() as db_cursor:
+                # Commits after every single statement on its own.
+                tosho_sqlite.add_record_to_database(
+                    db_cursor, self.book, 1, self.database.author_ids,
+                    self.database.publisher_ids)
+                tosho_sqlite.add_library_to_table(db_cursor, "Branch")
+                raise RuntimeError("cancelled")
+        for table in ('Books', 'Authors', 'Publishers', 'Volumes',
+                      'Collections'):
+            self.assertEqual(self.count(table), 0, table)
+        self.assertEqual(self.count('Libraries'), 1)
+        # The IDs of the rolled back rows are not handed out again.
+        self.assertIsNone(self.database.author_ids.get("Natsume Soseki"))
+        self.assertIsNone(self.database.publisher_ids.get("Iwanami Shoten"))
+
+    def test_block_is_committed_at_the_end(self):
+        with self.database.writing() as db_cursor:
+            tosho_sqlite.add_record_to_database(
+                db_cursor, self.book, 1, self.database.author_ids,
+                self.database.publisher_ids)
+            # Nothing is visible to readers before the block ends.
+            self.assertEqual(self.count('Books'), 0)
+        self.assertEqual(self.count('Books'), 1)
+        self.assertIsNotNone(self.database.author_ids.get("Natsume Soseki"))
+        # Outside writing() the helpers commit as before.
+        tosho_sqlite.add_library_to_table(self.database.cursor(), "Branch")
+        self.assertEqual(self.count('Libraries'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
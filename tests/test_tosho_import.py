@@ -0,0 +1,229 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import json
+import tempfile
+import unittest
+from unittest import mock
+import tosho_import
+from tosho_database import tosho_database
+
+_CSV = (
+    'Title,Authors,Publisher,ISBN,Pages\n'
+    'Hi no Tori,Osamu Tezuka,Kadokawa,0-306-40615-2,400\n'
+    '"Kokoro, a novel",Natsume Soseki; Edwin McClellan,,9784003101117,\n'
+    '"Two\nLines",Anonymous,Kodansha,,12\n'
+    ',Nobody,Untitled,,\n'
+)
+
+
+def _marc_record(fields: list) -> bytes:
+    '''
+    Return an ISO 2709 record of fields, a list of (tag, value) tuples. The
+    value of a data field is a tuple of its indicators and its subfields.
+    '''
+    directory = b''
+    data = b''
+    for tag, value in fields:
+        if isinstance(value, tuple):
+            indicators, subfields = value
+            value = indicators + ''.join(f'\x1f{code}{text}'
+                                         for code, text in subfields)
+        encoded = value.encode('utf-8') + b'\x1e'
+        directory += f'{tag}{len(encoded):04d}{len(data):05d}'.encode()
+        data += encoded
+    base_address = 24 + len(directory) + 1
+    length = base_address + len(data) + 1
+    leader = f'{length:05d}nam a22{base_address:05d}   4500'.encode()
+    return leader + directory + b'\x1e' + data + b'\x1d'
+
+
+_MARC = _marc_record([
+    ('001', 'ocm01234567'),
+    ('020', ('  ', [('a', '0306406152 (pbk.)')])),
+    ('035', ('  ', [('a', '(OCoLC)01234567')])),
+    ('100', ('1 ', [('a', 'Tezuka, Osamu,'), ('d', '1928-1989.')])),
+    ('245', ('10', [('a', 'Hi no tori :'), ('b', 'Phoenix /'),
+                    ('c', 'Osamu Tezuka.')])),
+    ('264', (' 1', [('a', 'Tokyo :'), ('b', 'Kadokawa,'), ('c', '[1967]')])),
+    ('300', ('  ', [('a', 'xii, 400 p. ;'), ('c', '18 cm')])),
+    ('700', ('1 ', [('a', 'Smith, J.')]))
+]) + b'\n' + _marc_record([
+    ('020', ('  ', [('a', '9784003101117')])),
+    ('245', ('00', [('a', 'Kokoro.')])),
+    ('260', ('  ', [('b', 'Iwanami Shoten,'), ('c', '1914.')]))
+]) + _marc_record([('500', ('  ', [('a', 'No title here.')]))])
+
+
+def _read(data: bytes, import_format: str, offset: int = 0) -> list:
+    return list(tosho_import.read_records(io.BytesIO(data), import_format,
+                                          offset))
+
+
+def _titles(records: list) -> list:
+    return [(offset, found_book and found_book.title)
+            for offset, found_book in records]
+
+
+class record_to_book_test(unittest.TestCase):
+
+    def test_isbn_10_in_the_isbn_13_column(self):
+        found_book = tosho_import.record_to_book(
+            {'Title': "Hi no Tori", 'isbn13': '0-306-40615-2'})
+        self.assertEqual(found_book.identifiers['isbn_13'], '9780306406157')
+        self.assertEqual(found_book.identifiers['isbn_10'], '0306406152')
+        found_book = tosho_import.record_to_book(
+            {'title': "Hi no Tori", 'isbn_13': '0306406153',
+             'isbn_10': '0306406152'})
+        # A wrong check digit is no ISBN-13 at all.
+        self.assertIsNone(found_book.identifiers['isbn_13'])
+        self.assertEqual(found_book.identifiers['isbn_10'], '0306406152')
+
+
+class read_records_test(unittest.TestCase):
+
+    def test_csv(self):
+        records = _read(_CSV.encode('utf-8'), 'csv')
+        self.assertEqual(len(records), 4)
+        hi_no_tori, kokoro, two_lines, untitled = \
+            [found_book for offset, found_book in records]
+        self.assertEqual(hi_no_tori.authors, ["Osamu Tezuka"])
+        self.assertEqual(hi_no_tori.identifiers['isbn_10'], '0306406152')
+        self.assertEqual(hi_no_tori.pages, 400)
+        self.assertEqual(kokoro.title, "Kokoro, a novel")
+        self.assertEqual(kokoro.authors,
+                         ["Natsume Soseki", "Edwin McClellan"])
+        self.assertEqual(kokoro.publisher, "UNKNOWN")
+        self.assertEqual(kokoro.identifiers['isbn_13'], '9784003101117')
+        self.assertEqual(two_lines.title, "Two\nLines")
+        self.assertIsNone(untitled)
+
+    def test_csv_resumes_after_a_row(self):
+        data = _CSV.encode('utf-8')
+        records = _read(data, 'csv')
+        for index, (offset, found_book) in enumerate(records):
+            self.assertEqual(_titles(_read(data, 'csv', offset)),
+                             _titles(records[index + 1:]))
+
+    def test_jsonl(self):
+        lines = [
+            {'title': "Hi no Tori", 'authors': ["Osamu Tezuka"],
+             'identifiers': {'isbn_13': '9780306406157', 'lccn': '67012345'},
+             'page_count': 400},
+            "not JSON",
+            [1, 2],
+            {'authors': "Nobody"},
+            {'title': "Kokoro", 'author': "Natsume Soseki",
+             'published': 1914}
+        ]
+        data = '\n\n'.join(line if isinstance(line, str)
+                            else json.dumps(line) for line in lines)
+        records = _read(data.encode('utf-8'), 'jsonl')
+        self.assertEqual(len(records), 5)
+        hi_no_tori, not_json, not_object, untitled, kokoro = \
+            [found_book for offset, found_book in records]
+        self.assertEqual(hi_no_tori.identifiers['isbn_13'], '9780306406157')
+        self.assertEqual(hi_no_tori.identifiers['lccn'], '67012345')
+        self.assertEqual(hi_no_tori.pages, 400)
+        self.assertEqual([not_json, not_object, untitled], [None] * 3)
+        self.assertEqual(kokoro.authors, ["Natsume Soseki"])
+        self.assertEqual(kokoro.publish_date, '1914')
+        self.assertEqual(records[-1][0], len(data.encode('utf-8')))
+
+    def test_marc(self):
+        records = _read(_MARC, 'marc')
+        self.assertEqual(len(records), 3)
+        hi_no_tori, kokoro, untitled = \
+            [found_book for offset, found_book in records]
+        self.assertEqual(hi_no_tori.title, "Hi no tori: Phoenix")
+        self.assertEqual(hi_no_tori.authors, ["Osamu Tezuka", "J. Smith"])
+        self.assertEqual(hi_no_tori.publisher, "Kadokawa")
+        self.assertEqual(hi_no_tori.publish_date, "1967")
+        self.assertEqual(hi_no_tori.pages, 400)
+        self.assertEqual({id_type: identifier for id_type, identifier
+                          in hi_no_tori.identifiers.items() if identifier},
+                         {'isbn_10': '0306406152', 'oclc': '01234567'})
+        self.assertEqual(kokoro.title, "Kokoro")
+        self.assertEqual(kokoro.publisher, "Iwanami Shoten")
+        self.assertEqual(kokoro.publish_date, "1914")
+        self.assertIsNone(untitled)
+        self.assertEqual(_titles(_read(_MARC, 'marc', records[0][0])),
+                         _titles(records[1:]))
+
+    def test_truncated_marc_stops(self):
+        records = _read(_MARC[:-10], 'marc')
+        self.assertEqual(len(records), 2)
+
+
+class import_file_test(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_path = temp_dir.name + '/'
+        self.source = self.db_path + 'books.jsonl'
+        with open(self.source, 'w') as source_file:
+            for index in range(10):
+                source_file.write(json.dumps({
+                    'title': f"Book {index}", 'authors': ["Anonymous"],
+                    'lccn': 1000 + index}) + '\n')
+
+    def counts(self) -> tuple:
+        with tosho_database(self.db_path, 'import.db') as database:
+            with database.reading() as db_cursor:
+                return tuple(db_cursor.execute(
+                    f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    for table in ('Books', 'Volumes'))
+
+    def test_interrupted_import_resumes(self):
+        add_records = tosho_database.add_records
+
+        def fail_third_batch(database, *args):
+            if fail_third_batch.calls == 2:
+                raise KeyboardInterrupt
+            fail_third_batch.calls += 1
+            return add_records(database, *args)
+
+        fail_third_batch.calls = 0
+        with mock.patch.object(tosho_database, 'add_records',
+                               fail_third_batch):
+            with self.assertRaises(KeyboardInterrupt):
+                tosho_import.import_file(self.source, self.db_path,
+                                         'import.db', batch_size=3)
+        self.assertEqual(self.counts(), (6, 6))
+        summary = tosho_import.import_file(self.source, self.db_path,
+                                           'import.db', batch_size=3)
+        self.assertEqual(summary['resumed_from'], 6)
+        self.assertEqual(summary['records'], 10)
+        self.assertEqual(summary['imported'], 10)
+        self.assertEqual(self.counts(), (10, 10))
+        # Nothing is left to import.
+        summary = tosho_import.import_file(self.source, self.db_path,
+                                           'import.db')
+        self.assertEqual(summary['resumed_from'], 10)
+        self.assertEqual(self.counts(), (10, 10))
+
+    def test_import_without_resume_starts_over(self):
+        tosho_import.import_file(self.source, self.db_path, 'import.db')
+        summary = tosho_import.import_file(self.source, self.db_path,
+                                           'import.db', resume=False)
+        self.assertEqual(summary['resumed_from'], 0)
+        self.assertEqual(self.counts(), (10, 20))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sqlite3
+import tempfile
+import unittest
+import tosho_query
+import tosho_sqlite
+from book import book
+
+# The tables whose BookID or VolumeID columns have no declared type.
+_JOIN_TABLES = ('ab', 'pb', 'v', 'c')
+
+
+class recording_cursor(sqlite3.Cursor):
+    '''
+    A cursor that remembers every query it ran.
+    '''
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.queries = []
+
+    def execute(self, sql, parameters=()):
+        self.queries.append((sql, parameters))
+        return super().execute(sql, parameters)
+
+
+def _books() -> list:
+    return [
+        book("Hi no Tori", ["Osamu Tezuka"], "Kadokawa", "1967",
+             {'isbn_13': '9780306406157', 'isbn_10': '0306406152'}, 400),
+        book("Kokoro", ["Natsume Soseki"], "Iwanami Shoten", "1914",
+             {'isbn_13': '9784003101117'}, 328),
+        book("Two Authors", ["Osamu Tezuka", "Natsume Soseki"], "Kadokawa",
+             "2001", {'isbn_10': '080442957X', 'lccn': 12345}, 120),
+        book("Journal", ["Anonymous"], None, "UNKNOWN",
+             {'issn': '0317-8471', 'oclc': 777}, 0)
+    ]
+
+
+class tosho_query_test(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_conn = tosho_sqlite.connect_to_database(temp_dir.name + '/',
+                                                        'query.db')
+        self.addCleanup(self.db_conn.close)
+
+    def add_books(self) -> sqlite3.Cursor:
+        '''
+        Add _books(), with a second copy of Kokoro in a library "Branch".
+        BookIDs count from 1 in the order of _books().
+        '''
+        tosho_sqlite.add_records_to_database(self.db_conn, _books())
+        db_cursor = self.db_conn.cursor()
+        branch_id = tosho_sqlite.add_library_to_table(db_cursor, "Branch")
+        tosho_sqlite.add_copy_to_database(db_cursor, 2, branch_id)
+        return db_cursor
+
+    def test_books_are_assembled(self):
+        db_cursor = self.add_books()
+        hi_no_tori, kokoro, two_authors, journal = \
+            tosho_query.get_books(db_cursor, [1, 2, 3, 4])
+        self.assertEqual(two_authors.authors,
+                         ["Osamu Tezuka", "Natsume Soseki"])
+        self.assertEqual(two_authors.publisher, "Kadokawa")
+        self.assertEqual(hi_no_tori.identifiers['isbn_10'], '0306406152')
+        self.assertEqual(kokoro.volume_count, 2)
+        self.assertEqual(kokoro.libraries, ["Branch", "Local"])
+        self.assertEqual(journal.publisher, "UNKNOWN")
+        self.assertEqual(journal.identifiers['issn'], '03178471')
+
+    def test_get_books_keeps_the_order_and_skips_missing_ids(self):
+        db_cursor = self.add_books()
+        self.assertEqual([found.book_id for found in tosho_query.get_books(
+            db_cursor, [3, 99, 1])], [3, 1])
+        self.assertIsNone(tosho_query.get_book(db_cursor, 99))
+
+    def test_find_book_id(self):
+        db_cursor = self.add_books()
+        # Either ISBN finds a book, whichever of them was stored.
+        for isbn, book_id in [('0-306-40615-2', 1), ('9780306406157', 1),
+                              ('4003101111', 2), ('9780804429573', 3),
+                              ('080442957x', 3)]:
+            self.assertEqual(tosho_query.find_book_id(db_cursor, 'isbn',
+                                                      isbn), book_id, isbn)
+        self.assertEqual(tosho_query.find_book_id(db_cursor, 'ISSN',
+                                                  '0317-8471'), 4)
+        self.assertEqual(tosho_query.find_book_id(db_cursor, 'lccn',
+                                                  12345), 3)
+        self.assertIsNone(tosho_query.find_book_id(db_cursor, 'isbn',
+                                                   '9784003101118'))
+        self.assertIsNone(tosho_query.find_book_id(db_cursor, 'oclc', 1))
+        with self.assertRaises(ValueError):
+            tosho_query.find_book_id(db_cursor, 'asin', 'B000000000')
+
+    def test_find_isbn_book_ids(self):
+        db_cursor = self.add_books()
+        self.assertEqual(tosho_query.find_isbn_book_ids(
+            db_cursor, ['9780306406157', '9780804429573', '9784003101118']),
+            {'9780306406157': 1, '9780804429573': 3})
+
+    def test_filters(self):
+        db_cursor = self.add_books()
+        for filters, book_ids in [({'author': "Osamu Tezuka"}, [1, 3]),
+                                  ({'publisher': "Kadokawa"}, [1, 3]),
+                                  ({'title': "kokoro"}, [2]),
+                                  ({'library_id': 2}, [2]),
+                                  ({'isbn_10': '0-306-40615-2'}, [1]),
+                                  ({'author': "Osamu Tezuka",
+                                    'title': "Two"}, [3]),
+                                  ({'author': "Nobody"}, [])]:
+            self.assertEqual([found.book_id for found
+                              in tosho_query.find_books(db_cursor,
+                                                        **filters)],
+                             book_ids, filters)
+            self.assertEqual(tosho_query.count_books(db_cursor, **filters),
+                             len(book_ids), filters)
+        with self.assertRaises(ValueError):
+            tosho_query.find_books(db_cursor, colour="red")
+
+    def test_iterators_and_pages(self):
+        db_cursor = self.add_books()
+        book_ids = [found.book_id for found
+                    in tosho_query.iter_books(db_cursor, batch_size=3)]
+        self.assertEqual(book_ids, [1, 2, 3, 4])
+        self.assertEqual([found.book_id for found in tosho_query.stream_books(
+            self.db_conn.cursor(), chunk_size=3)], book_ids)
+        self.assertEqual([[found.book_id for found
+                           in tosho_query.get_books_page(db_cursor, page,
+                                                         page_size=3)]
+                          for page in (1, 2, 3)], [[1, 2, 3], [4], []])
+        self.assertEqual([found.book_id for found in tosho_query.find_books(
+            db_cursor, limit=2)], [1, 2])
+
+    def test_join_tables_are_searched_by_index(self):
+        db_cursor = self.db_conn.cursor(factory=recording_cursor)
+        filters = {'author': "Osamu Tezuka", 'library_id': 1}
+        tosho_query.find_books(db_cursor, **filters)
+        tosho_query.count_books(db_cursor, **filters)
+        tosho_query.get_books(db_cursor, [1, 2])
+        self.assertEqual(len(db_cursor.queries), 3)
+        for sql, parameters in db_cursor.queries:
+            plan = [row[3] for row in self.db_conn.execute(
+                f"EXPLAIN QUERY PLAN {sql}", parameters)]
+            # Without an index, every book would read the whole table.
+            scans = [step for step in plan
+                     if step.split(' ')[:2] in [['SCAN', table]
+                                                for table in _JOIN_TABLES]]
+            self.assertEqual(scans, [], sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
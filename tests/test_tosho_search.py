@@ -0,0 +1,151 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tempfile
+import unittest
+import tosho_search
+import tosho_sqlite
+from book import book
+
+
+class search_index_test(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_path = temp_dir.name + '/'
+
+    def connect(self, db_name: str):
+        db_conn = tosho_sqlite.connect_to_database(self.db_path, db_name)
+        self.addCleanup(db_conn.close)
+        return db_conn
+
+    @staticmethod
+    def triggers(db_conn) -> dict:
+        return dict(db_conn.execute("SELECT name, sql FROM sqlite_master "
+                                    "WHERE type = 'trigger'"))
+
+    def test_migration_3_replaces_the_triggers_of_migration_2(self):
+        db_conn = self.connect('old.db')
+        # Put back the triggers of migration 2, as in a database that was
+        # created before migration 3 existed.
+        for name in self.triggers(db_conn):
+            db_conn.execute(f"DROP TRIGGER {name};")
+        for instruction in tosho_sqlite.SCHEMA_MIGRATIONS[1]:
+            if instruction.startswith("CREATE TRIGGER"):
+                db_conn.execute(instruction)
+        db_conn.execute("PRAGMA user_version = 2;")
+        db_conn.commit()
+        self.assertNotIn('+NEW.BookID',
+                         ''.join(self.triggers(db_conn).values()))
+        tosho_sqlite.migrate_database(db_conn)
+        self.assertEqual(self.triggers(db_conn),
+                         self.triggers(self.connect('new.db')))
+        self.assertIn('+NEW.BookID', ''.join(self.triggers(db_conn).values()))
+
+    def test_index_query_searches_the_join_tables_by_index(self):
+        db_conn = self.connect('new.db')
+        plan = [row[3] for row in db_conn.execute(
+            f"EXPLAIN QUERY PLAN {tosho_sqlite.SEARCH_INDEX_QUERY}")]
+        self.assertTrue(any(step.startswith("SEARCH ab ") for step in plan))
+        self.assertTrue(any(step.startswith("SEARCH pb ") for step in plan))
+
+
+class search_test(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_conn = tosho_sqlite.connect_to_database(temp_dir.name + '/',
+                                                        'search.db')
+        self.addCleanup(self.db_conn.close)
+        # BookIDs count from 1 in this order.
+        tosho_sqlite.add_records_to_database(self.db_conn, [
+            book("Kadokawa Shoten no Rekishi", ["Anonymous"], "Kodansha",
+                 "2007", {'isbn_13': '9780306406157'}, 200),
+            book("Hi no Tori", ["Osamu Tezuka"], "Kadokawa", "1967",
+                 {'isbn_13': '9784003101117'}, 400),
+            book("Kokoro", ["Natsume Sōseki", "Kadokawa Genyoshi"],
+                 "Iwanami Shoten", "1914", {'isbn_13': '9780804429573'}, 328)
+        ])
+        self.db_cursor = self.db_conn.cursor()
+
+    def search(self, query: str) -> list:
+        return [book_id for book_id, rank
+                in tosho_search.search_book_ids(self.db_cursor, query)]
+
+    def index(self) -> list:
+        return self.db_cursor.execute(
+            "SELECT rowid, Title, Authors, Publisher FROM BooksSearch ORDER "
+            "BY rowid").fetchall()
+
+    def expected_index(self) -> list:
+        return self.db_cursor.execute(
+            f"SELECT * FROM ({tosho_sqlite.SEARCH_INDEX_QUERY}) ORDER BY 1"
+        ).fetchall()
+
+    def test_title_ranks_above_authors_above_publisher(self):
+        self.assertEqual(self.search("kadokawa"), [1, 3, 2])
+
+    def test_prefixes_and_diacritics(self):
+        self.assertEqual(self.search("tez osa"), [2])
+        self.assertEqual(self.search("soseki"), [3])
+        self.assertEqual(self.search("Kok"), [3])
+        self.assertEqual(self.search("tezuka kokoro"), [])
+
+    def test_query_syntax_is_searched_literally(self):
+        self.assertEqual(self.search('hi: "no" tori('), [2])
+        self.assertEqual(self.search('tori AND'), [])
+        self.assertEqual(self.search("!?"), [])
+        self.assertEqual([found.title for found in tosho_search.search(
+            self.db_cursor, "tori")], ["Hi no Tori"])
+
+    def test_triggers_keep_the_index_in_sync(self):
+        self.assertEqual(self.index(), self.expected_index())
+        self.db_cursor.execute("UPDATE Books SET Title = 'Phoenix' WHERE "
+                               "BookID = 2;")
+        self.db_cursor.execute("UPDATE Authors SET Name = 'Tezuka Osamu' "
+                               "WHERE Name = 'Osamu Tezuka';")
+        self.db_cursor.execute("UPDATE Publishers SET Name = 'Iwanami' "
+                               "WHERE Name = 'Iwanami Shoten';")
+        self.db_cursor.execute("DELETE FROM Authors_Books WHERE BookID = 3 "
+                               "AND AuthorID = (SELECT AuthorID FROM "
+                               "Authors WHERE Name = 'Kadokawa Genyoshi');")
+        self.db_cursor.execute("DELETE FROM Publishers_Books WHERE BookID = "
+                               "1;")
+        tosho_sqlite.add_record_to_database(self.db_cursor, book(
+            "Buddha", ["Tezuka Osamu"], "Ushio", "1972",
+            {'isbn_13': '9791034304301'}, 300))
+        self.db_cursor.execute("DELETE FROM Books WHERE BookID = 1;")
+        self.db_conn.commit()
+        self.assertEqual(self.index(), self.expected_index())
+        self.assertEqual(self.search("phoenix"), [2])
+        self.assertEqual(self.search("hi no tori"), [])
+        self.assertEqual(sorted(self.search("tezuka")), [2, 4])
+        self.assertEqual(self.search("kadokawa"), [2])
+        self.assertEqual(self.search("kodansha"), [])
+
+    def test_rebuild_search_index(self):
+        self.db_cursor.execute("DELETE FROM BooksSearch;")
+        self.db_conn.commit()
+        self.assertEqual(self.search("kokoro"), [])
+        self.assertEqual(tosho_search.rebuild_search_index(self.db_conn), 3)
+        self.assertEqual(self.index(), self.expected_index())
+        self.assertEqual(self.search("kokoro"), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sqlite3
+import tempfile
+import unittest
+import tosho_query
+import tosho_search
+import tosho_sqlite
+from book import book
+
+# The tables of a database made before SCHEMA_MIGRATIONS existed.
+_BASELINE_SCHEMA = [
+    "CREATE TABLE Books(BookID INTEGER PRIMARY KEY, Title, PublishDate, "
+    "Pages INT, ISBN_10 INT UNIQUE, ISBN_13 INT UNIQUE, ISSN INT UNIQUE, "
+    "OCLC INT UNIQUE, LCCN INT UNIQUE);",
+    "CREATE TABLE Authors(AuthorID INTEGER PRIMARY KEY, Name UNIQUE);",
+    "CREATE TABLE Publishers(PublisherID INTEGER PRIMARY KEY, Name UNIQUE);",
+    "CREATE TABLE Volumes(VolumeID INTEGER PRIMARY KEY, BookID, FOREIGN "
+    "KEY(BookID) REFERENCES Books(BookID) ON DELETE CASCADE);",
+    "CREATE TABLE Libraries(LibraryID INTEGER PRIMARY KEY, Name UNIQUE);",
+    "CREATE TABLE Borrowers(BorrowerID INTEGER PRIMARY KEY, Name, "
+    "ContactNumber INT UNIQUE);",
+    "CREATE TABLE Authors_Books(AuthorID, BookID, FOREIGN KEY(AuthorID) "
+    "REFERENCES Authors(AuthorID) ON DELETE CASCADE, FOREIGN KEY(BookID) "
+    "REFERENCES Books(BookID) ON DELETE CASCADE, UNIQUE(AuthorID, BookID));",
+    "CREATE TABLE Publishers_Books(PublisherID, BookID UNIQUE, FOREIGN "
+    "KEY(PublisherID) REFERENCES Publishers(PublisherID) ON DELETE CASCADE, "
+    "FOREIGN KEY(BookID) REFERENCES Books(BookID) ON DELETE CASCADE);",
+    "CREATE TABLE Collections(LibraryID, VolumeID UNIQUE, FOREIGN "
+    "KEY(LibraryID) REFERENCES Libraries(LibraryID) ON DELETE CASCADE, "
+    "FOREIGN KEY(VolumeID) REFERENCES Volumes(VolumeID) ON DELETE CASCADE);",
+    "CREATE TABLE Borrowings(BorrowerID, VolumeID, UNIQUE(BorrowerID, "
+    "VolumeID), FOREIGN KEY(BorrowerID) REFERENCES Borrowers(BorrowerID) ON "
+    "DELETE CASCADE, FOREIGN KEY(VolumeID) REFERENCES Volumes(VolumeID) ON "
+    "DELETE CASCADE);"
+]
+# The tables whose rows link the others together.
+_LINK_TABLES = ('Authors_Books', 'Publishers_Books', 'Volumes', 'Collections',
+                'Borrowings')
+
+
+def _books() -> list:
+    return [
+        book("Kokoro", ["Natsume Soseki"], "Iwanami Shoten", "1914",
+             {'isbn_13': '9784003101117', 'isbn_10': '4003101111'}, 328),
+        book("Hi no Tori", ["Osamu Tezuka"], "Kadokawa", "1967",
+             {'isbn_13': '978-0-306-40615-7', 'isbn_10': '0306406152'},
+             400),
+        book("Two Authors", ["Osamu Tezuka", "Natsume Soseki"], "Kadokawa",
+             "2001", {'isbn_13': '9780804429573'}, 120),
+        book("No Publisher", ["Anonymous"], None, "UNKNOWN",
+             {'isbn_10': '080442957X', 'lccn': 12345}, 0)
+    ]
+
+
+def _contents(db_conn: sqlite3.Connection) -> list:
+    '''
+    Return what the database knows about each book, without the IDs that
+    the two writers may number differently.
+    '''
+    db_cursor = db_conn.cursor()
+    db_cursor.execute("SELECT BookID, Title, PublishDate, Pages, ISBN_10, "
+                      "ISBN_13, ISSN, OCLC, LCCN FROM Books ORDER BY Title")
+    contents = []
+    for row in db_cursor.fetchall():
+        book_id = row[0]
+        authors = sorted(name for (name,) in db_cursor.execute(
+            "SELECT a.Name FROM Authors_Books ab JOIN Authors a ON "
+            "a.AuthorID = ab.AuthorID WHERE ab.BookID = ?", [book_id]))
+        publishers = [name for (name,) in db_cursor.execute(
+            "SELECT p.Name FROM Publishers_Books pb JOIN Publishers p ON "
+            "p.PublisherID = pb.PublisherID WHERE pb.BookID = ? AND p.Name "
+            "IS NOT NULL", [book_id])]
+        volumes = db_cursor.execute(
+            "SELECT COUNT(*) FROM Volumes v JOIN Collections c ON "
+            "c.VolumeID = v.VolumeID WHERE v.BookID = ? AND c.LibraryID = 1",
+            [book_id]).fetchone()[0]
+        contents.append((row[1:], authors, publishers, volumes))
+    return contents
+
+
+class add_records_test(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_path = temp_dir.name + '/'
+
+    def connect(self, db_name: str) -> sqlite3.Connection:
+        db_conn = tosho_sqlite.connect_to_database(self.db_path, db_name)
+        self.addCleanup(db_conn.close)
+        return db_conn
+
+    def test_batch_writer_matches_single_writer(self):
+        single = self.connect('single.db')
+        for relevant_book in _books():
+            tosho_sqlite.add_record_to_database(single.cursor(),
+                                                relevant_book)
+        batched = self.connect('batched.db')
+        self.assertEqual(tosho_sqlite.add_records_to_database(
+            batched, _books(), batch_size=3), 4)
+        self.assertEqual(_contents(batched), _contents(single))
+
+    def test_book_without_publisher(self):
+        db_conn = self.connect('batched.db')
+        tosho_sqlite.add_records_to_database(db_conn, _books()[3:])
+        self.assertEqual(db_conn.execute(
+            "SELECT COUNT(*) FROM Publishers_Books").fetchone()[0], 0)
+        self.assertEqual(db_conn.execute(
+            "SELECT COUNT(*) FROM Publishers WHERE Name IS NULL")
+            .fetchone()[0], 0)
+
+    def test_copies_become_volumes(self):
+        db_conn = self.connect('batched.db')
+        books = _books()
+        tosho_sqlite.add_records_to_database(db_conn, books + books[:2],
+                                             batch_size=4)
+        contents = _contents(db_conn)
+        self.assertEqual(len(contents), 4)
+        self.assertEqual(sorted(volumes for *_, volumes in contents),
+                         [1, 1, 2, 2])
+
+    def test_malformed_isbn_13_is_stored_as_text(self):
+        books = _books()
+        books[0].identifiers['isbn_13'] = 'not an isbn'
+        books[2].identifiers['isbn_13'] = '0804429573'
+        single = self.connect('single.db')
+        for relevant_book in books:
+            tosho_sqlite.add_record_to_database(single.cursor(),
+                                                relevant_book)
+        batched = self.connect('batched.db')
+        self.assertEqual(tosho_sqlite.add_records_to_database(
+            batched, books, batch_size=3), 4)
+        self.assertEqual(_contents(batched), _contents(single))
+        isbns = [row[0][4] for row in _contents(batched)]
+        self.assertIn('not an isbn', isbns)
+        self.assertIn('0804429573', isbns)
+
+    def test_open_transaction_is_not_committed(self):
+        db_conn = self.connect('batched.db')
+        db_conn.execute("INSERT INTO Libraries(Name) VALUES ('Branch')")
+        with self.assertRaises(sqlite3.ProgrammingError):
+            tosho_sqlite.add_records_to_database(db_conn, _books())
+        db_conn.rollback()
+        self.assertEqual(db_conn.execute(
+            "SELECT COUNT(*) FROM Libraries").fetchone()[0], 1)
+        self.assertEqual(db_conn.execute(
+            "SELECT COUNT(*) FROM Books").fetchone()[0], 0)
+
+
+class migration_test(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_path = temp_dir.name + '/'
+
+    def connect(self, db_name: str) -> sqlite3.Connection:
+        db_conn = tosho_sqlite.connect_to_database(self.db_path, db_name)
+        self.addCleanup(db_conn.close)
+        return db_conn
+
+    def create_baseline_database(self, db_name: str) -> None:
+        db_conn = sqlite3.connect(self.db_path + db_name)
+        for instruction in _BASELINE_SCHEMA:
+            db_conn.execute(instruction)
+        db_conn.execute("INSERT INTO Libraries(Name) VALUES ('Local');")
+        db_conn.executemany(
+            "INSERT INTO Books(BookID, Title, PublishDate, Pages, ISBN_10, "
+            "ISBN_13, LCCN) VALUES (?, ?, ?, ?, ?, ?, ?);",
+            [(1, "Hi no Tori", "1967", 400, 306406152, 9780306406157, None),
+             (2, "Kokoro", "1914", 328, 4003101111, 9784003101117, None),
+             (3, "No Publisher", "UNKNOWN", 0, '080442957X', None, 12345)])
+        db_conn.executemany("INSERT INTO Authors(AuthorID, Name) VALUES "
+                            "(?, ?);", [(1, "Osamu Tezuka"),
+                                        (2, "Natsume Soseki")])
+        db_conn.executemany("INSERT INTO Publishers(PublisherID, Name) "
+                            "VALUES (?, ?);", [(1, "Kadokawa"),
+                                               (2, "Iwanami Shoten")])
+        db_conn.executemany("INSERT INTO Authors_Books(AuthorID, BookID) "
+                            "VALUES (?, ?);", [(1, 1), (2, 2), (1, 3)])
+        db_conn.executemany("INSERT INTO Publishers_Books(PublisherID, "
+                            "BookID) VALUES (?, ?);", [(1, 1), (2, 2)])
+        db_conn.executemany("INSERT INTO Volumes(VolumeID, BookID) VALUES "
+                            "(?, ?);", [(1, 1), (2, 1), (3, 2), (4, 3)])
+        db_conn.executemany("INSERT INTO Collections(LibraryID, VolumeID) "
+                            "VALUES (1, ?);", [(1,), (2,), (3,), (4,)])
+        db_conn.execute("INSERT INTO Borrowers(Name) VALUES ('Aiko');")
+        db_conn.execute("INSERT INTO Borrowings VALUES (1, 2);")
+        db_conn.commit()
+        db_conn.close()
+
+    @staticmethod
+    def schema(db_conn: sqlite3.Connection) -> dict:
+        '''
+        Return the columns of every table and the names of the indexes and
+        triggers, which unlike the SQL text do not depend on how the table
+        came to be.
+        '''
+        schema = {}
+        for kind, name, table in db_conn.execute(
+                "SELECT type, name, tbl_name FROM sqlite_master WHERE name "
+                "NOT LIKE 'sqlite_%' AND name NOT LIKE 'BooksSearch_%'"):
+            if kind == 'table':
+                schema[name] = db_conn.execute(
+                    f"PRAGMA table_info({name});").fetchall()
+            else:
+                schema[name] = (kind, table)
+        return schema
+
+    def test_baseline_database_is_migrated(self):
+        self.create_baseline_database('old.db')
+        db_conn = self.connect('old.db')
+        self.assertEqual(db_conn.execute("PRAGMA user_version;").fetchone()[0],
+                         len(tosho_sqlite.SCHEMA_MIGRATIONS))
+        self.assertEqual(self.schema(db_conn),
+                         self.schema(self.connect('new.db')))
+        self.assertEqual(db_conn.execute(
+            "SELECT BookID, ISBN_10, ISBN_13, LCCN FROM Books ORDER BY "
+            "BookID").fetchall(),
+            [(1, '0306406152', '9780306406157', None),
+             (2, '4003101111', '9784003101117', None),
+             (3, '080442957X', None, 12345)])
+        self.assertEqual(
+            [db_conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+             for table in _LINK_TABLES], [3, 2, 4, 4, 1])
+        self.assertEqual(db_conn.execute(
+            "PRAGMA foreign_key_check;").fetchall(), [])
+        db_cursor = db_conn.cursor()
+        self.assertEqual(tosho_query.find_book_id(db_cursor, 'isbn',
+                                                  '0-306-40615-2'), 1)
+        self.assertEqual(sorted(found.book_id for found
+                                in tosho_search.search(db_cursor, "tezuka")),
+                         [1, 3])
+        # The recreated triggers keep the index in sync.
+        tosho_sqlite.add_record_to_database(db_cursor, _books()[2])
+        self.assertEqual(len(tosho_search.search(db_cursor, "tezuka")), 3)
+
+    def test_new_database_needs_no_migration(self):
+        db_conn = self.connect('new.db')
+        self.assertEqual(db_conn.execute("PRAGMA user_version;").fetchone()[0],
+                         len(tosho_sqlite.SCHEMA_MIGRATIONS))
+        self.assertEqual(tosho_sqlite.migrate_database(db_conn),
+                         len(tosho_sqlite.SCHEMA_MIGRATIONS))
+        isbn_columns = {name: column_type for _, name, column_type, *_
+                        in db_conn.execute("PRAGMA table_info(Books);")
+                        if name in ('ISBN_10', 'ISBN_13', 'ISSN')}
+        self.assertEqual(set(isbn_columns.values()), {'TEXT'})
+        # Created as it is, not renamed from the Books_new of migration 6.
+        self.assertTrue(db_conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'Books'")
+            .fetchone()[0].startswith("CREATE TABLE Books("))
+
+
+if __name__ == '__main__':
+    unittest.main()
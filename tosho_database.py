@@ -0,0 +1,267 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+A database session that keeps state between calls into tosho_sqlite.
+
+The functions in tosho_sqlite only get a cursor, so every call has to start
+from scratch. A tosho_database owns the connections and remembers the IDs of
+the author and publisher names it has seen, so that importing the same
+prolific authors and publishers over and over costs no SQL at all.
+
+A tosho_database may be shared between threads. It has a single writer
+connection, used by one thread at a time, and a pool of read-only
+connections. In WAL mode the readers see the last committed state and never
+wait for the writer, so searches stay fast while an import is running:
+
+    with database.reading() as db_cursor:
+        books = tosho_search.search(db_cursor, "tezuka")
+    with database.writing() as db_cursor:
+        tosho_sqlite.add_volume_library_relation(db_cursor, volume_id, 2)
+
+The functions of tosho_sqlite that commit after every statement do not
+commit inside writing(); the whole block is one transaction.
+'''
+
+import logging
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+from book import book
+import tosho_sqlite
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_MAX_READERS = 4
+
+
+class name_id_cache:
+    '''
+    A bounded, least recently used mapping of names to row IDs for one table.
+
+    IDs of rows inserted by a transaction that has not been committed yet are
+    kept apart as pending. commit() makes them permanent and rollback() drops
+    them, so the cache never hands out the ID of a row that was rolled back.
+    '''
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str) -> int:
+        '''
+        Return the ID of name, or None if it is not cached.
+        '''
+        name_id = self._pending.get(name)
+        if name_id is None:
+            name_id = self._ids.get(name)
+            if name_id is not None:
+                self._ids.move_to_end(name)
+        if name_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return name_id
+
+    def add(self, name: str, name_id: int, pending: bool = False) -> None:
+        if pending:
+            self._pending[name] = name_id
+            return
+        self._ids[name] = name_id
+        self._ids.move_to_end(name)
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def commit(self) -> None:
+        pending = self._pending
+        self._pending = {}
+        for name, name_id in pending.items():
+            self.add(name, name_id)
+
+    def rollback(self) -> None:
+        self._pending.clear()
+
+    def clear(self) -> None:
+        self._ids.clear()
+        self._pending.clear()
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._pending)
+
+
+class tosho_database:
+    '''
+    An open toshokan database together with the name caches used to write
+    to it, a single writer connection and a pool of up to max_readers
+    read-only connections.
+    '''
+
+    def __init__(self, db_path: str, db_name: str,
+                 cache_size: int = DEFAULT_CACHE_SIZE,
+                 profile: str = tosho_sqlite.DEFAULT_PROFILE,
+                 max_readers: int = DEFAULT_MAX_READERS):
+        self.db_path = db_path
+        self.db_name = db_name
+        # The writer may be used from any thread, but _write_lock makes sure
+        # only one of them uses it at a time.
+        self.connection = \
+            tosho_sqlite.connect_to_database(db_path, db_name, profile,
+                                             check_same_thread=False)
+        self._write_lock = threading.RLock()
+        self.author_ids = name_id_cache(cache_size)
+        self.publisher_ids = name_id_cache(cache_size)
+        self.max_readers = max_readers
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._readers_lock = threading.Lock()
+        self._all_readers = []
+
+    def cursor(self) -> sqlite3.Cursor:
+        '''
+        Return a cursor of the writer connection. Only use this from a single
+        thread; shared code should use reading() or writing() instead.
+        '''
+        return self.connection.cursor()
+
+    @contextmanager
+    def writing(self) -> Iterator[sqlite3.Cursor]:
+        '''
+        Run a write transaction on the writer connection and yield its cursor.
+        The transaction is committed when the block ends, or rolled back if
+        it raises, including whatever the tosho_sqlite functions called in
+        the block would have committed on their own. Other threads wait
+        until the block has ended.
+        '''
+        with self._write_lock:
+            if self.connection.in_transaction:
+                self.commit()
+            db_cursor = self.connection.cursor()
+            db_cursor.execute("BEGIN IMMEDIATE;")
+            try:
+                with self.connection.hold_commits():
+                    yield db_cursor
+            except BaseException:
+                self.rollback()
+                raise
+            self.commit()
+
+    @contextmanager
+    def reading(self, timeout: float = None) -> Iterator[sqlite3.Cursor]:
+        '''
+        Yield a cursor of a read-only connection from the pool. Everything
+        read inside the block comes from the same snapshot of the database.
+        Waits up to timeout seconds (forever if None) for a free connection
+        once max_readers connections are in use.
+        '''
+        db_conn = self._get_reader(timeout)
+        try:
+            db_cursor = db_conn.cursor()
+            # A read transaction pins one snapshot for the whole block.
+            db_cursor.execute("BEGIN;")
+            try:
+                yield db_cursor
+            finally:
+                db_conn.rollback()
+        finally:
+            self._readers.put(db_conn)
+
+    def _get_reader(self, timeout: float = None) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._readers_lock:
+            if self._reader_count < self.max_readers:
+                self._reader_count += 1
+                create = True
+            else:
+                create = False
+        if not create:
+            return self._readers.get(timeout=timeout)
+        try:
+            db_conn = tosho_sqlite.connect_to_database(self.db_path,
+                                                       self.db_name,
+                                                       'read-only-replica',
+                                                       check_same_thread=False)
+        except BaseException:
+            with self._readers_lock:
+                self._reader_count -= 1
+            raise
+        with self._readers_lock:
+            self._all_readers.append(db_conn)
+        return db_conn
+
+    def add_record(self, relevant_book: book, library_id: int = 1) -> None:
+        '''
+        Add a single book to the database, see
+        tosho_sqlite.add_record_to_database().
+        '''
+        with self._write_lock:
+            tosho_sqlite.add_record_to_database(self.cursor(), relevant_book,
+                                                library_id, self.author_ids,
+                                                self.publisher_ids)
+
+    def add_records(self, books: Iterable[book], library_id: int = 1,
+                    batch_size: int = 1000, before_commit=None,
+                    new_book_ids: list = None) -> int:
+        '''
+        Add many books to the database in batches, see
+        tosho_sqlite.add_records_to_database().
+        '''
+        with self._write_lock:
+            return tosho_sqlite.add_records_to_database(self.connection,
+                                                        books, library_id,
+                                                        batch_size,
+                                                        self.author_ids,
+                                                        self.publisher_ids,
+                                                        before_commit,
+                                                        new_book_ids)
+
+    def commit(self) -> None:
+        with self._write_lock:
+            self.connection.commit()
+            self.author_ids.commit()
+            self.publisher_ids.commit()
+
+    def rollback(self) -> None:
+        with self._write_lock:
+            self.connection.rollback()
+            self.author_ids.rollback()
+            self.publisher_ids.rollback()
+
+    def close(self) -> None:
+        with self._readers_lock:
+            for db_conn in self._all_readers:
+                db_conn.close()
+            self._all_readers = []
+            self._reader_count = 0
+        self._readers = queue.LifoQueue()
+        with self._write_lock:
+            self.connection.close()
+            self.author_ids.clear()
+            self.publisher_ids.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
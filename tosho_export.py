@@ -0,0 +1,169 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Export the catalog as JSON Lines or CSV.
+
+The books are streamed out of the database with tosho_query.stream_books()
+and written one at a time, so the memory used by an export does not depend
+on the size of the catalog. The output can be gzip compressed on the fly.
+'''
+
+import csv
+import gzip
+import io
+import json
+import logging
+import sqlite3
+import sys
+from typing import TextIO
+from book import book
+import tosho_query
+from tosho_sqlite import connect_to_database
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+
+# The fields of an exported book, in the order of the CSV columns.
+EXPORT_FIELDS = ['book_id', 'title', 'authors', 'publisher', 'publish_date',
+                 'pages', 'isbn_13', 'isbn_10', 'issn', 'oclc', 'lccn',
+                 'volume_count', 'libraries']
+
+# Joins the authors and the libraries in a CSV cell.
+CSV_LIST_SEPARATOR = '; '
+
+
+def book_to_record(relevant_book: book) -> dict:
+    '''
+    Return the exported fields of a book as a dictionary.
+    '''
+    identifiers = relevant_book.identifiers
+    return {
+        'book_id': relevant_book.book_id,
+        'title': relevant_book.title,
+        'authors': list(relevant_book.authors),
+        'publisher': relevant_book.publisher,
+        'publish_date': relevant_book.publish_date,
+        'pages': relevant_book.pages,
+        'isbn_13': identifiers['isbn_13'],
+        'isbn_10': identifiers['isbn_10'],
+        'issn': identifiers['issn'],
+        'oclc': identifiers['oclc'],
+        'lccn': identifiers['lccn'],
+        'volume_count': relevant_book.volume_count,
+        'libraries': list(relevant_book.libraries)
+    }
+
+
+def export_books(db_cursor: sqlite3.Cursor, output: TextIO,
+                 export_format: str = 'jsonl', chunk_size: int = 1000,
+                 **filters) -> int:
+    '''
+    Write every book matching the filters (see tosho_query) to output in
+    export_format, one line or row per book. Return the number of books
+    written.
+    '''
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format!r}.")
+    books = tosho_query.stream_books(db_cursor, chunk_size, **filters)
+    book_count = 0
+    if export_format == 'jsonl':
+        for relevant_book in books:
+            output.write(json.dumps(book_to_record(relevant_book),
+                                    ensure_ascii=False))
+            output.write('\n')
+            book_count += 1
+        return book_count
+    writer = csv.DictWriter(output, EXPORT_FIELDS)
+    writer.writeheader()
+    for relevant_book in books:
+        record = book_to_record(relevant_book)
+        record['authors'] = CSV_LIST_SEPARATOR.join(record['authors'])
+        record['libraries'] = CSV_LIST_SEPARATOR.join(record['libraries'])
+        writer.writerow(record)
+        book_count += 1
+    return book_count
+
+
+def export_catalog(db_path: str, db_name: str, destination: str = '-',
+                   export_format: str = 'jsonl', compress: bool = None,
+                   chunk_size: int = 1000,
+                   profile: str = 'read-only-replica', **filters) -> int:
+    '''
+    Export the books of the database at db_path + db_name to the file
+    destination, or to standard output if destination is "-". Return the
+    number of books written.
+
+    The output is gzip compressed if compress is True, or, if compress is
+    None, if destination ends with ".gz". The whole export reads a single
+    snapshot of the database, so books added while it runs are left out.
+    '''
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format!r}.")
+    if compress is None:
+        compress = destination.endswith('.gz')
+    db_conn = connect_to_database(db_path, db_name, profile)
+    try:
+        with _open_output(destination, compress) as output:
+            db_cursor = db_conn.cursor()
+            if db_conn.in_transaction:
+                db_conn.commit()
+            db_cursor.execute("BEGIN;")
+            try:
+                book_count = export_books(db_cursor, output, export_format,
+                                          chunk_size, **filters)
+            finally:
+                db_conn.rollback()
+    finally:
+        db_conn.close()
+    logger.info(f"Exported {book_count} books to {destination}.")
+    return book_count
+
+
+def _open_output(destination: str, compress: bool) -> TextIO:
+    '''
+    Open destination ("-" for standard output) for writing text, through
+    gzip if compress is True. Closing the returned file leaves standard
+    output open.
+    '''
+    if destination == '-':
+        binary = sys.stdout.buffer
+        if not compress:
+            return _uncloseable(sys.stdout)
+        gzip_file = gzip.GzipFile(fileobj=binary, mode='wb')
+        return io.TextIOWrapper(gzip_file, encoding='utf-8', newline='')
+    if compress:
+        return gzip.open(destination, 'wt', encoding='utf-8', newline='')
+    return open(destination, 'w', encoding='utf-8', newline='')
+
+
+class _uncloseable:
+    '''
+    Wraps standard output so that a with statement flushes it instead of
+    closing it.
+    '''
+
+    def __init__(self, output: TextIO):
+        self.output = output
+
+    def write(self, text: str) -> int:
+        return self.output.write(text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.output.flush()
@@ -0,0 +1,476 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Import books from files instead of looking them up online.
+
+Three formats are understood:
+    csv   -- one book per row, with a header naming the columns. The columns
+             written by tosho_export are understood, as are a few common
+             alternatives ("isbn", "author", "date", ...).
+    jsonl -- one JSON object per line with the same keys as the CSV columns,
+             such as the output of "toshokan export --format jsonl".
+    marc  -- MARC 21 bibliographic records in ISO 2709 (.mrc) files.
+
+The file is read one record at a time and the books are written in batches
+with tosho_database.add_records(), so the size of the file does not matter.
+After every batch the byte offset of the next record is stored in the table
+ImportCheckpoints, in the same transaction as the batch itself. An import
+that was interrupted therefore resumes exactly where the last committed
+batch ended, without adding any book twice.
+'''
+
+import csv
+import json
+import logging
+import os
+import re
+import time
+from typing import BinaryIO, Iterator
+from book import book, BookBatch, IDENTIFIER_TYPES
+from identifiers import canonical_isbn, normalize_isbn
+from tosho_database import tosho_database, DEFAULT_CACHE_SIZE
+logger = logging.getLogger(__name__)
+
+IMPORT_FORMATS = ('csv', 'jsonl', 'marc')
+FORMAT_EXTENSIONS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.mrc': 'marc',
+    '.marc': 'marc'
+}
+
+# Other names for the columns of a CSV file or the keys of a JSON object.
+FIELD_ALIASES = {
+    'author': 'authors',
+    'date': 'publish_date',
+    'published': 'publish_date',
+    'publication_date': 'publish_date',
+    'page_count': 'pages',
+    'isbn13': 'isbn_13',
+    'isbn10': 'isbn_10'
+}
+# Separates the names in the authors column of a CSV file.
+AUTHOR_SEPARATOR = ';'
+
+# MARC 21 field and subfield separators.
+_MARC_SUBFIELD = '\x1f'
+_MARC_FIELD_END = '\x1e'
+# Punctuation that cataloguing rules put at the end of MARC subfields.
+_MARC_PUNCTUATION = ' /:;,.='
+
+
+class import_stats:
+    '''
+    Counters describing the progress of an import.
+    '''
+
+    def __init__(self, records: int = 0, imported: int = 0,
+                 skipped: int = 0):
+        self.started = time.monotonic()
+        self.resumed_from = records  # Records read by earlier runs
+        self.records = records  # Records read from the file
+        self.imported = imported  # Volumes stored in the database
+        self.skipped = skipped  # Records that could not be imported
+
+    def as_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        new_records = self.records - self.resumed_from
+        return {
+            'records': self.records,
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'resumed_from': self.resumed_from,
+            'elapsed': elapsed,
+            'records_per_second': new_records / elapsed if elapsed else 0.0
+        }
+
+
+def guess_format(source: str) -> str:
+    '''
+    Return the import format matching the extension of the file source.
+    '''
+    extension = os.path.splitext(source)[1].lower()
+    try:
+        return FORMAT_EXTENSIONS[extension]
+    except KeyError:
+        raise ValueError(f"Cannot tell the format of {source} from its "
+                         "extension. Please give it explicitly.") from None
+
+
+def import_file(source: str, db_path: str, db_name: str,
+                import_format: str = None, library_id: int = 1,
+                batch_size: int = 1000, resume: bool = True,
+                profile: str = 'bulk-import') -> dict:
+    '''
+    Import every book in the file source into the database at db_path +
+    db_name and return the final counters of the run as a dictionary.
+
+    import_format is one of IMPORT_FORMATS and is guessed from the extension
+    of source if not given. If resume is True and an earlier import of the
+    same file was interrupted, the import continues after the last batch it
+    committed; otherwise the file is read from the start.
+    '''
+    if import_format is None:
+        import_format = guess_format(source)
+    if import_format not in IMPORT_FORMATS:
+        raise ValueError(f"Unknown import format {import_format!r}.")
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    source_key = os.path.abspath(source)
+    with tosho_database(db_path, db_name, DEFAULT_CACHE_SIZE,
+                        profile) as database:
+        offset = 0
+        stats = import_stats()
+        checkpoint = get_checkpoint(database.cursor(), source_key)
+        if checkpoint is not None and resume:
+            if checkpoint['format'] != import_format:
+                logger.warning(f"WARNING: {source} was imported as "
+                               f"{checkpoint['format']} before. Starting "
+                               "over!")
+            elif checkpoint['offset'] > os.path.getsize(source):
+                logger.warning(f"WARNING: {source} is shorter than when it "
+                               "was imported before. Starting over!")
+            else:
+                offset = checkpoint['offset']
+                stats = import_stats(checkpoint['records'],
+                                     checkpoint['imported'],
+                                     checkpoint['skipped'])
+                logger.info(f"Resuming the import of {source} after "
+                            f"{stats.records} records.")
+        with open(source, 'rb') as source_file:
+            batch = BookBatch()
+            for offset, relevant_book in read_records(source_file,
+                                                      import_format, offset):
+                stats.records += 1
+                if relevant_book is None:
+                    stats.skipped += 1
+                    continue
+                try:
+                    batch.append(relevant_book)
+                except ValueError as e:
+                    logger.warning(f"WARNING: Skipping record "
+                                   f"{stats.records}: {e}")
+                    stats.skipped += 1
+                    continue
+                if len(batch) >= batch_size:
+                    _write_batch(database, batch, library_id, source_key,
+                                 import_format, offset, stats)
+                    batch = BookBatch()
+            _write_batch(database, batch, library_id, source_key,
+                         import_format, offset, stats)
+    summary = stats.as_dict()
+    logger.info(f"Import of {source} finished: {summary}")
+    return summary
+
+
+def _write_batch(database: tosho_database, batch: BookBatch,
+                 library_id: int, source: str, import_format: str,
+                 offset: int, stats: import_stats) -> None:
+    '''
+    Write the books of batch and the checkpoint after them in one
+    transaction, and count them in stats once it is committed.
+    '''
+    def save_checkpoint(db_cursor, committed_batch):
+        _save_checkpoint(db_cursor, source, import_format, offset,
+                         stats.records, stats.imported + len(committed_batch),
+                         stats.skipped)
+
+    if not batch:
+        # Only skipped records since the last batch; move the checkpoint
+        # past them anyway.
+        with database.writing() as db_cursor:
+            save_checkpoint(db_cursor, batch)
+        return
+    stats.imported += database.add_records(batch, library_id, len(batch),
+                                           save_checkpoint)
+    logger.info(f"{stats.records} records read, {stats.imported} imported, "
+                f"{stats.skipped} skipped.")
+
+
+def get_checkpoint(db_cursor, source: str) -> dict:
+    '''
+    Return the checkpoint of the last import of the file source (an absolute
+    path), or None if it was never imported.
+    '''
+    db_cursor.execute("SELECT Format, Offset, Records, Imported, Skipped, "
+                      "Updated FROM ImportCheckpoints WHERE Source = ?",
+                      (source,))
+    row = db_cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip(('format', 'offset', 'records', 'imported', 'skipped',
+                     'updated'), row))
+
+
+def _save_checkpoint(db_cursor, source: str, import_format: str, offset: int,
+                     records: int, imported: int, skipped: int) -> None:
+    db_cursor.execute("INSERT OR REPLACE INTO ImportCheckpoints(Source, "
+                      "Format, Offset, Records, Imported, Skipped, Updated) "
+                      "VALUES (?, ?, ?, ?, ?, ?, datetime('now'))",
+                      (source, import_format, offset, records, imported,
+                       skipped))
+
+
+def read_records(source_file: BinaryIO, import_format: str,
+                 offset: int = 0) -> Iterator[tuple]:
+    '''
+    Yield an (offset, book) tuple for every record of source_file, which
+    must be opened in binary mode, starting at the byte offset offset.
+    The offset yielded is that of the end of the record. Records that
+    cannot be turned into a book yield None instead of a book.
+    '''
+    if import_format == 'csv':
+        return _read_csv(source_file, offset)
+    if import_format == 'jsonl':
+        return _read_jsonl(source_file, offset)
+    if import_format == 'marc':
+        return _read_marc(source_file, offset)
+    raise ValueError(f"Unknown import format {import_format!r}.")
+
+
+def _read_jsonl(source_file: BinaryIO, offset: int) -> Iterator[tuple]:
+    source_file.seek(offset)
+    for line in source_file:
+        offset += len(line)
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            logger.warning(f"WARNING: Skipping a line that is not valid "
+                           f"JSON: {e}")
+            yield offset, None
+            continue
+        if not isinstance(record, dict):
+            logger.warning("WARNING: Skipping a line that is not a JSON "
+                           "object.")
+            yield offset, None
+            continue
+        yield offset, record_to_book(record)
+
+
+def _read_csv(source_file: BinaryIO, offset: int) -> Iterator[tuple]:
+    # The header is needed even when resuming in the middle of the file.
+    source_file.seek(0)
+    header_line = source_file.readline()
+    fields = next(csv.reader([header_line.decode('utf-8-sig')]), [])
+    offset = max(offset, len(header_line))
+    source_file.seek(offset)
+    # csv.reader() pulls lines until a row is complete, so after each row
+    # the end of the last line read is the end of the row.
+    end_of_row = offset
+
+    def lines():
+        nonlocal end_of_row
+        for line in source_file:
+            end_of_row += len(line)
+            yield line.decode('utf-8')
+
+    for row in csv.reader(lines()):
+        if not any(row):
+            continue
+        yield end_of_row, record_to_book(dict(zip(fields, row)))
+
+
+def record_to_book(record: dict) -> book:
+    '''
+    Turn a CSV row or a JSON object into a book. Return None if it has no
+    title.
+    '''
+    fields = {}
+    for key, value in record.items():
+        key = str(key).strip().lower().replace(' ', '_').replace('-', '_')
+        fields[FIELD_ALIASES.get(key, key)] = value
+    if isinstance(fields.get('identifiers'), dict):
+        fields.update(fields['identifiers'])
+    title = _text(fields.get('title'))
+    if not title:
+        logger.warning("WARNING: Skipping a record without a title.")
+        return None
+    authors = fields.get('authors')
+    if isinstance(authors, str):
+        authors = authors.split(AUTHOR_SEPARATOR)
+    authors = [_text(name) for name in authors or [] if _text(name)]
+    identifiers = {id_type: _text(fields.get(id_type)) or None
+                   for id_type in IDENTIFIER_TYPES}
+    isbn = normalize_isbn(fields.get('isbn'))
+    if isbn is not None:
+        identifiers['isbn_13' if len(isbn) == 13 else 'isbn_10'] = isbn
+    for id_type in ('isbn_13', 'isbn_10'):
+        identifiers[id_type] = normalize_isbn(identifiers[id_type])
+    isbn_13 = identifiers['isbn_13']
+    if isbn_13 is not None and len(isbn_13) == 10:
+        # Some feeds put ISBN-10s in their ISBN-13 column.
+        identifiers['isbn_10'] = identifiers['isbn_10'] or isbn_13
+        identifiers['isbn_13'] = canonical_isbn(isbn_13)
+    pages = _text(fields.get('pages'))
+    return book(title,
+                authors or None,
+                _text(fields.get('publisher')) or "UNKNOWN",
+                _text(fields.get('publish_date')) or "UNKNOWN",
+                identifiers,
+                int(pages) if pages and pages.isdigit() else 0)
+
+
+def _text(value) -> str:
+    return None if value is None else str(value).strip()
+
+
+def _read_marc(source_file: BinaryIO, offset: int) -> Iterator[tuple]:
+    source_file.seek(offset)
+    while True:
+        first_byte = source_file.read(1)
+        # Some files put a line break between the records.
+        while first_byte in (b'\n', b'\r', b' '):
+            offset += 1
+            first_byte = source_file.read(1)
+        if not first_byte:
+            return
+        length = first_byte + source_file.read(4)
+        if not length.isdigit():
+            logger.error(f"ERROR: The MARC record at byte {offset} has no "
+                         "valid length. Stopping!")
+            return
+        record = length + source_file.read(int(length) - 5)
+        if len(record) < int(length):
+            logger.error(f"ERROR: The MARC record at byte {offset} is "
+                         "truncated. Stopping!")
+            return
+        offset += len(record)
+        try:
+            relevant_book = marc_to_book(record)
+        except (ValueError, IndexError) as e:
+            logger.warning(f"WARNING: Skipping a broken MARC record: {e}")
+            relevant_book = None
+        yield offset, relevant_book
+
+
+def parse_marc(record: bytes) -> list:
+    '''
+    Split an ISO 2709 record into its fields. Return a list of (tag, value)
+    tuples in the order of the record. The value of a control field (tags
+    001 to 009) is its text; the value of a data field is a tuple of its two
+    indicators and a list of (code, text) subfield tuples.
+
+    Records are decoded as UTF-8. MARC-8 records (leader position 9 is not
+    "a") only decode correctly as far as they are plain ASCII.
+    '''
+    leader = record[:24].decode('ascii')
+    base_address = int(leader[12:17])
+    directory = record[24:base_address - 1].decode('ascii')
+    fields = []
+    for start in range(0, len(directory) - 11, 12):
+        entry = directory[start:start + 12]
+        tag = entry[:3]
+        field_length = int(entry[3:7])
+        field_start = base_address + int(entry[7:12])
+        value = record[field_start:field_start + field_length]
+        value = value.decode('utf-8', errors='replace').rstrip(_MARC_FIELD_END)
+        if tag < '010':
+            fields.append((tag, value))
+            continue
+        subfields = [(subfield[0], subfield[1:])
+                     for subfield in value[2:].split(_MARC_SUBFIELD)[1:]
+                     if subfield]
+        fields.append((tag, (value[:1], value[1:2], subfields)))
+    return fields
+
+
+def marc_to_book(record: bytes) -> book:
+    '''
+    Turn a MARC 21 bibliographic record into a book. Return None if it has
+    no title.
+    '''
+    title = None
+    authors = []
+    added_authors = []
+    # The publisher and date from 260 and from 264, the newer field for the
+    # same data.
+    publications = {}
+    pages = 0
+    identifiers = {}
+    for tag, value in parse_marc(record):
+        if tag < '010':
+            continue
+        ind1, ind2, subfields = value
+        codes = {}
+        for code, text in subfields:
+            codes.setdefault(code, text)
+        if tag == '245' and 'a' in codes:
+            title = _marc_clean(codes['a'])
+            if 'b' in codes:
+                title = f"{title}: {_marc_clean(codes['b'])}"
+        elif tag in ('100', '110', '111') and 'a' in codes:
+            authors.append(_marc_name(codes['a'], tag == '100' and
+                                      ind1 == '1'))
+        elif tag in ('700', '710', '711') and 'a' in codes:
+            added_authors.append(_marc_name(codes['a'], tag == '700' and
+                                            ind1 == '1'))
+        elif tag == '260' or (tag == '264' and ind2 == '1'):
+            publications.setdefault(tag, codes)
+        elif tag == '300' and 'a' in codes:
+            page_counts = re.findall(r'(\d+)\s*p', codes['a'])
+            if page_counts:
+                pages = max(int(count) for count in page_counts)
+        elif tag == '020' and 'a' in codes:
+            parts = codes['a'].split()
+            isbn = normalize_isbn(parts[0] if parts else '')
+            if isbn is not None:
+                id_type = 'isbn_13' if len(isbn) == 13 else 'isbn_10'
+                identifiers.setdefault(id_type, isbn)
+        elif tag == '022' and 'a' in codes:
+            identifiers.setdefault('issn', codes['a'].strip())
+        elif tag == '010' and 'a' in codes:
+            identifiers.setdefault('lccn', codes['a'].strip())
+        elif tag == '035' and codes.get('a', '').startswith('(OCoLC)'):
+            oclc = re.sub(r'\D', '', codes['a'][len('(OCoLC)'):])
+            if oclc:
+                identifiers.setdefault('oclc', oclc)
+    if not title:
+        logger.warning("WARNING: Skipping a MARC record without a title.")
+        return None
+    publication = publications.get('264', publications.get('260', {}))
+    publisher = publication.get('b')
+    publish_date = publication.get('c')
+    return book(title,
+                authors + added_authors or None,
+                _marc_clean(publisher) if publisher else "UNKNOWN",
+                _marc_clean(publish_date).strip('[]') if publish_date
+                else "UNKNOWN",
+                identifiers,
+                pages)
+
+
+def _marc_clean(text: str) -> str:
+    return text.strip().rstrip(_MARC_PUNCTUATION).strip()
+
+
+def _marc_name(name: str, inverted: bool) -> str:
+    '''
+    Return a personal or corporate name from MARC. Inverted personal names
+    ("Tezuka, Osamu,") are turned around to match the providers ("Osamu
+    Tezuka").
+    '''
+    name = name.strip().rstrip(' /:;,=')
+    # Keep the full stop of a final initial ("Smith, J.").
+    if name.endswith('.') and not re.search(r'\b\w\.$', name):
+        name = name[:-1].rstrip()
+    if inverted and name.count(',') == 1:
+        surname, forenames = name.split(',')
+        name = f"{forenames.strip()} {surname.strip()}"
+    return name
@@ -0,0 +1,370 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Counters and histograms describing where the time of a lookup or an import
+goes.
+
+The modules of toshokan report what they do with count(), observe() and
+timer(). Metrics are off until enable() is called; until then each of these
+returns at once, so the instrumentation costs next to nothing. Once enabled,
+the metrics are written to one or more sinks: at every flush(), every
+interval seconds if one is given, and when the program exits.
+
+    tosho_metrics.enable(prometheus_sink("toshokan.prom"), interval=15)
+    with tosho_metrics.timer('toshokan_stage_seconds', stage='merge'):
+        merged = policy.merge(provider_results)
+
+A sink is any object with a write(snapshot) method taking the dictionary
+returned by snapshot(). json_sink and prometheus_sink write files; the
+Prometheus text format is the one read by the textfile collector of the
+node exporter.
+'''
+
+import atexit
+import bisect
+import datetime
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import nullcontext
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds and in bytes.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# The metrics reported by toshokan: their type, description and, for
+# histograms, their buckets. Metrics missing here can still be used; they
+# get no description and histograms get LATENCY_BUCKETS.
+METRICS = {
+    'toshokan_stage_seconds': (
+        'histogram', "Time spent in each stage of looking up and storing "
+        "books.", LATENCY_BUCKETS),
+    'toshokan_http_request_seconds': (
+        'histogram', "Time taken by single HTTP requests to the online "
+        "databases, by provider and status.", LATENCY_BUCKETS),
+    'toshokan_http_response_bytes': (
+        'histogram', "Size of the response bodies of the online databases.",
+        BYTE_BUCKETS),
+    'toshokan_http_retries_total': (
+        'counter', "HTTP requests that were retried.", None),
+    'toshokan_rate_limit_wait_seconds': (
+        'histogram', "Time requests waited for the rate limit of their "
+        "provider.", LATENCY_BUCKETS),
+    'toshokan_rate_limit_throttled_total': (
+        'counter', "Responses asking us to slow down, by provider and "
+        "status.", None),
+    'toshokan_provider_lookups_total': (
+        'counter', "Lookups on the online databases, by how they ended "
+        "(skipped if the circuit breaker was open).",
+        None),
+    'toshokan_provider_hedges_total': (
+        'counter', "Hedged lookups: sent, and won by answering before the "
+        "first attempt.", None),
+    'toshokan_circuit_opened_total': (
+        'counter', "Times a provider was skipped for failing too often.",
+        None),
+    'toshokan_provider_cache_total': (
+        'counter', "Lookups in the provider response cache, by result.",
+        None),
+    'toshokan_commit_seconds': (
+        'histogram', "Time taken by database commits.", LATENCY_BUCKETS),
+    'toshokan_rows_written_total': (
+        'counter', "Rows written to the database, by table.", None)
+}
+
+_registry = None
+_sinks = []
+_flusher = None
+_stop_flushing = threading.Event()
+_null_timer = nullcontext()
+
+
+class metrics_registry:
+    '''
+    The current values of all counters and histograms. It is safe to share
+    between threads.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        # (name, labels) -> [bucket counts..., overflow count, sum, count]
+        self._histograms = {}
+
+    def count(self, name: str, value: float, labels: tuple) -> None:
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple) -> None:
+        buckets = _buckets(name)
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 3)
+            # Counted in the first bucket the value fits in; snapshot()
+            # makes the counts cumulative.
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(histogram)
+                          for key, histogram in self._histograms.items()}
+        result = {
+            'created': datetime.datetime.now(
+                datetime.timezone.utc).isoformat(),
+            'counters': [],
+            'histograms': []
+        }
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].append({'name': name, 'labels': dict(labels),
+                                       'value': value})
+        for (name, labels), histogram in sorted(histograms.items()):
+            cumulative = 0
+            buckets = {}
+            for bound, bucket_count in zip(_buckets(name) + (math.inf,),
+                                           histogram[:-2]):
+                cumulative += bucket_count
+                buckets[_format_bound(bound)] = cumulative
+            result['histograms'].append({'name': name,
+                                         'labels': dict(labels),
+                                         'buckets': buckets,
+                                         'sum': histogram[-2],
+                                         'count': histogram[-1]})
+        return result
+
+
+class _timer:
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name: str, labels: tuple):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        registry = _registry
+        if registry is not None:
+            registry.observe(self.name, time.perf_counter() - self.started,
+                             self.labels)
+
+
+def _buckets(name: str) -> tuple:
+    definition = METRICS.get(name)
+    return definition[2] if definition and definition[2] \
+        else LATENCY_BUCKETS
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == math.inf else repr(bound)
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def enabled() -> bool:
+    return _registry is not None
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    '''
+    Add value to the counter name with the given labels.
+    '''
+    if _registry is None:
+        return
+    _registry.count(name, value, _labels(labels))
+
+
+def observe(name: str, value: float, **labels) -> None:
+    '''
+    Add value to the histogram name with the given labels.
+    '''
+    if _registry is None:
+        return
+    _registry.observe(name, value, _labels(labels))
+
+
+def timer(name: str, **labels):
+    '''
+    Return a context manager adding the time its block takes, in seconds,
+    to the histogram name with the given labels.
+    '''
+    if _registry is None:
+        return _null_timer
+    return _timer(name, _labels(labels))
+
+
+def snapshot() -> dict:
+    '''
+    Return the current values of all metrics: a dictionary with a list of
+    "counters" (name, labels and value) and of "histograms" (name, labels,
+    cumulative counts per bucket bound, sum and count). Empty if metrics
+    are off.
+    '''
+    if _registry is None:
+        return {'counters': [], 'histograms': []}
+    return _registry.snapshot()
+
+
+def flush() -> None:
+    '''
+    Write the current metrics to every sink.
+    '''
+    if _registry is None or not _sinks:
+        return
+    current = snapshot()
+    for sink in _sinks:
+        try:
+            sink.write(current)
+        except OSError as e:
+            logger.warning(f"WARNING: Could not write the metrics to "
+                           f"{sink!r}: {e}")
+
+
+def enable(*sinks, interval: float = None) -> metrics_registry:
+    '''
+    Start collecting metrics and writing them to sinks. With interval, the
+    metrics are also written every interval seconds from a background
+    thread. Enabling again keeps the values collected so far.
+    '''
+    global _registry, _sinks, _flusher
+    if _registry is None:
+        _registry = metrics_registry()
+        atexit.register(flush)
+    _sinks = list(sinks)
+    if interval and _flusher is None:
+        _stop_flushing.clear()
+        _flusher = threading.Thread(target=_flush_every, args=(interval,),
+                                    name="toshokan-metrics", daemon=True)
+        _flusher.start()
+    return _registry
+
+
+def disable() -> None:
+    '''
+    Write the metrics one last time, then stop collecting them and forget
+    their values.
+    '''
+    global _registry, _sinks, _flusher
+    if _flusher is not None:
+        _stop_flushing.set()
+        _flusher.join()
+        _flusher = None
+    flush()
+    _registry = None
+    _sinks = []
+
+
+def _flush_every(interval: float) -> None:
+    while not _stop_flushing.wait(interval):
+        flush()
+
+
+def _write_atomically(path: str, text: str) -> None:
+    # Readers such as the node exporter never see a half written file.
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as output:
+        output.write(text)
+    os.replace(temp_path, path)
+
+
+class json_sink:
+    '''
+    Writes the snapshot of the metrics to the JSON file at path.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, current: dict) -> None:
+        _write_atomically(self.path, json.dumps(current, indent=2) + '\n')
+
+    def __repr__(self):
+        return f"json_sink({self.path!r})"
+
+
+class prometheus_sink:
+    '''
+    Writes the metrics to the file at path in the Prometheus text format.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, current: dict) -> None:
+        _write_atomically(self.path, to_prometheus(current))
+
+    def __repr__(self):
+        return f"prometheus_sink({self.path!r})"
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(labels: dict, **extra) -> str:
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(str(value))}"'
+                          for key, value in labels.items()) + '}'
+
+
+def to_prometheus(current: dict) -> str:
+    '''
+    Return a snapshot() in the Prometheus text exposition format.
+    '''
+    lines = []
+    described = set()
+
+    def describe(name, kind):
+        if name in described:
+            return
+        described.add(name)
+        help_text = METRICS.get(name, (kind, '', None))[1]
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+    for counter in current['counters']:
+        describe(counter['name'], 'counter')
+        lines.append(f"{counter['name']}{_format_labels(counter['labels'])} "
+                     f"{counter['value']}")
+    for histogram in current['histograms']:
+        name = histogram['name']
+        describe(name, 'histogram')
+        for bound, bucket_count in histogram['buckets'].items():
+            lines.append(f"{name}_bucket"
+                         f"{_format_labels(histogram['labels'], le=bound)} "
+                         f"{bucket_count}")
+        labels = _format_labels(histogram['labels'])
+        lines.append(f"{name}_sum{labels} {histogram['sum']}")
+        lines.append(f"{name}_count{labels} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
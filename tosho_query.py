@@ -0,0 +1,323 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Functions that read books back out of the database.
+
+Every function returns fully assembled book objects: title, authors,
+publisher, identifiers, pages, the number of volumes and the libraries
+holding them. A whole batch of books is read with a single query, with the
+authors and libraries gathered by group_concat(), instead of one query per
+author and publisher.
+
+The filters accepted by find_books(), iter_books(), stream_books(),
+get_books_page() and count_books() are:
+    title      -- part of the title, case insensitive
+    author     -- the exact name of one of the authors
+    publisher  -- the exact name of the publisher
+    library_id -- the LibraryID of a library holding a copy
+    isbn_13, isbn_10, issn, oclc, lccn -- the exact identifier
+'''
+
+import json
+import sqlite3
+from typing import Iterator
+from book import book
+from identifiers import canonical_isbn, isbn13_to_isbn10, normalize_identifier
+from tosho_sqlite import BOOK_IDENTIFIER_COLUMNS, MAX_SQL_PARAMETERS
+
+# Separates the names gathered by group_concat(). The ASCII unit separator
+# cannot be typed into a title or a name by accident, unlike a comma.
+_SEPARATOR = '\x1f'
+
+# The BookID and VolumeID columns of the join tables have no declared type.
+# Comparing them with b.BookID or v.VolumeID, which are INTEGER PRIMARY KEYs,
+# would apply integer affinity to the join table side and keep SQLite from
+# using its index, scanning the whole join table for every book instead. The
+# unary + strips the affinity of the primary key side.
+_BOOK_QUERY = (
+    "SELECT b.BookID, b.Title, b.PublishDate, b.Pages, b.ISBN_10, b.ISBN_13, "
+    "b.ISSN, b.OCLC, b.LCCN, p.Name, "
+    # Authors_Books rows are inserted in the order of book.authors
+    "(SELECT group_concat(Name, char(31)) FROM (SELECT a.Name FROM "
+    "Authors_Books ab JOIN Authors a ON a.AuthorID = ab.AuthorID WHERE "
+    "ab.BookID = +b.BookID ORDER BY ab.rowid)), "
+    "(SELECT COUNT(*) FROM Volumes v WHERE v.BookID = +b.BookID), "
+    "(SELECT group_concat(Name, char(31)) FROM (SELECT DISTINCT l.Name FROM "
+    "Volumes v JOIN Collections c ON c.VolumeID = +v.VolumeID JOIN "
+    "Libraries l ON l.LibraryID = c.LibraryID WHERE v.BookID = +b.BookID "
+    "ORDER BY l.Name)) "
+    "FROM Books b "
+    "LEFT JOIN Publishers_Books pb ON pb.BookID = +b.BookID "
+    "LEFT JOIN Publishers p ON p.PublisherID = pb.PublisherID "
+)
+
+
+def _row_to_book(row: tuple) -> book:
+    (book_id, title, publish_date, pages, isbn_10, isbn_13, issn, oclc, lccn,
+     publisher, authors, volume_count, libraries) = row
+    identifiers = {
+        'lccn': lccn,
+        'isbn_13': isbn_13,
+        'isbn_10': isbn_10,
+        'oclc': oclc,
+        'issn': issn
+    }
+    return book(title,
+                authors.split(_SEPARATOR) if authors else ["UNKNOWN"],
+                publisher if publisher is not None else "UNKNOWN",
+                publish_date,
+                identifiers,
+                pages,
+                book_id,
+                volume_count,
+                libraries.split(_SEPARATOR) if libraries else [])
+
+
+def _filter_to_sql(filters: dict) -> tuple:
+    '''
+    Turn the filters into a WHERE clause (without the WHERE) and its
+    parameters. Unknown filters raise a ValueError.
+    '''
+    clauses = []
+    parameters = []
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name == 'title':
+            clauses.append("b.Title LIKE ?")
+            parameters.append(f"%{value}%")
+        elif name == 'author':
+            clauses.append("EXISTS (SELECT 1 FROM Authors_Books ab JOIN "
+                           "Authors a ON a.AuthorID = ab.AuthorID WHERE "
+                           "ab.BookID = +b.BookID AND a.Name = ?)")
+            parameters.append(value)
+        elif name == 'publisher':
+            clauses.append("p.Name = ?")
+            parameters.append(value)
+        elif name == 'library_id':
+            clauses.append("EXISTS (SELECT 1 FROM Volumes v JOIN Collections "
+                           "c ON c.VolumeID = +v.VolumeID WHERE v.BookID = "
+                           "+b.BookID AND c.LibraryID = ?)")
+            parameters.append(value)
+        elif name in BOOK_IDENTIFIER_COLUMNS:
+            clauses.append(f"b.{BOOK_IDENTIFIER_COLUMNS[name]} = ?")
+            parameters.append(normalize_identifier(name, value))
+        else:
+            raise ValueError(f"Unknown filter {name!r}.")
+    return " AND ".join(clauses) or "1", parameters
+
+
+def get_book(db_cursor: sqlite3.Cursor, book_id: int) -> book:
+    '''
+    Return the book with the given BookID, or None if there is no such book.
+    '''
+    books = get_books(db_cursor, [book_id])
+    return books[0] if books else None
+
+
+def get_books(db_cursor: sqlite3.Cursor, book_ids: list) -> list:
+    '''
+    Return the books with the given BookIDs, in the same order. BookIDs that
+    do not exist are skipped.
+    '''
+    book_ids = list(book_ids)
+    found_books = {}
+    for start in range(0, len(book_ids), MAX_SQL_PARAMETERS):
+        chunk = book_ids[start:start + MAX_SQL_PARAMETERS]
+        placeholders = ", ".join("?" * len(chunk))
+        db_cursor.execute(f"{_BOOK_QUERY} WHERE b.BookID IN ({placeholders})",
+                          chunk)
+        for row in db_cursor.fetchall():
+            found_books[row[0]] = _row_to_book(row)
+    return [found_books[book_id] for book_id in book_ids
+            if book_id in found_books]
+
+
+def find_book_id(db_cursor: sqlite3.Cursor, idtype: str,
+                 identifier) -> int:
+    '''
+    Return the BookID of the book with the given identifier, or None if the
+    catalog does not have it. idtype is "isbn" (either kind of ISBN) or one
+    of the keys of BOOK_IDENTIFIER_COLUMNS, in any case. An ISBN matches the
+    book whichever of its ISBN-10 and ISBN-13 was stored.
+    '''
+    idtype = idtype.lower()
+    if idtype in ('isbn', 'isbn_10', 'isbn_13'):
+        isbn_13 = canonical_isbn(identifier)
+        if isbn_13 is None:
+            return None
+        # Two lookups, each on its own UNIQUE index.
+        db_cursor.execute("SELECT BookID FROM Books WHERE ISBN_13 = ? UNION "
+                          "ALL SELECT BookID FROM Books WHERE ISBN_10 = ? "
+                          "LIMIT 1", [isbn_13, isbn13_to_isbn10(isbn_13)])
+    elif idtype in BOOK_IDENTIFIER_COLUMNS:
+        db_cursor.execute(f"SELECT BookID FROM Books WHERE "
+                          f"{BOOK_IDENTIFIER_COLUMNS[idtype]} = ?",
+                          [normalize_identifier(idtype, identifier)])
+    else:
+        raise ValueError(f"Unknown identifier type {idtype!r}.")
+    row = db_cursor.fetchone()
+    return row[0] if row else None
+
+
+def find_isbn_book_ids(db_cursor: sqlite3.Cursor, isbns: list) -> dict:
+    '''
+    The batched counterpart of find_book_id() for ISBNs. isbns are ISBN-13s
+    as returned by identifiers.canonical_isbn(). Return a dictionary mapping
+    those the catalog has to the BookID of their book.
+    '''
+    book_ids = {}
+    isbns = list(isbns)
+    for start in range(0, len(isbns), MAX_SQL_PARAMETERS):
+        chunk = isbns[start:start + MAX_SQL_PARAMETERS]
+        placeholders = ", ".join("?" * len(chunk))
+        db_cursor.execute(f"SELECT ISBN_13, BookID FROM Books WHERE ISBN_13 "
+                          f"IN ({placeholders})", chunk)
+        book_ids.update(db_cursor.fetchall())
+    # The books stored with only their ISBN-10.
+    isbns_10 = {isbn13_to_isbn10(isbn): isbn for isbn in isbns
+                if isbn not in book_ids}
+    isbns_10.pop(None, None)
+    isbn_10_list = list(isbns_10)
+    for start in range(0, len(isbn_10_list), MAX_SQL_PARAMETERS):
+        chunk = isbn_10_list[start:start + MAX_SQL_PARAMETERS]
+        placeholders = ", ".join("?" * len(chunk))
+        db_cursor.execute(f"SELECT ISBN_10, BookID FROM Books WHERE ISBN_10 "
+                          f"IN ({placeholders})", chunk)
+        for isbn_10, book_id in db_cursor.fetchall():
+            book_ids[isbns_10[isbn_10]] = book_id
+    return book_ids
+
+
+def find_books(db_cursor: sqlite3.Cursor, limit: int = None,
+               **filters) -> list:
+    '''
+    Return the books matching all of the filters, ordered by BookID. At most
+    limit books are returned if limit is given.
+    '''
+    where, parameters = _filter_to_sql(filters)
+    query = f"{_BOOK_QUERY} WHERE {where} ORDER BY b.BookID"
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters.append(limit)
+    db_cursor.execute(query, parameters)
+    return [_row_to_book(row) for row in db_cursor.fetchall()]
+
+
+def iter_books(db_cursor: sqlite3.Cursor, batch_size: int = 500,
+               **filters) -> Iterator[book]:
+    '''
+    Yield every book matching the filters, ordered by BookID.
+
+    The books are read batch_size at a time. Each batch is a separate query
+    continuing after the last BookID of the previous one, so no statement is
+    left open between batches and the whole catalog never has to fit in
+    memory.
+    '''
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    where, parameters = _filter_to_sql(filters)
+    last_book_id = 0
+    while True:
+        db_cursor.execute(f"{_BOOK_QUERY} WHERE b.BookID > ? AND {where} "
+                          "ORDER BY b.BookID LIMIT ?",
+                          [last_book_id] + parameters + [batch_size])
+        rows = db_cursor.fetchall()
+        for row in rows:
+            yield _row_to_book(row)
+        if len(rows) < batch_size:
+            return
+        last_book_id = rows[-1][0]
+
+
+def stream_books(db_cursor: sqlite3.Cursor, chunk_size: int = 1000,
+                 **filters) -> Iterator[book]:
+    '''
+    Yield every book matching the filters, ordered by BookID, from a single
+    query whose rows are fetched chunk_size at a time with fetchmany().
+
+    Books are ordered by the primary key, so SQLite hands the rows out as it
+    finds them and never builds the whole result. Unlike iter_books(), the
+    statement stays open until the generator is exhausted, and db_cursor
+    must not be used for anything else in the meantime. This is the fastest
+    way to read the whole catalog; run it inside a read transaction (see
+    tosho_database.reading()) so that it reads a single snapshot.
+    '''
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    where, parameters = _filter_to_sql(filters)
+    db_cursor.execute(f"{_BOOK_QUERY} WHERE {where} ORDER BY b.BookID",
+                      parameters)
+    while True:
+        rows = db_cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        for row in rows:
+            yield _row_to_book(row)
+
+
+def get_books_page(db_cursor: sqlite3.Cursor, page: int = 1,
+                   page_size: int = 50, **filters) -> list:
+    '''
+    Return page number page (counting from 1) of the books matching the
+    filters, page_size books per page, ordered by BookID. Use count_books()
+    to find the number of pages.
+    '''
+    if page < 1 or page_size < 1:
+        raise ValueError("page and page_size must be at least 1")
+    where, parameters = _filter_to_sql(filters)
+    db_cursor.execute(f"{_BOOK_QUERY} WHERE {where} ORDER BY b.BookID "
+                      "LIMIT ? OFFSET ?",
+                      parameters + [page_size, (page - 1) * page_size])
+    return [_row_to_book(row) for row in db_cursor.fetchall()]
+
+
+def count_books(db_cursor: sqlite3.Cursor, **filters) -> int:
+    '''
+    Return the number of books matching the filters.
+    '''
+    where, parameters = _filter_to_sql(filters)
+    db_cursor.execute("SELECT COUNT(*) FROM Books b LEFT JOIN "
+                      "Publishers_Books pb ON pb.BookID = +b.BookID LEFT JOIN "
+                      "Publishers p ON p.PublisherID = pb.PublisherID WHERE "
+                      f"{where}", parameters)
+    return db_cursor.fetchone()[0]
+
+
+def get_merge_conflicts(db_cursor: sqlite3.Cursor, resolved: bool = False,
+                        limit: int = 100) -> list:
+    '''
+    Return up to limit entries of the review queue MergeConflicts, oldest
+    first, as dictionaries. Only the conflicts not yet reviewed are returned
+    unless resolved is True.
+    '''
+    db_cursor.execute("SELECT ConflictID, IdType, Identifier, Field, "
+                      "Candidates, Chosen, Rule, Created, Resolved FROM "
+                      "MergeConflicts WHERE Resolved <= ? ORDER BY "
+                      "ConflictID LIMIT ?", [int(resolved), limit])
+    return [{
+        'conflict_id': conflict_id,
+        'id_type': id_type,
+        'identifier': identifier,
+        'field': field,
+        'candidates': json.loads(candidates),
+        'chosen': json.loads(chosen),
+        'rule': rule,
+        'created': created,
+        'resolved': bool(is_resolved)
+    } for (conflict_id, id_type, identifier, field, candidates, chosen, rule,
+           created, is_resolved) in db_cursor.fetchall()]
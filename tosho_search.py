@@ -0,0 +1,102 @@
+# toshokan
+# Copyright (C) 2020 Aayush Agarwal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Full-text search over the titles, authors and publishers of the catalog.
+
+The search uses the FTS5 table BooksSearch, which is created by schema
+migration 2 in tosho_sqlite and kept up to date by triggers on Books,
+Authors_Books, Publishers_Books, Authors and Publishers (the ones of
+migration 3, which replaced those of migration 2). Results are ranked
+with BM25, weighing a match in the title above one in the author names,
+and one in the author names above one in the publisher name.
+'''
+
+import logging
+import re
+import sqlite3
+import tosho_query
+from tosho_sqlite import SEARCH_INDEX_QUERY
+logger = logging.getLogger(__name__)
+
+# The BM25 weights of the columns Title, Authors and Publisher.
+COLUMN_WEIGHTS = (10.0, 5.0, 2.0)
+
+
+def _match_expression(query: str) -> str:
+    '''
+    Turn what the user typed into an FTS5 MATCH expression that finds the
+    books containing every word, with the last letters of each word left
+    open ("tez osa" finds "Osamu Tezuka").
+
+    Every word is quoted, so characters that mean something in the FTS5
+    query syntax (quotes, colons, AND, NEAR, ...) are searched for literally
+    instead of causing an error.
+    '''
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_book_ids(db_cursor: sqlite3.Cursor, query: str,
+                    limit: int = 20) -> list:
+    '''
+    Return a list of (BookID, rank) tuples for the best limit matches of
+    query, best first. A lower rank is a better match.
+    '''
+    match = _match_expression(query)
+    if not match:
+        return []
+    db_cursor.execute("SELECT rowid, bm25(BooksSearch, ?, ?, ?) AS rank FROM "
+                      "BooksSearch WHERE BooksSearch MATCH ? ORDER BY rank "
+                      "LIMIT ?", list(COLUMN_WEIGHTS) + [match, limit])
+    return db_cursor.fetchall()
+
+
+def search(db_cursor: sqlite3.Cursor, query: str, limit: int = 20) -> list:
+    '''
+    Return the books that best match query, best first.
+    '''
+    book_ids = [book_id for book_id, rank
+                in search_book_ids(db_cursor, query, limit)]
+    return tosho_query.get_books(db_cursor, book_ids)
+
+
+def rebuild_search_index(db_conn: sqlite3.Connection) -> int:
+    '''
+    Throw away the contents of BooksSearch and index every book again.
+    Return the number of books indexed.
+
+    The triggers keep the index in sync, so this is only needed if the index
+    was damaged or rows were changed with the triggers missing.
+    '''
+    if db_conn.in_transaction:
+        db_conn.commit()
+    db_cursor = db_conn.cursor()
+    db_cursor.execute("BEGIN IMMEDIATE;")
+    try:
+        db_cursor.execute("DELETE FROM BooksSearch;")
+        db_cursor.execute("INSERT INTO BooksSearch(rowid, Title, Authors, "
+                          f"Publisher) {SEARCH_INDEX_QUERY};")
+        book_count = db_cursor.rowcount
+        # Merge the index b-trees into one for the fastest queries.
+        db_cursor.execute("INSERT INTO BooksSearch(BooksSearch) VALUES "
+                          "('optimize');")
+    except BaseException:
+        db_conn.rollback()
+        raise
+    db_conn.commit()
+    logger.info(f"Rebuilt the search index for {book_count} books.")
+    return book_count
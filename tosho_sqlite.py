@@ -23,42 +23,450 @@ database and the user.
 # the sequence of which calls are to be clubbed together for the user are
 # decided.
 
+import json
 import sqlite3
 import logging
-from book import book
+import time
+from contextlib import contextmanager
+from typing import Iterable
+import tosho_metrics
+from book import book, BookBatch
+from identifiers import normalize_identifier
 logger = logging.getLogger(__name__)
 
+# The identifier columns of the table "Books" and the keys of
+# book.identifiers they are filled from. Every one of them is UNIQUE.
+# ISBN_10, ISBN_13 and ISSN hold the normalised strings of
+# identifiers.normalize_identifier().
+BOOK_IDENTIFIER_COLUMNS = {
+    'isbn_13': 'ISBN_13',
+    'isbn_10': 'ISBN_10',
+    'issn': 'ISSN',
+    'oclc': 'OCLC',
+    'lccn': 'LCCN'
+}
+
+# The author and publisher names indexed for full-text search (see
+# tosho_search) for the book with BookID {book_id}. The BookID columns of the
+# join tables have no declared type, so {book_id} is prefixed with a unary +
+# to drop its integer affinity; otherwise SQLite cannot use the index on
+# ab.BookID or pb.BookID and scans the whole join table instead.
+_SEARCH_AUTHORS = ("(SELECT group_concat(a.Name, ' ') FROM Authors_Books ab "
+                   "JOIN Authors a ON a.AuthorID = ab.AuthorID WHERE "
+                   "ab.BookID = +{book_id})")
+_SEARCH_PUBLISHER = ("(SELECT group_concat(p.Name, ' ') FROM Publishers_Books "
+                     "pb JOIN Publishers p ON p.PublisherID = pb.PublisherID "
+                     "WHERE pb.BookID = +{book_id})")
+
+# The same as created by migration 2, which must not change.
+_SEARCH_AUTHORS_V2 = ("(SELECT group_concat(a.Name, ' ') FROM Authors_Books "
+                      "ab JOIN Authors a ON a.AuthorID = ab.AuthorID WHERE "
+                      "ab.BookID = {book_id})")
+_SEARCH_PUBLISHER_V2 = ("(SELECT group_concat(p.Name, ' ') FROM "
+                        "Publishers_Books pb JOIN Publishers p ON "
+                        "p.PublisherID = pb.PublisherID WHERE pb.BookID = "
+                        "{book_id})")
+
+# Selects the rows of the full-text search table BooksSearch from scratch.
+SEARCH_INDEX_QUERY = ("SELECT BookID, Title, "
+                      f"{_SEARCH_AUTHORS.format(book_id='Books.BookID')}, "
+                      f"{_SEARCH_PUBLISHER.format(book_id='Books.BookID')} "
+                      "FROM Books")
+
+# The triggers that keep BooksSearch in sync with the tables it indexes, as
+# created by migration 3 and recreated by later migrations.
+_SEARCH_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Books_Insert AFTER INSERT ON "
+    "Books BEGIN INSERT INTO BooksSearch(rowid, Title, Authors, Publisher)"
+    f" VALUES (NEW.BookID, NEW.Title, "
+    f"{_SEARCH_AUTHORS.format(book_id='NEW.BookID')}, "
+    f"{_SEARCH_PUBLISHER.format(book_id='NEW.BookID')}); END;",
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Books_Update AFTER UPDATE OF "
+    "Title ON Books BEGIN UPDATE BooksSearch SET Title = NEW.Title WHERE "
+    "rowid = NEW.BookID; END;",
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Books_Delete AFTER DELETE ON "
+    "Books BEGIN DELETE FROM BooksSearch WHERE rowid = OLD.BookID; END;",
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Authors_Books_Insert AFTER "
+    "INSERT ON Authors_Books BEGIN UPDATE BooksSearch SET Authors = "
+    f"{_SEARCH_AUTHORS.format(book_id='NEW.BookID')} WHERE rowid = "
+    "NEW.BookID; END;",
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Authors_Books_Delete AFTER "
+    "DELETE ON Authors_Books BEGIN UPDATE BooksSearch SET Authors = "
+    f"{_SEARCH_AUTHORS.format(book_id='OLD.BookID')} WHERE rowid = "
+    "OLD.BookID; END;",
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Publishers_Books_Insert "
+    "AFTER INSERT ON Publishers_Books BEGIN UPDATE BooksSearch SET "
+    f"Publisher = {_SEARCH_PUBLISHER.format(book_id='NEW.BookID')} WHERE "
+    "rowid = NEW.BookID; END;",
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Publishers_Books_Delete "
+    "AFTER DELETE ON Publishers_Books BEGIN UPDATE BooksSearch SET "
+    f"Publisher = {_SEARCH_PUBLISHER.format(book_id='OLD.BookID')} WHERE "
+    "rowid = OLD.BookID; END;",
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Authors_Update AFTER UPDATE "
+    "OF Name ON Authors BEGIN UPDATE BooksSearch SET Authors = "
+    f"{_SEARCH_AUTHORS.format(book_id='BooksSearch.rowid')} WHERE rowid "
+    "IN (SELECT BookID FROM Authors_Books WHERE AuthorID = "
+    "NEW.AuthorID); END;",
+    "CREATE TRIGGER IF NOT EXISTS BooksSearch_Publishers_Update AFTER "
+    "UPDATE OF Name ON Publishers BEGIN UPDATE BooksSearch SET Publisher "
+    f"= {_SEARCH_PUBLISHER.format(book_id='BooksSearch.rowid')} WHERE "
+    "rowid IN (SELECT BookID FROM Publishers_Books WHERE PublisherID = "
+    "NEW.PublisherID); END;"
+]
+_SEARCH_TRIGGER_NAMES = [
+    'BooksSearch_Books_Insert', 'BooksSearch_Books_Update',
+    'BooksSearch_Books_Delete', 'BooksSearch_Authors_Books_Insert',
+    'BooksSearch_Authors_Books_Delete', 'BooksSearch_Publishers_Books_Insert',
+    'BooksSearch_Publishers_Books_Delete', 'BooksSearch_Authors_Update',
+    'BooksSearch_Publishers_Update'
+]
+
+def _normalised_column(column: str, length: int) -> str:
+    '''
+    Return an SQL expression for the value of an identifier column as a
+    string of length digits without hyphens or spaces.
+    '''
+    return (f"CASE WHEN typeof({column}) = 'integer' THEN "
+            f"printf('%0{length}d', {column}) ELSE "
+            f"upper(replace(replace(trim({column}), '-', ''), ' ', '')) END")
+
+
+# Upgrades to the schema created by create_new_database(). Migration n (the
+# n-th entry, counting from 1) takes a database from PRAGMA user_version n - 1
+# to n. Databases created before this list existed have user_version 0.
+#
+# NOTE: Never edit a migration that has been released; append a new one. A
+#       migration that changes a table created by create_new_database() must
+#       change it there as well, and be listed in TABLE_REBUILD_MIGRATIONS.
+SCHEMA_MIGRATIONS = [
+    # 1: Indexes on the foreign key columns of the join tables that are not
+    #    already the first column of a UNIQUE constraint.
+    [
+        "CREATE INDEX IF NOT EXISTS Authors_Books_BookID ON "
+        "Authors_Books(BookID);",
+        "CREATE INDEX IF NOT EXISTS Publishers_Books_PublisherID ON "
+        "Publishers_Books(PublisherID);",
+        "CREATE INDEX IF NOT EXISTS Volumes_BookID ON Volumes(BookID);",
+        "CREATE INDEX IF NOT EXISTS Collections_LibraryID ON "
+        "Collections(LibraryID);",
+        "CREATE INDEX IF NOT EXISTS Borrowings_VolumeID ON "
+        "Borrowings(VolumeID);"
+    ],
+    # 2: The FTS5 table BooksSearch over titles, author names and publisher
+    #    names, kept in sync by triggers. Its rowid is the BookID.
+    #    (Migration 3 replaces these triggers.)
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS BooksSearch USING fts5(Title, "
+        "Authors, Publisher, tokenize = 'unicode61 remove_diacritics 2', "
+        "prefix = '2 3');",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Books_Insert AFTER INSERT "
+        "ON Books BEGIN INSERT INTO BooksSearch(rowid, Title, Authors, "
+        "Publisher) VALUES (NEW.BookID, NEW.Title, "
+        f"{_SEARCH_AUTHORS_V2.format(book_id='NEW.BookID')}, "
+        f"{_SEARCH_PUBLISHER_V2.format(book_id='NEW.BookID')}); END;",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Books_Update AFTER UPDATE "
+        "OF Title ON Books BEGIN UPDATE BooksSearch SET Title = NEW.Title "
+        "WHERE rowid = NEW.BookID; END;",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Books_Delete AFTER DELETE "
+        "ON Books BEGIN DELETE FROM BooksSearch WHERE rowid = OLD.BookID; "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Authors_Books_Insert AFTER "
+        "INSERT ON Authors_Books BEGIN UPDATE BooksSearch SET Authors = "
+        f"{_SEARCH_AUTHORS_V2.format(book_id='NEW.BookID')} WHERE rowid = "
+        "NEW.BookID; END;",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Authors_Books_Delete AFTER "
+        "DELETE ON Authors_Books BEGIN UPDATE BooksSearch SET Authors = "
+        f"{_SEARCH_AUTHORS_V2.format(book_id='OLD.BookID')} WHERE rowid = "
+        "OLD.BookID; END;",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Publishers_Books_Insert "
+        "AFTER INSERT ON Publishers_Books BEGIN UPDATE BooksSearch SET "
+        f"Publisher = {_SEARCH_PUBLISHER_V2.format(book_id='NEW.BookID')} "
+        "WHERE rowid = NEW.BookID; END;",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Publishers_Books_Delete "
+        "AFTER DELETE ON Publishers_Books BEGIN UPDATE BooksSearch SET "
+        f"Publisher = {_SEARCH_PUBLISHER_V2.format(book_id='OLD.BookID')} "
+        "WHERE rowid = OLD.BookID; END;",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Authors_Update AFTER UPDATE "
+        "OF Name ON Authors BEGIN UPDATE BooksSearch SET Authors = "
+        f"{_SEARCH_AUTHORS_V2.format(book_id='BooksSearch.rowid')} WHERE "
+        "rowid IN (SELECT BookID FROM Authors_Books WHERE AuthorID = "
+        "NEW.AuthorID); END;",
+        "CREATE TRIGGER IF NOT EXISTS BooksSearch_Publishers_Update AFTER "
+        "UPDATE OF Name ON Publishers BEGIN UPDATE BooksSearch SET Publisher "
+        f"= {_SEARCH_PUBLISHER_V2.format(book_id='BooksSearch.rowid')} WHERE "
+        "rowid IN (SELECT BookID FROM Publishers_Books WHERE PublisherID = "
+        "NEW.PublisherID); END;",
+        "DELETE FROM BooksSearch;",
+        "INSERT INTO BooksSearch(rowid, Title, Authors, Publisher) SELECT "
+        f"BookID, Title, {_SEARCH_AUTHORS_V2.format(book_id='Books.BookID')}, "
+        f"{_SEARCH_PUBLISHER_V2.format(book_id='Books.BookID')} FROM Books;"
+    ],
+    # 3: Recreate the BooksSearch triggers of migration 2, whose lookups in
+    #    Authors_Books and Publishers_Books could not use the BookID indexes:
+    #    comparing the untyped BookID of a join table with NEW.BookID applied
+    #    integer affinity to it, so every author or publisher added scanned
+    #    the whole join table. _SEARCH_AUTHORS and _SEARCH_PUBLISHER now
+    #    compare with +NEW.BookID.
+    [
+        *[f"DROP TRIGGER IF EXISTS {name};" for name in _SEARCH_TRIGGER_NAMES],
+        *_SEARCH_TRIGGERS
+    ],
+    # 4: How far the imports of tosho_import got into each source file, so
+    #    that an interrupted import can resume where it stopped.
+    [
+        "CREATE TABLE IF NOT EXISTS ImportCheckpoints(Source TEXT PRIMARY "
+        "KEY, Format TEXT, Offset INT, Records INT, Imported INT, Skipped "
+        "INT, Updated TEXT);"
+    ],
+    # 5: The review queue of the fields the providers disagreed on, filled
+    #    by the merge policies of merge_policy.
+    [
+        "CREATE TABLE IF NOT EXISTS MergeConflicts(ConflictID INTEGER "
+        "PRIMARY KEY, IdType TEXT, Identifier TEXT, Field TEXT, Candidates "
+        "TEXT, Chosen TEXT, Rule TEXT, Created TEXT, Resolved INT NOT NULL "
+        "DEFAULT 0);",
+        "CREATE INDEX IF NOT EXISTS MergeConflicts_Resolved ON "
+        "MergeConflicts(Resolved, ConflictID);"
+    ],
+    # 6: Store ISBN_10, ISBN_13 and ISSN as TEXT. As integers, identifiers
+    #    starting with 0 lost a digit and those ending in X did not match.
+    #    SQLite cannot change the type of a column, so "Books" is rebuilt.
+    [
+        *[f"DROP TRIGGER IF EXISTS {name};" for name in _SEARCH_TRIGGER_NAMES],
+        "CREATE TABLE Books_new(BookID INTEGER PRIMARY KEY, Title, "
+        "PublishDate, Pages INT, ISBN_10 TEXT UNIQUE, ISBN_13 TEXT UNIQUE, "
+        "ISSN TEXT UNIQUE, OCLC INT UNIQUE, LCCN INT UNIQUE);",
+        "INSERT INTO Books_new(BookID, Title, PublishDate, Pages, ISBN_10, "
+        "ISBN_13, ISSN, OCLC, LCCN) SELECT BookID, Title, PublishDate, Pages, "
+        f"{_normalised_column('ISBN_10', 10)}, "
+        f"{_normalised_column('ISBN_13', 13)}, "
+        f"{_normalised_column('ISSN', 8)}, OCLC, LCCN FROM Books;",
+        "DROP TABLE Books;",
+        "ALTER TABLE Books_new RENAME TO Books;",
+        *_SEARCH_TRIGGERS
+    ]
+]
+# Migrations that rebuild a table referenced by foreign keys. They run with
+# foreign_keys OFF, as dropping the old table would otherwise delete every
+# row referring to it. New databases are created without them, see
+# create_new_database().
+TABLE_REBUILD_MIGRATIONS = frozenset([6])
+
+# Named sets of PRAGMAs applied by connect_to_database().
+#   interactive       -- scanning and searching at the desk: WAL so readers
+#                        never wait for the writer, and durable commits.
+#   bulk-import       -- large imports: a big page cache and fewer WAL
+#                        checkpoints. synchronous=NORMAL is still safe in WAL
+#                        mode; a crash can only lose the last transactions.
+#   read-only-replica -- reporting and exports from another process: the file
+#                        is opened read-only and leans on mmap and the cache.
+# Negative cache_size values are in KiB, mmap_size is in bytes and
+# busy_timeout in milliseconds. foreign_keys must be ON for the ON DELETE
+# CASCADE clauses of the schema to have any effect.
+CONNECTION_PROFILES = {
+    'interactive': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'foreign_keys': 'ON',
+        'cache_size': -16384,
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000
+    },
+    'bulk-import': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'foreign_keys': 'ON',
+        'cache_size': -262144,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 30000,
+        'wal_autocheckpoint': 10000
+    },
+    'read-only-replica': {
+        'query_only': 'ON',
+        'cache_size': -65536,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000
+    }
+}
+DEFAULT_PROFILE = 'interactive'
+# Profiles that open the database file read-only.
+READ_ONLY_PROFILES = frozenset(['read-only-replica'])
+
+# Older SQLite builds refuse statements with more than 999 host parameters, so
+# IN (...) lookups are split into chunks no larger than this.
+MAX_SQL_PARAMETERS = 900
+
 # NOTE: Database Connection, Creation and Initialisation code here.
 
 
+class metered_connection(sqlite3.Connection):
+    '''
+    A connection that reports how long its commits take to tosho_metrics.
+    All connections to the database are made with this class.
+
+    Most functions of this module commit after every statement. Inside
+    hold_commits() their commits leave the transaction open instead, so
+    that they can be part of a larger transaction.
+    '''
+
+    _commits_held = False
+
+    @contextmanager
+    def hold_commits(self):
+        '''
+        Make commit() do nothing until the block ends. The caller commits
+        or rolls back the transaction afterwards.
+        '''
+        self._commits_held = True
+        try:
+            yield self
+        finally:
+            self._commits_held = False
+
+    def commit(self) -> None:
+        if self._commits_held:
+            return
+        if not self.in_transaction:
+            super().commit()
+            return
+        with tosho_metrics.timer('toshokan_commit_seconds'):
+            super().commit()
+
+
 def connect_to_database(db_path: str,
-                        db_name: str) -> sqlite3.Connection:
+                        db_name: str,
+                        profile: str = DEFAULT_PROFILE,
+                        check_same_thread: bool = True) -> sqlite3.Connection:
     '''
     Given a path and file name, connect to a SQLite v3 database. If the file
     does not exist, then it is created by calling create_new_database().
+
+    The connection is set up with the PRAGMAs of one of the
+    CONNECTION_PROFILES. A read-only profile never creates or migrates the
+    database. Pass check_same_thread=False only if the caller makes sure
+    that one thread at a time uses the connection.
     '''
+    if profile not in CONNECTION_PROFILES:
+        raise ValueError(f"Unknown connection profile {profile!r}. Valid "
+                         f"profiles are {', '.join(CONNECTION_PROFILES)}.")
+    if profile in READ_ONLY_PROFILES:
+        db_conn = sqlite3.connect(f"file:{db_path}{db_name}?mode=ro", uri=True,
+                                  check_same_thread=check_same_thread,
+                                  factory=metered_connection)
+        apply_connection_profile(db_conn, profile)
+        schema_version = \
+            db_conn.execute("PRAGMA user_version;").fetchone()[0]
+        if schema_version < len(SCHEMA_MIGRATIONS):
+            logger.warning("WARNING: The database has an old schema and "
+                           "cannot be upgraded through a read-only "
+                           "connection!")
+        return db_conn
     try:
-        db_conn = sqlite3.connect(f"file:{db_path}{db_name}?mode=rw", uri=True)
+        db_conn = sqlite3.connect(f"file:{db_path}{db_name}?mode=rw", uri=True,
+                                  check_same_thread=check_same_thread,
+                                  factory=metered_connection)
     except sqlite3.OperationalError:
         logger.warning("WARNING: File not found! Creating new database!")
         db_conn = create_new_database(db_path, db_name)
         db_conn.close()
-        db_conn = connect_to_database(db_path, db_name)
+        db_conn = connect_to_database(db_path, db_name, profile,
+                                      check_same_thread)
+    else:
+        apply_connection_profile(db_conn, profile)
+        migrate_database(db_conn)
     return db_conn
 
 
+def apply_connection_profile(db_conn: sqlite3.Connection,
+                             profile: str) -> None:
+    '''
+    Set the PRAGMAs of a profile in CONNECTION_PROFILES on a connection. This
+    has to happen outside of a transaction, as foreign_keys and journal_mode
+    cannot be changed inside one.
+    '''
+    if db_conn.in_transaction:
+        db_conn.commit()
+    for pragma, value in CONNECTION_PROFILES[profile].items():
+        # PRAGMA does not accept parameters; the values come from the table
+        # above, never from the user.
+        db_conn.execute(f"PRAGMA {pragma} = {value};").fetchall()
+
+
+def migrate_database(db_conn: sqlite3.Connection) -> int:
+    '''
+    Bring the schema of a database up to date by applying every migration in
+    SCHEMA_MIGRATIONS it has not seen yet. Each migration is applied in its
+    own transaction together with the new PRAGMA user_version, so an
+    interrupted upgrade can simply be run again. Return the schema version.
+    '''
+    db_cursor = db_conn.cursor()
+    schema_version = db_cursor.execute("PRAGMA user_version;").fetchone()[0]
+    latest_version = len(SCHEMA_MIGRATIONS)
+    if schema_version > latest_version:
+        logger.warning(f"WARNING: The database has schema version "
+                       f"{schema_version}, but this version of toshokan only "
+                       f"knows up to {latest_version}!")
+        return schema_version
+    if db_conn.in_transaction:
+        db_conn.commit()
+    while schema_version < latest_version:
+        migration = SCHEMA_MIGRATIONS[schema_version]
+        schema_version += 1
+        logger.info(f"Migrating the database to schema version "
+                    f"{schema_version}.")
+        rebuild = schema_version in TABLE_REBUILD_MIGRATIONS
+        if rebuild:
+            # foreign_keys cannot be changed inside a transaction.
+            foreign_keys = \
+                db_cursor.execute("PRAGMA foreign_keys;").fetchone()[0]
+            db_cursor.execute("PRAGMA foreign_keys = OFF;")
+        try:
+            db_cursor.execute("BEGIN;")
+            try:
+                for instruction in migration:
+                    db_cursor.execute(instruction)
+                if rebuild and db_cursor.execute(
+                        "PRAGMA foreign_key_check;").fetchall():
+                    raise sqlite3.IntegrityError(
+                        f"Schema migration {schema_version} broke foreign "
+                        f"keys.")
+                # PRAGMA does not accept parameters, but this is always an
+                # int.
+                db_cursor.execute(f"PRAGMA user_version = "
+                                  f"{int(schema_version)};")
+            except BaseException:
+                db_conn.rollback()
+                raise
+            db_cursor.execute("END;")
+        finally:
+            if rebuild:
+                db_cursor.execute(f"PRAGMA foreign_keys = "
+                                  f"{int(foreign_keys)};")
+    return schema_version
+
+
 def create_new_database(db_path: str,
                         db_name: str) -> sqlite3.Connection:
     '''
     Given a path and file name, create an SQLite v3 database and create the
     table schema for the newly created database.
+
+    The tables are created as they are after the last of SCHEMA_MIGRATIONS.
+    Of the migrations, only those that add to the schema are then applied,
+    never the TABLE_REBUILD_MIGRATIONS, and the database starts out at the
+    latest schema version.
     '''
-    db_conn = sqlite3.connect(f"file:{db_path}{db_name}?mode=rwc", uri=True)
+    db_conn = sqlite3.connect(f"file:{db_path}{db_name}?mode=rwc", uri=True,
+                              factory=metered_connection)
     db_cursor = db_conn.cursor()
     create_table_instructions = {
         'Books': "CREATE TABLE Books(BookID INTEGER PRIMARY KEY, Title, "
-                 "PublishDate, Pages INT, ISBN_10 INT UNIQUE, ISBN_13 INT "
-                 "UNIQUE, ISSN INT UNIQUE, OCLC INT UNIQUE, LCCN INT UNIQUE);",
+                 "PublishDate, Pages INT, ISBN_10 TEXT UNIQUE, ISBN_13 TEXT "
+                 "UNIQUE, ISSN TEXT UNIQUE, OCLC INT UNIQUE, LCCN INT "
+                 "UNIQUE);",
         'Authors': "CREATE TABLE Authors(AuthorID INTEGER PRIMARY KEY, "
                    "Name UNIQUE);",
         'Publishers': "CREATE TABLE Publishers(PublisherID INTEGER PRIMARY "
@@ -93,6 +501,12 @@ def create_new_database(db_path: str,
     db_cursor.execute("BEGIN;")
     for table in create_table_instructions:
         db_cursor.execute(create_table_instructions[table])
+    for schema_version, migration in enumerate(SCHEMA_MIGRATIONS, 1):
+        if schema_version not in TABLE_REBUILD_MIGRATIONS:
+            for instruction in migration:
+                db_cursor.execute(instruction)
+    # PRAGMA does not accept parameters, but this is always an int.
+    db_cursor.execute(f"PRAGMA user_version = {int(len(SCHEMA_MIGRATIONS))};")
     db_cursor.execute("END;")
     library_id = add_library_to_table(db_cursor)  # Create the Local library
     db_conn.commit()
@@ -103,15 +517,23 @@ def create_new_database(db_path: str,
 
 def add_record_to_database(db_cursor: sqlite3.Cursor,
                            relevant_book: book,
-                           library_id: int = 1) -> sqlite3.Cursor:
+                           library_id: int = 1,
+                           author_cache=None,
+                           publisher_cache=None) -> sqlite3.Cursor:
     '''
     Given a book object, add its details to the database.
+
+    author_cache and publisher_cache are optional name_id_cache objects (see
+    tosho_database) that remember the IDs of names seen before.
     '''
+    started = time.perf_counter()
     # First, add the details of the publisher
     publisher_id = add_publisher_to_table(db_cursor,
-                                          relevant_book.publisher)
+                                          relevant_book.publisher,
+                                          publisher_cache)
     # Then add the author(s)
-    author_ids = add_authors_to_table(db_cursor, relevant_book.authors)
+    author_ids = add_authors_to_table(db_cursor, relevant_book.authors,
+                                      author_cache)
     # Then add the details of the book
     book_id = add_book_to_database(db_cursor, relevant_book.title,
                                    relevant_book.publish_date,
@@ -120,12 +542,281 @@ def add_record_to_database(db_cursor: sqlite3.Cursor,
                                    author_ids)
     # Then create a volume for this book
     volume_id = add_volume_to_table(db_cursor, book_id)
-    print("add_volume_to_table")
     # Then add it to the library
     db_cursor = add_volume_library_relation(db_cursor, volume_id, library_id)
+    tosho_metrics.observe('toshokan_stage_seconds',
+                          time.perf_counter() - started, stage='store')
     return db_cursor
 
 
+def add_copy_to_database(db_cursor: sqlite3.Cursor, book_id: int,
+                         library_id: int = 1) -> int:
+    '''
+    Add another copy of a book that is already in the database: a new volume
+    of the book with the given BookID, stocked in the library library_id.
+    Return the VolumeID of the new volume.
+
+    Nothing is committed, so that the caller can look the book up and add
+    the copy in a single transaction.
+    '''
+    db_cursor.execute("INSERT INTO Volumes(BookID) VALUES (?)", [book_id])
+    volume_id = db_cursor.lastrowid
+    db_cursor.execute("INSERT INTO Collections(LibraryID, VolumeID) VALUES "
+                      "(?, ?)", [library_id, volume_id])
+    tosho_metrics.count('toshokan_rows_written_total', table='Volumes')
+    return volume_id
+
+
+def add_records_to_database(db_conn: sqlite3.Connection,
+                            books: Iterable[book],
+                            library_id: int = 1,
+                            batch_size: int = 1000,
+                            author_cache=None,
+                            publisher_cache=None,
+                            before_commit=None,
+                            new_book_ids: list = None) -> int:
+    '''
+    Given an iterable of book objects, add the details of all of them to the
+    database. Return the number of volumes that were created.
+
+    Unlike add_record_to_database(), which commits after every single INSERT,
+    the books are staged in batches of batch_size and each batch is written
+    with executemany() inside a single transaction. A book whose identifiers
+    are already in the database (or earlier in the same batch) is not added
+    twice; a new volume of the existing book is created instead.
+
+    author_cache and publisher_cache are optional name_id_cache objects (see
+    tosho_database) that remember the IDs of names seen before. Names added
+    by a batch that is rolled back are dropped from them again.
+
+    books may also be a BookBatch, whose columns are then written as they
+    are without creating a book object per row.
+
+    before_commit is an optional function called with the cursor and the
+    BookBatch at the end of each batch's transaction. Whatever it writes is
+    committed, or rolled back, together with the batch.
+
+    Every batch is a transaction of its own, so db_conn must not be in a
+    transaction already; a sqlite3.ProgrammingError is raised if it is,
+    rather than committing the caller's pending changes along the way.
+    Books without a publisher (None) are linked to none.
+
+    new_book_ids is an optional list the BookIDs of the books that were new
+    to the database are appended to once their batch is committed.
+    '''
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    volume_count = 0
+    if isinstance(books, BookBatch):
+        for start in range(0, len(books), batch_size):
+            volume_count += _add_record_batch(db_conn,
+                                              books.slice(start,
+                                                          start + batch_size),
+                                              library_id, author_cache,
+                                              publisher_cache, before_commit,
+                                              new_book_ids)
+        return volume_count
+    batch = BookBatch()
+    for relevant_book in books:
+        batch.append(relevant_book)
+        if len(batch) >= batch_size:
+            volume_count += _add_record_batch(db_conn, batch, library_id,
+                                              author_cache, publisher_cache,
+                                              before_commit, new_book_ids)
+            batch = BookBatch()
+    if batch:
+        volume_count += _add_record_batch(db_conn, batch, library_id,
+                                          author_cache, publisher_cache,
+                                          before_commit, new_book_ids)
+    return volume_count
+
+
+def _add_record_batch(db_conn: sqlite3.Connection, batch: BookBatch,
+                      library_id: int, author_cache=None,
+                      publisher_cache=None, before_commit=None,
+                      new_book_ids: list = None) -> int:
+    '''
+    Write one batch of books to the database in a single transaction. Return
+    the number of volumes created.
+    '''
+    started = time.perf_counter()
+    if db_conn.in_transaction:
+        raise sqlite3.ProgrammingError("Cannot write a batch of books while "
+                                       "another transaction is open. "
+                                       "Commit or roll it back first.")
+    db_cursor = db_conn.cursor()
+    # IMMEDIATE takes the write lock up front, so the IDs we hand out below
+    # from MAX(...) + 1 cannot be claimed by another writer before we insert.
+    db_cursor.execute("BEGIN IMMEDIATE;")
+    try:
+        # An unknown name is None; no row is added or linked for it.
+        publisher_ids = _add_names_to_table(db_cursor, "Publishers",
+                                            "PublisherID",
+                                            set(batch.publishers) - {None},
+                                            publisher_cache)
+        author_ids = _add_names_to_table(db_cursor, "Authors", "AuthorID",
+                                         {name for names in batch.authors
+                                          for name in names} - {None},
+                                         author_cache)
+        book_ids = _add_batch_books_to_table(db_cursor, batch)
+        added_book_ids = {book_id for book_id, is_new in book_ids if is_new}
+        db_cursor.executemany("INSERT OR IGNORE INTO Authors_Books(AuthorID, "
+                              "BookID) VALUES (?, ?)",
+                              [(author_ids[name], book_id)
+                               for names, (book_id, is_new)
+                               in zip(batch.authors, book_ids) if is_new
+                               for name in names if name is not None])
+        db_cursor.executemany("INSERT OR IGNORE INTO Publishers_Books("
+                              "PublisherID, BookID) VALUES (?, ?)",
+                              [(publisher_ids[publisher], book_id)
+                               for publisher, (book_id, is_new)
+                               in zip(batch.publishers, book_ids)
+                               if is_new and publisher is not None])
+        db_cursor.execute("SELECT COALESCE(MAX(VolumeID), 0) FROM Volumes")
+        next_volume_id = db_cursor.fetchone()[0] + 1
+        volume_rows = [(next_volume_id + i, book_id)
+                       for i, (book_id, is_new) in enumerate(book_ids)]
+        db_cursor.executemany("INSERT INTO Volumes(VolumeID, BookID) VALUES "
+                              "(?, ?)", volume_rows)
+        db_cursor.executemany("INSERT INTO Collections(LibraryID, VolumeID) "
+                              "VALUES (?, ?)",
+                              [(library_id, volume_id)
+                               for volume_id, book_id in volume_rows])
+        if before_commit is not None:
+            before_commit(db_cursor, batch)
+    except BaseException:
+        db_conn.rollback()
+        for id_cache in (author_cache, publisher_cache):
+            if id_cache is not None:
+                id_cache.rollback()
+        raise
+    db_conn.commit()
+    for id_cache in (author_cache, publisher_cache):
+        if id_cache is not None:
+            id_cache.commit()
+    if new_book_ids is not None:
+        new_book_ids.extend(sorted(added_book_ids))
+    logger.info(f"Added {len(added_book_ids)} new books and "
+                f"{len(volume_rows)} volumes to the database.")
+    if tosho_metrics.enabled():
+        tosho_metrics.observe('toshokan_stage_seconds',
+                              time.perf_counter() - started, stage='store')
+        tosho_metrics.count('toshokan_rows_written_total',
+                            len(added_book_ids), table='Books')
+        tosho_metrics.count('toshokan_rows_written_total', len(volume_rows),
+                            table='Volumes')
+    return len(volume_rows)
+
+
+def _add_names_to_table(db_cursor: sqlite3.Cursor, table: str, id_column: str,
+                        names: set, id_cache=None) -> dict:
+    '''
+    Add a set of names to the table "Authors" or "Publishers" and return a
+    dictionary that maps every name to its ID. Names that already exist are
+    left untouched, and names found in id_cache are not looked up at all.
+    '''
+    name_ids = {}
+    if id_cache is not None:
+        uncached_names = []
+        for name in names:
+            name_id = id_cache.get(name)
+            if name_id is None:
+                uncached_names.append(name)
+            else:
+                name_ids[name] = name_id
+        names = uncached_names
+    db_cursor.executemany(f"INSERT OR IGNORE INTO {table}(Name) VALUES (?)",
+                          [(name,) for name in names])
+    names = list(names)
+    for start in range(0, len(names), MAX_SQL_PARAMETERS):
+        chunk = names[start:start + MAX_SQL_PARAMETERS]
+        placeholders = ", ".join("?" * len(chunk))
+        db_cursor.execute(f"SELECT {id_column}, Name FROM {table} WHERE Name "
+                          f"IN ({placeholders})", chunk)
+        for row_id, name in db_cursor.fetchall():
+            name_ids[name] = row_id
+            if id_cache is not None:
+                # Pending until the batch is committed.
+                id_cache.add(name, row_id, pending=True)
+    return name_ids
+
+
+def _identifier_key(id_type: str, identifier):
+    '''
+    Return a value for an identifier that compares equal however it was
+    given to us. ISBNs and ISSNs are normalised strings, as they are stored;
+    the providers return the other identifiers as strings while the database
+    hands back integers for the same values.
+    '''
+    if id_type in ('isbn_10', 'isbn_13', 'issn'):
+        return normalize_identifier(id_type, identifier)
+    identifier_str = str(identifier).strip()
+    return int(identifier_str) if identifier_str.isdigit() else identifier_str
+
+
+def _add_batch_books_to_table(db_cursor: sqlite3.Cursor,
+                              batch: BookBatch) -> list:
+    '''
+    Add the books of a batch to the table "Books". Return a list with one
+    (BookID, is_new) tuple per book of the batch, in the same order.
+
+    Books are matched against the database and against each other by their
+    identifiers, so a book is only inserted once per batch no matter how many
+    copies of it are being added.
+    '''
+    identifier_columns = {id_type: [normalize_identifier(id_type, identifier)
+                                    for identifier
+                                    in batch.identifier_column(id_type)]
+                          for id_type in BOOK_IDENTIFIER_COLUMNS}
+    # First find out which identifiers are already in the database.
+    known_ids = {id_type: {} for id_type in BOOK_IDENTIFIER_COLUMNS}
+    for id_type, column in BOOK_IDENTIFIER_COLUMNS.items():
+        values = list({_identifier_key(id_type, identifier)
+                       for identifier in identifier_columns[id_type]
+                       if identifier is not None})
+        for start in range(0, len(values), MAX_SQL_PARAMETERS):
+            chunk = values[start:start + MAX_SQL_PARAMETERS]
+            placeholders = ", ".join("?" * len(chunk))
+            db_cursor.execute(f"SELECT BookID, {column} FROM Books WHERE "
+                              f"{column} IN ({placeholders})", chunk)
+            for book_id, value in db_cursor.fetchall():
+                known_ids[id_type][_identifier_key(id_type, value)] = book_id
+    db_cursor.execute("SELECT COALESCE(MAX(BookID), 0) FROM Books")
+    next_book_id = db_cursor.fetchone()[0] + 1
+    book_ids = []
+    book_rows = []
+    for index in range(len(batch)):
+        identifiers = {id_type: identifier_columns[id_type][index]
+                       for id_type in BOOK_IDENTIFIER_COLUMNS}
+        book_id = None
+        for id_type, identifier in identifiers.items():
+            if identifier is None:
+                continue
+            book_id = known_ids[id_type].get(_identifier_key(id_type,
+                                                             identifier))
+            if book_id is not None:
+                break
+        if book_id is not None:
+            book_ids.append((book_id, False))
+            continue
+        book_id = next_book_id
+        next_book_id += 1
+        for id_type, identifier in identifiers.items():
+            if identifier is not None:
+                known_ids[id_type][_identifier_key(id_type,
+                                                   identifier)] = book_id
+        book_ids.append((book_id, True))
+        book_rows.append((book_id, batch.titles[index],
+                          batch.publish_dates[index], batch.pages[index],
+                          identifiers['isbn_10'], identifiers['isbn_13'],
+                          identifiers['issn'], identifiers['oclc'],
+                          identifiers['lccn']))
+    db_cursor.executemany("INSERT INTO Books(BookID, Title, PublishDate, "
+                          "Pages, ISBN_10, ISBN_13, ISSN, OCLC, LCCN) VALUES "
+                          "(?, ?, ?, ?, ?, ?, ?, ?, ?)", book_rows)
+    return book_ids
+
+
 def add_book_to_database(db_cursor: sqlite3.Cursor, title: str,
                          publish_date: str, pages: int, identifiers: dict,
                          publisher_id: int, author_ids: int) -> int:
@@ -136,87 +827,95 @@ def add_book_to_database(db_cursor: sqlite3.Cursor, title: str,
     return book_id
 
 
-def add_publisher_to_table(db_cursor: sqlite3.Cursor, name: str) -> int:
+def add_publisher_to_table(db_cursor: sqlite3.Cursor, name: str,
+                           id_cache=None) -> int:
     '''
     Add the name of the Publisher to the table "Publishers". Return the
-    PublisherID of the added Publisher.
+    PublisherID of the added Publisher. If id_cache already knows the name,
+    no query is made at all.
     '''
-    try:
-        db_cursor.execute("INSERT INTO Publishers(Name) VALUES (?)",
-                          [name])
+    if id_cache is not None:
+        publisher_id = id_cache.get(name)
+        if publisher_id is not None:
+            return publisher_id
+    publisher_id, inserted = _add_name_to_table(db_cursor, "Publishers",
+                                                "PublisherID", name)
+    if inserted:
         db_cursor.connection.commit()
-    except sqlite3.IntegrityError:
+    else:
         logger.info(f"The publisher {name} already exists in the database.")
-    db_cursor.execute("SELECT PublisherID FROM Publishers WHERE Name=?",
-                      [name])
-    publisher_row = db_cursor.fetchone()
-    publisher_id = int(publisher_row[0])
+    if id_cache is not None:
+        # Pending if the commit was held, until the transaction ends.
+        id_cache.add(name, publisher_id,
+                     pending=db_cursor.connection.in_transaction)
     return publisher_id
 
 
-def add_authors_to_table(db_cursor: sqlite3.Cursor, authors: list) -> list:
+def add_authors_to_table(db_cursor: sqlite3.Cursor, authors: list,
+                         id_cache=None) -> list:
     '''
     Add a list of authors to the table "Authors". Return the AuthorIDs
     of the authors added to the table.
     '''
-    db_cursor = db_conn.cursor()
     author_ids = []
     for author_name in authors:
-        author_id = add_author_to_table(db_cursor, author_name)
+        author_id = add_author_to_table(db_cursor, author_name, id_cache)
         author_ids.append(author_id)
     return author_ids
 
 
-def add_author_to_table(db_cursor: sqlite3.Cursor, name: str) -> int:
+def add_author_to_table(db_cursor: sqlite3.Cursor, name: str,
+                        id_cache=None) -> int:
     '''
-    Add the name of an author to a table and return his author_id.
+    Add the name of an author to a table and return his author_id. If
+    id_cache already knows the name, no query is made at all.
     '''
-    try:
-        db_cursor.execute("INSERT INTO Authors(Name) VALUES (?)", [name])
+    if id_cache is not None:
+        author_id = id_cache.get(name)
+        if author_id is not None:
+            return author_id
+    author_id, inserted = _add_name_to_table(db_cursor, "Authors", "AuthorID",
+                                             name)
+    if inserted:
         db_cursor.connection.commit()
-    except sqlite3.IntegrityError:
+    else:
         logger.info(f"The author {name} already exists in the database.")
-    db_cursor.execute("SELECT AuthorID FROM Authors WHERE Name=?", [name])
-    author_row = db_cursor.fetchone()
-    author_id = int(author_row[0])
+    if id_cache is not None:
+        id_cache.add(name, author_id,
+                     pending=db_cursor.connection.in_transaction)
     return author_id
 
 
+def _add_name_to_table(db_cursor: sqlite3.Cursor, table: str, id_column: str,
+                       name: str) -> tuple:
+    '''
+    Add a name to the table "Authors", "Publishers" or "Libraries" unless it
+    is already there. Return a tuple of the ID of the name and whether it was
+    inserted.
+    '''
+    # OR IGNORE instead of catching the IntegrityError: the new ID is then
+    # simply lastrowid, and only an existing name costs a second query, which
+    # the UNIQUE index on Name answers directly.
+    db_cursor.execute(f"INSERT OR IGNORE INTO {table}(Name) VALUES (?)",
+                      [name])
+    if db_cursor.rowcount == 1:
+        return db_cursor.lastrowid, True
+    db_cursor.execute(f"SELECT {id_column} FROM {table} WHERE Name=?", [name])
+    return db_cursor.fetchone()[0], False
+
+
 def add_volume_to_table(db_cursor: sqlite3.Cursor, book_id: int) -> int:
     '''
     Given the book_id of a book, create a volume that is stored in the
     database. Return the volume_id of the newly created volume.
     '''
     db_cursor.execute("INSERT INTO Volumes(BookID) VALUES (?)", [book_id])
+    # VolumeID is an alias for the rowid, so lastrowid is the new VolumeID.
+    # This used to be found by walking every volume of the book and looking
+    # for the one not yet in Collections, which got slower with every copy.
+    volume_id = db_cursor.lastrowid
     db_cursor.connection.commit()
-    # Grab all copies of the book from the Table Volumes
-    db_cursor.execute("SELECT VolumeID FROM Volumes WHERE BookID=?", [book_id])
-    # We can use SELECT last_inserted_row() to do it quickly but where's the
-    # fun in that? I wrote an algorithm to do it to better understand the
-    # language
-    v_rows: list = db_cursor.fetchall()
-    v_rows_index = 0
-    v_rows_len = len(v_rows)
-    while v_rows_index >= 0 and v_rows_index < v_rows_len:
-        v_row = v_rows[v_rows_index]
-        volume_id = v_row[0]
-        # Check if the book is already mapped to Collections
-        db_cursor.execute("SELECT VolumeID FROM Collections WHERE VolumeID=?",
-                          [volume_id])
-        # NOTE: In schema, Collections(VolumeID) is unique so we can just take
-        # the first result
-        c_row = db_cursor.fetchone()
-        if c_row is None:
-            # This means given Volume is not in Collections and is the newly
-            # created volume. So we do not need to iterate over the remaining
-            break
-        else:
-            # This book has been found Collections and we need to check the
-            # remaining rows.
-            v_rows_index += 1
-    if v_rows_index >= v_rows_len:
-        # Something catastrophic happened
-        raise ValueError
+    tosho_metrics.count('toshokan_rows_written_total', table='Volumes')
     return volume_id
 
 
@@ -229,6 +928,7 @@ def add_borrower_to_table(db_cursor: sqlite3.Cursor, name: str,
     try:
         db_cursor.execute("INSERT INTO Borrowers(Name, ContactNumber) VALUES "
                           "(?, ?)", [name, contact_number])
+        borrower_id = db_cursor.lastrowid
         db_cursor.connection.commit()
     except sqlite3.IntegrityError:
         logger.error("Error: This Contact Number already exists in "
@@ -236,11 +936,8 @@ def add_borrower_to_table(db_cursor: sqlite3.Cursor, name: str,
                      "Borrower!")
         db_cursor.execute("SELECT BorrowerID FROM Borrowers WHERE "
                           "ContactNumber=?", [contact_number])
-    else:
-        db_cursor.execute("SELECT BorrowerID FROM Borrowers WHERE Name=? AND "
-                          "ContactNumber=?", [name, contact_number])
-    row = db_cursor.fetchone()
-    borrower_id = row[0]
+        row = db_cursor.fetchone()
+        borrower_id = row[0]
     return borrower_id
 
 
@@ -250,13 +947,12 @@ def add_library_to_table(db_cursor: sqlite3.Cursor,
     Create the Library entry which contains the name of a library. Return the
     LibraryID of the created library.
     '''
-    try:
-        db_cursor.execute("INSERT INTO Libraries(Name) VALUES (?)", [name])
+    library_id, inserted = _add_name_to_table(db_cursor, "Libraries",
+                                              "LibraryID", name)
+    if inserted:
         db_cursor.connection.commit()
-    except sqlite3.IntegrityError:
+    else:
         logger.info(f"{name} already exists in the database.")
-    library_id = db_cursor.execute("SELECT LibraryID from Libraries WHERE "
-                                   "Name=?", [name])
     return library_id
 
 
@@ -266,9 +962,9 @@ def add_book_to_table(db_cursor: sqlite3.Cursor, title: str, publish_date: str,
     Add information about the book to the table "Books". Return the BookID of
     the added book.
     '''
-    isbn_10 = identifiers['isbn_10']
-    isbn_13 = identifiers['isbn_13']
-    issn = identifiers['issn']
+    isbn_10 = normalize_identifier('isbn_10', identifiers['isbn_10'])
+    isbn_13 = normalize_identifier('isbn_13', identifiers['isbn_13'])
+    issn = normalize_identifier('issn', identifiers['issn'])
     oclc = identifiers['oclc']
     lccn = identifiers['lccn']
     db_cursor = db_cursor.execute("INSERT INTO Books(Title, PublishDate, "
@@ -276,19 +972,39 @@ def add_book_to_table(db_cursor: sqlite3.Cursor, title: str, publish_date: str,
                                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                                   [title, publish_date, pages, isbn_10,
                                    isbn_13, issn, oclc, lccn])
+    # BookID is an alias for the rowid, so there is no need to search for the
+    # row we just inserted.
+    book_id = db_cursor.lastrowid
     db_cursor.connection.commit()
-    db_cursor = db_cursor.execute("SELECT BookID FROM Books WHERE Title=? AND "
-                                  "PublishDate=? AND Pages=? AND (ISBN_10=? "
-                                  "OR ISBN_10 IS NULL) AND (ISBN_13=? OR "
-                                  "ISBN_13 IS NULL) AND (ISSN=? OR ISSN IS "
-                                  "NULL) AND (OCLC=? OR OCLC IS NULL) AND "
-                                  "(LCCN=? OR LCCN IS NULL)",
-                                  [title, publish_date, pages, isbn_10,
-                                   isbn_13, issn, oclc, lccn])
-    book_row = db_cursor.fetchone()
-    book_id = book_row[0]
+    tosho_metrics.count('toshokan_rows_written_total', table='Books')
     return book_id
 
+
+def add_merge_conflicts_to_table(db_cursor: sqlite3.Cursor,
+                                 conflicts: list) -> None:
+    '''
+    Add conflicts, as returned by merge_policy.merge_policy.merge() with the
+    keys 'id_type' and 'identifier' of the lookup added, to the review queue
+    MergeConflicts. The candidates and the chosen value are stored as JSON.
+
+    Nothing is committed, so that the conflicts can be written in the same
+    transaction as the books they belong to.
+    '''
+    db_cursor.executemany("INSERT INTO MergeConflicts(IdType, Identifier, "
+                          "Field, Candidates, Chosen, Rule, Created) VALUES "
+                          "(?, ?, ?, ?, ?, ?, datetime('now'))",
+                          [(conflict.get('id_type'),
+                            conflict.get('identifier'),
+                            conflict['field'],
+                            json.dumps(conflict['candidates'],
+                                       ensure_ascii=False),
+                            json.dumps(conflict['chosen'],
+                                       ensure_ascii=False),
+                            conflict['rule'])
+                           for conflict in conflicts])
+    tosho_metrics.count('toshokan_rows_written_total', len(conflicts),
+                        table='MergeConflicts')
+
 # NOTE: Functions to create mappings between two tables here
 
 
@@ -366,6 +1082,16 @@ def add_volume_library_relation(db_cursor: sqlite3.Cursor, volume_id: int,
 # NOTE: Update row entries here!
 
 
+def resolve_merge_conflict(db_cursor: sqlite3.Cursor,
+                           conflict_id: int) -> None:
+    '''
+    Mark a conflict of the review queue as reviewed.
+    '''
+    db_cursor.execute("UPDATE MergeConflicts SET Resolved = 1 WHERE "
+                      "ConflictID = ?", [conflict_id])
+    db_cursor.connection.commit()
+
+
 def update_identifiers(db_cursor: sqlite3.Cursor, identifiers: dict,
                        book_id: int) -> sqlite3.Cursor:
     '''
@@ -455,7 +1181,8 @@ def update_lccn(db_cursor: sqlite3.Cursor, identifier: int,
 
 # NOTE: Functions that return rows from tables here
 
-# TODO
+# The functions that read whole books back out of the database live in
+# tosho_query.
 
 
 if __name__ == "__main__":
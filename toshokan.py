@@ -11,23 +11,279 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import logging
+import sys
+logger = logging.getLogger(__name__)
+
+
 def main(args) -> None:
-    pass
+    configure_metrics(args)
+    configure_traffic(args)
+    configure_rate_limits(args)
+    configure_cache(args)
+    if args.command == "bulk":
+        bulk(args)
+    elif args.command == "search":
+        search(args)
+    elif args.command == "reindex":
+        reindex(args)
+    elif args.command == "export":
+        export(args)
+    elif args.command == "import":
+        import_records(args)
+    else:
+        lookup(args)
+
+
+def configure_cache(args) -> None:
+    '''
+    Set up the on-disk cache of provider responses from the command line
+    arguments.
+    '''
+    import os
+    import provider_cache
+    if args.cache_mode == "bypass":
+        return
+    cache_path = os.path.expanduser(args.cache)
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok = True)
+    provider_cache.configure_cache(cache_path, args.cache_mode)
+
+
+def configure_metrics(args) -> None:
+    '''
+    Start collecting metrics if a file to write them to was given on the
+    command line.
+    '''
+    import tosho_metrics
+    sinks = []
+    if args.metrics_json:
+        sinks.append(tosho_metrics.json_sink(args.metrics_json))
+    if args.metrics_prometheus:
+        sinks.append(tosho_metrics.prometheus_sink(args.metrics_prometheus))
+    if sinks:
+        tosho_metrics.enable(*sinks, interval = args.metrics_interval)
+
+
+def configure_rate_limits(args) -> None:
+    '''
+    Set up the rate limits of the requests to the online databases from the
+    command line arguments.
+    '''
+    import provider_limits
+    try:
+        provider_limits.configure_rate_limits(
+            enabled = not args.no_rate_limit, max_rate = args.max_rate)
+    except ValueError as e:
+        sys.exit(str(e))
+
+
+def configure_traffic(args) -> None:
+    '''
+    Set up the recording or replay of the traffic to the online databases
+    from the command line arguments.
+    '''
+    import provider_http
+    if args.traffic == "live":
+        return
+    if args.traffic_archive is None:
+        sys.exit(f"--traffic {args.traffic} needs --traffic-archive.")
+    provider_http.configure_traffic(args.traffic, args.traffic_archive,
+                                    args.replay_latency)
+    # Responses served from the cache would neither be recorded nor come
+    # from the archive.
+    args.cache_mode = "bypass"
+
+
+def lookup(args) -> None:
+    '''
+    Look up a single book and print what the providers know about it. With
+    --add, add a copy of it to the database instead, without asking the
+    providers if the database already has the book.
+    '''
+    if not args.add:
+        from lookup_data import lookup_data
+        print(lookup_data(args.idtype, args.book_id,
+                          interactive = args.interactive))
+        return
+    from lookup_data import add_to_catalog
+    from tosho_database import tosho_database
+    with tosho_database(args.db_path, args.db_name,
+                        profile = args.profile or "interactive") as database:
+        found_book, is_new = add_to_catalog(database, args.idtype,
+                                            args.book_id,
+                                            library_id = args.library_id,
+                                            interactive = args.interactive)
+    if found_book.book_id < 0:
+        print(f"No online database knows {args.book_id}. Nothing was added.")
+        return
+    print(found_book)
+    print("Added the book to the catalog." if is_new
+          else "Added another copy of a book already in the catalog.")
+
+
+def bulk(args) -> None:
+    '''
+    Look up every ISBN in the input file (one per line) and add the books that
+    were found to the database.
+    '''
+    from bulk_lookup import bulk_lookup
+    if args.input == "-":
+        isbns = (line.strip() for line in sys.stdin if line.strip())
+        summary = bulk_lookup(isbns, args.db_path, args.db_name,
+                              concurrency = args.concurrency,
+                              queue_size = args.queue_size,
+                              batch_size = args.batch_size,
+                              profile = args.profile or "bulk-import")
+    else:
+        with open(args.input) as isbn_file:
+            isbns = (line.strip() for line in isbn_file if line.strip())
+            summary = bulk_lookup(isbns, args.db_path, args.db_name,
+                                  concurrency = args.concurrency,
+                                  queue_size = args.queue_size,
+                                  batch_size = args.batch_size,
+                                  profile = args.profile or "bulk-import")
+    print(f"Read {summary['read']} ISBNs ({summary['invalid']} invalid, "
+          f"{summary['duplicates']} duplicates, "
+          f"{summary['in_catalog']} already in the catalog), "
+          f"looked up {summary['looked_up']} "
+          f"({summary['lookups_per_second']:.1f}/s), "
+          f"{summary['not_found']} not found, "
+          f"{summary['conflicts']} conflicts to review, "
+          f"wrote {summary['written']} volumes in "
+          f"{summary['elapsed']:.1f} seconds.")
+
+
+def search(args) -> None:
+    '''
+    Print the books in the database that best match the search terms.
+    '''
+    from tosho_sqlite import connect_to_database
+    from tosho_search import search as search_books
+    db_conn = connect_to_database(args.db_path, args.db_name,
+                                  args.profile or "interactive")
+    try:
+        for found_book in search_books(db_conn.cursor(), " ".join(args.terms),
+                                       args.limit):
+            print(found_book)
+    finally:
+        db_conn.close()
+
+
+def reindex(args) -> None:
+    '''
+    Rebuild the full-text search index of the database.
+    '''
+    from tosho_sqlite import connect_to_database
+    from tosho_search import rebuild_search_index
+    db_conn = connect_to_database(args.db_path, args.db_name,
+                                  args.profile or "bulk-import")
+    try:
+        book_count = rebuild_search_index(db_conn)
+    finally:
+        db_conn.close()
+    print(f"Indexed {book_count} books.")
+
+
+def export(args) -> None:
+    '''
+    Write every book in the database to a file or standard output.
+    '''
+    from tosho_export import export_catalog
+    book_count = export_catalog(args.db_path, args.db_name, args.output,
+                                args.export_format,
+                                compress = True if args.gzip else None,
+                                chunk_size = args.chunk_size,
+                                profile = args.profile or "read-only-replica")
+    if args.output != "-":
+        print(f"Exported {book_count} books to {args.output}.")
+
+
+def import_records(args) -> None:
+    '''
+    Add the books in a CSV, JSON Lines or MARC file to the database.
+    '''
+    from tosho_import import import_file
+    summary = import_file(args.input, args.db_path, args.db_name,
+                          args.import_format,
+                          library_id = args.library_id,
+                          batch_size = args.batch_size,
+                          resume = not args.restart,
+                          profile = args.profile or "bulk-import")
+    resumed = f" (resumed after {summary['resumed_from']})" \
+        if summary['resumed_from'] else ""
+    print(f"Read {summary['records']} records{resumed}, imported "
+          f"{summary['imported']}, skipped {summary['skipped']} in "
+          f"{summary['elapsed']:.1f} seconds.")
+
 
-if __name__="__main__":
+if __name__ == "__main__":
     import argparse
     parser = \
-        argparse.ArgumentParser(description = "Given an identifier, returns "
-                                "information about a book as contained in the "
-                                "Open Library database.")
-    parser.add_argument("book_id", type = str, help = "The identifier of a "
-                        "book. Default assumption is that the ID is an ISBN.",
-                        metavar = "ID")
+        argparse.ArgumentParser(description = "Catalog a personal library.")
+    parser.add_argument("-v", "--verbose", action = "store_true",
+                        help = "Log progress information.")
+    parser.add_argument("--cache", default = "~/.cache/toshokan/responses.db",
+                        help = "The file in which the responses of the "
+                        "online databases are cached.")
+    parser.add_argument("--cache-mode", default = "use",
+                        choices = ["use", "refresh", "bypass"],
+                        help = "'refresh' ignores cached responses but "
+                        "stores new ones, 'bypass' does not use the cache at "
+                        "all.")
+    parser.add_argument("--traffic", default = "live",
+                        choices = ["live", "record", "replay"],
+                        help = "'record' saves every request to the online "
+                        "databases and its response to the traffic archive, "
+                        "'replay' answers the requests from it without any "
+                        "network access. Both turn the cache off.")
+    parser.add_argument("--traffic-archive", default = None,
+                        help = "The file the traffic is recorded to or "
+                        "replayed from, a gzip file of JSON lines.")
+    parser.add_argument("--replay-latency", default = None,
+                        help = "Delay every replayed response by this many "
+                        "seconds, or by as long as it took when it was "
+                        "recorded with 'recorded'. No delay by default.")
+    parser.add_argument("--max-rate", type = float, default = None,
+                        help = "The most requests per second sent to each "
+                        "online database. Below that, the rate adapts to "
+                        "how often they ask us to slow down.")
+    parser.add_argument("--no-rate-limit", action = "store_true",
+                        help = "Send requests to the online databases as fast "
+                        "as possible.")
+    parser.add_argument("--metrics-json", default = None,
+                        help = "Write timings and counters of the lookups and "
+                        "database writes to this JSON file.")
+    parser.add_argument("--metrics-prometheus", default = None,
+                        help = "Write the same metrics to this file in the "
+                        "Prometheus text format, e.g. for the textfile "
+                        "collector of the node exporter.")
+    parser.add_argument("--metrics-interval", type = float, default = None,
+                        help = "Also write the metrics every this many "
+                        "seconds, not only on exit.")
+    subparsers = parser.add_subparsers(dest = "command")
+    lookup_parser = \
+        subparsers.add_parser("lookup", help = "Given an identifier, "
+                              "print information about a book as contained "
+                              "in the online databases.")
+    lookup_parser.add_argument("book_id", type = str, help = "The identifier "
+                               "of a book. Default assumption is that the ID "
+                               "is an ISBN.", metavar = "ID")
     # TODO. Let's first get ISBN lookups working.
     #group = parser.add_mutually_exclusive_group()
-    parser.add_argument("-i", "--isbn", action="store_const", const=1,
-                       default=1, #type=str,
-                       help="The ID is processed as an ISBN. Enabled default.")
+    lookup_parser.add_argument("-i", "--isbn", action="store_const", const=1,
+                               default=1, #type=str,
+                               help="The ID is processed as an ISBN. Enabled "
+                               "default.")
+    lookup_parser.add_argument("--interactive", action = "store_true",
+                               help = "Ask which value to keep when the "
+                               "online databases disagree, instead of "
+                               "following the merge rules.")
+    lookup_parser.add_argument("--add", action = "store_true",
+                               help = "Add a copy of the book to the "
+                               "database. Books already in the database are "
+                               "not looked up again.")
+    lookup_parser.add_argument("--library-id", type = int, default = 1,
+                               help = "The library the copy is added to.")
     # group.add_argument("-l", "--lccn", action="store_const", const = 1,
     #                    default = 0, type = str,
     #                    help = "The ID is processed as an LCCN.")
@@ -38,9 +294,84 @@ if __name__="__main__":
     #                    default = 0, type = str, 
     #                    help = "The ID is processed as Open Library's "
     #                    "internal identifier the book.")
+    bulk_parser = \
+        subparsers.add_parser("bulk", help = "Look up a list of ISBNs and add "
+                              "the books to the database.")
+    bulk_parser.add_argument("input", nargs = "?", default = "-",
+                             help = "A file with one ISBN per line. Reads "
+                             "from standard input if omitted.")
+    bulk_parser.add_argument("--concurrency", type = int, default = 8,
+                             help = "The number of ISBNs looked up at the "
+                             "same time.")
+    bulk_parser.add_argument("--queue-size", type = int, default = 256,
+                             help = "The number of books that may wait to be "
+                             "written before lookups are paused.")
+    bulk_parser.add_argument("--batch-size", type = int, default = 100,
+                             help = "The largest number of books written in "
+                             "one transaction.")
+    search_parser = \
+        subparsers.add_parser("search", help = "Search the titles, authors and "
+                              "publishers of the books in the database.")
+    search_parser.add_argument("terms", nargs = "+", help = "The words to "
+                               "search for. Words may be abbreviated.")
+    search_parser.add_argument("--limit", type = int, default = 20,
+                               help = "The largest number of books shown.")
+    reindex_parser = \
+        subparsers.add_parser("reindex", help = "Rebuild the search index of "
+                              "the database.")
+    export_parser = \
+        subparsers.add_parser("export", help = "Write every book in the "
+                              "database as JSON Lines or CSV.")
+    export_parser.add_argument("output", nargs = "?", default = "-",
+                               help = "The file to write to. Writes to "
+                               "standard output if omitted.")
+    export_parser.add_argument("--format", dest = "export_format",
+                               default = "jsonl", choices = ["jsonl", "csv"],
+                               help = "The format of the export.")
+    export_parser.add_argument("--gzip", action = "store_true",
+                               help = "Compress the output with gzip. Files "
+                               "ending in .gz are always compressed.")
+    export_parser.add_argument("--chunk-size", type = int, default = 1000,
+                               help = "The number of books read from the "
+                               "database at a time.")
+    import_parser = \
+        subparsers.add_parser("import", help = "Add the books in a CSV, JSON "
+                              "Lines or MARC file to the database without "
+                              "looking them up.")
+    import_parser.add_argument("input", help = "The file to import.")
+    import_parser.add_argument("--format", dest = "import_format",
+                               default = None,
+                               choices = ["csv", "jsonl", "marc"],
+                               help = "The format of the file. Guessed from "
+                               "its extension by default.")
+    import_parser.add_argument("--batch-size", type = int, default = 1000,
+                               help = "The number of books written in one "
+                               "transaction.")
+    import_parser.add_argument("--library-id", type = int, default = 1,
+                               help = "The library the books are added to.")
+    import_parser.add_argument("--restart", action = "store_true",
+                               help = "Read the file from the start even if "
+                               "an earlier import of it was interrupted.")
+    for subparser in (lookup_parser, bulk_parser, search_parser,
+                      reindex_parser, export_parser, import_parser):
+        subparser.add_argument("--db-path", default = "./",
+                               help = "The directory of the database.")
+        subparser.add_argument("--db-name", default = "toshokan.db",
+                               help = "The file name of the database.")
+        subparser.add_argument("--profile", default = None,
+                               choices = ["interactive", "bulk-import",
+                                          "read-only-replica"],
+                               help = "The connection profile (SQLite "
+                               "settings) used for the database. Each "
+                               "command picks a suitable one by default.")
     # NOTE: ISBN is temporary, will be replaced by code from the parser later
-    idtype = "ISBN"
     # NOTE: 'parser' will be changed to group when I enable the flags for the
     #       ArgumentParser
     args = parser.parse_args()
+    args.idtype = "ISBN"
+    if args.command is None:
+        parser.print_help()
+        sys.exit(2)
+    logging.basicConfig(level = logging.INFO if args.verbose
+                        else logging.WARNING)
     main(args)